@@ -5,4 +5,20 @@ python manage.py collectstatic --no-input
 
 DJANGO_SUPERUSER_PASSWORD=$SUPER_USER_PASSWORD python manage.py createsuperuser --username $SUPER_USER_NAME --email $SUPER_USER_EMAIL --noinput
 
+# Metrics files of the previous run's workers, /metrics sums whatever is there
+if [ -n "$METRICS_DIR" ]; then
+    rm -rf "$METRICS_DIR" && mkdir -p "$METRICS_DIR"
+fi
+
+# Background job worker, runs next to gunicorn so it also works against a local SQLite file
+python manage.py run_jobs &
+
+# SERVER=uvicorn serves cygree.asgi with uvicorn workers: the async endpoints (client
+# history, notifications, agent request list) then wait on the database without
+# holding a worker, so one process handles many concurrent clients. Login stays sync,
+# its password hash runs in a thread rather than on the event loop.
+if [ "$SERVER" = "uvicorn" ]; then
+    exec uvicorn cygree.asgi:application --host 0.0.0.0 --port 8000 --workers "${WEB_CONCURRENCY:-4}" --proxy-headers
+fi
+
 gunicorn cygree.wsgi:application --bind 0.0.0.0:8000
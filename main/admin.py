@@ -4,6 +4,9 @@ from unfold.admin import ModelAdmin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.contrib.auth.admin import GroupAdmin as BaseGroupAdmin
 from django.contrib.auth.models import User, Group
+from datetime import timedelta
+from django.utils import timezone
+from main import rollups
 
 from unfold.admin import ModelAdmin
 
@@ -35,7 +38,9 @@ class UserProfileAdminClass(ModelAdmin):
 
 @admin.register(PlasticCollection)
 class PlasticCollectionAdminClass(ModelAdmin):
-    pass
+    list_display = ['__str__', 'status', 'collection_date', 'possible_duplicate_of']
+    list_filter = ['status', ('possible_duplicate_of', admin.EmptyFieldListFilter)]
+    raw_id_fields = ['possible_duplicate_of']
 @admin.register(ListReward)
 class ListRewardAdminClass(ModelAdmin):
     pass
@@ -50,4 +55,56 @@ class RewardAdminClass(ModelAdmin):
 
 @admin.register(Badge)
 class BadgeAdminClass(ModelAdmin):
-    pass
\ No newline at end of file
+    pass
+
+@admin.register(PointsLedger)
+class PointsLedgerAdminClass(ModelAdmin):
+    list_display = ['user', 'reason', 'points', 'plastic', 'created_date']
+
+
+@admin.register(MediaBlob)
+class MediaBlobAdminClass(ModelAdmin):
+    list_display = ['name', 'size', 'ref_count', 'created_date']
+
+
+@admin.register(Job)
+class JobAdminClass(ModelAdmin):
+    list_display = ['task', 'status', 'priority', 'attempts', 'run_after', 'finished_date']
+    list_filter = ['status']
+    search_fields = ['task', 'key']
+
+
+@admin.register(DailyRollup)
+class DailyRollupAdminClass(ModelAdmin):
+    list_display = ['day', 'dimension', 'collections', 'kg', 'points_issued', 'rewards', 'points_redeemed']
+    list_filter = ['day']
+    search_fields = ['dimension']
+
+
+# Analytics on the admin index, read from the daily rollups only (UNFOLD["DASHBOARD_CALLBACK"])
+admin.site.index_template = 'main/admin_index.html'
+
+
+def dashboard_callback(request, context):
+    today = timezone.localdate()
+    month = rollups.range_totals('global', today - timedelta(days=29), today)
+    days = rollups.daily_series('global', today - timedelta(days=13), today)
+    context.update({
+        'rollup_cards': [
+            {'title': 'Kg collected, last 30 days', 'value': month['kg']},
+            {'title': 'Collections, last 30 days', 'value': month['collections']},
+            {'title': 'Points issued, last 30 days', 'value': month['points_issued']},
+            {'title': 'Points redeemed, last 30 days', 'value': month['points_redeemed']},
+        ],
+        'rollup_days': {
+            'headers': ['Day', 'Collections', 'Kg', 'Points issued', 'Points redeemed'],
+            'rows': [[day['day'], day['collections'], day['kg'], day['points_issued'], day['points_redeemed']]
+                     for day in reversed(days)],
+        },
+        'rollup_cities': {
+            'headers': ['City', 'Kg', 'Collections'],
+            'rows': [[row['city'], row['kg'], row['collections']]
+                     for row in rollups.top_dimensions('city', today - timedelta(days=29), today)],
+        },
+    })
+    return context
@@ -1,4 +1,5 @@
-from .services import UserModelService
+from .services import UserModelService, anearest_open_requests, acollection_totals, encode_cursor, decode_cursor, \
+    claim_collections, collect_collections, dispatch_requests
 from .schema import *
 from ninja_jwt.controller import NinjaJWTDefaultController
 from ninja_jwt.authentication import JWTAuth
@@ -21,9 +22,16 @@ from main.models import *
 from ninja import Swagger,UploadedFile,File
 from django.contrib.auth import authenticate
 from ninja_jwt.tokens import RefreshToken
-from django.http import JsonResponse
+from django.http import StreamingHttpResponse
+from django.db import transaction
 from django.db.models import Q
+from django.core.exceptions import ValidationError
 from django.middleware.csrf import get_token
+from django.utils import timezone
+from datetime import date, timedelta
+from main import events, images, catalog, leaderboards, rollups, exports, imports, jobs, versions
+from main.renderers import ORJSONParser, ORJSONRenderer, ORJSONResponse
+from main.auth import ProfileJWTAuth, ProfileJWTQueryAuth, add_profile_claims, owned_profile_id, aowned_profile_id
 
 api = NinjaExtraAPI(title="CyGree",description="""
   <p>Cygree is designed to transform the way we handle plastic waste. This API enables users to recycle plastics efficiently while earning valuable incentives.</p>
@@ -38,23 +46,32 @@ api = NinjaExtraAPI(title="CyGree",description="""
   </ul>
   
   <p>By integrating Cygree, businesses and developers can contribute to a greener planet while engaging users in a rewarding recycling journey. Together, we can reduce plastic waste and create a sustainable future.</p>
-""",urls_namespace='api',docs=Swagger({"persistAuthorization": True})
+""",urls_namespace='api',docs=Swagger({"persistAuthorization": True}),
+                    renderer=ORJSONRenderer(),parser=ORJSONParser()
                     )
 
 api.register_controllers(NinjaJWTDefaultController)
 
 class IsOwner(permissions.BasePermission):
     def has_permission(self, request, controller):
-        # Allow access only if the user id is same as obj user id
-        user_id = request.path.split('/')
-        for i in user_id:
-            if(i.isnumeric()):
-                return request.auth.id == int(i)
-        return False
+        # Allow access only if the user id in the route is the authenticated user's id
+        user_id = controller.context.kwargs.get('user_id')
+        if user_id is None:
+            return False
+        return request.auth.id == int(user_id)
     # def has_object_permission(self, request, controller, obj):
     #     # Allow access only if the authenticated user is the owner of the object
     #     return request.auth.id == obj.user.id
 
+class IsAgent(permissions.BasePermission):
+    def has_permission(self, request, controller):
+        # Role comes from the signed token, no profile lookup
+        return getattr(request.auth, 'role', None) in ('Agent', 'Admin')
+
+class IsAdmin(permissions.BasePermission):
+    def has_permission(self, request, controller):
+        return getattr(request.auth, 'role', None) == 'Admin'
+
 #First create user with basic details
 #Password updation and other critical operations are performed on user model
 @api.get("/set-csrf-token")
@@ -64,31 +81,32 @@ def get_csrf_token(request):
 
 @api.post('/user/login', tags=['Login'], url_name='login')
 def login(request, data: LoginSchema):
+    # Sync on purpose: the password hash takes hundreds of milliseconds of CPU, under uvicorn
+    # it runs in a worker thread instead of stalling the event loop
     user = authenticate(username=data.username, password=data.password)
     if user:
         try:
             profile = UserProfile.objects.get(user=user)
             role = "Admin" if user.is_superuser else profile.role
-            refresh = RefreshToken.for_user(user)
-            return JsonResponse({
-                'id': profile.user.id,
+            refresh = add_profile_claims(RefreshToken.for_user(user), profile, role)
+            return ORJSONResponse({
+                'id': user.id,
                 'access': str(refresh.access_token),
                 'refresh': str(refresh),
                 'role': role
             })
         except UserProfile.DoesNotExist:
-            return JsonResponse({'error': 'User profile does not exist'}, status=400)
-    return JsonResponse({'error': 'Invalid credentials'}, status=400)
+            return ORJSONResponse({'error': 'User profile does not exist'}, status=400)
+    return ORJSONResponse({'error': 'Invalid credentials'}, status=400)
 
 
 
 @api.post('user/register',tags=['Register'],url_name='register',response=UserSchemaOut)
 def Register(request, data:UserSchemaIn):
-    user=User.objects.create_user(username=data.username,password=data.password,first_name=data.first_name
-                                  ,last_name=data.last_name, email=data.email)
-    profile=UserProfile.objects.create(user=user)
-    user.save()
-    profile.save()
+    with transaction.atomic():
+        user=User.objects.create_user(username=data.username,password=data.password,first_name=data.first_name
+                                      ,last_name=data.last_name, email=data.email)
+        UserProfile.objects.create(user=user)
     return user
 
 @api_controller("/user",tags=["UserOperations"],auth=JWTAuth())
@@ -103,10 +121,11 @@ class UserModelController(ModelControllerBase):
 api.register_controllers(UserModelController)
 
 #Hold extra information related to user to setup its profile
-@api_controller('/profile', tags=['UserOperations'],auth=JWTAuth(),permissions=[IsOwner])
+@api_controller('/profile', tags=['UserOperations'],auth=ProfileJWTAuth(),permissions=[IsOwner])
 class ProfileModelController:
 
     @http_get('/{user_id}', response=UserProfileSchemaOut, url_name='get_user')
+    @versions.conditional(lambda profile_id: [versions.profile_key(profile_id)])
     def Get_user(self, request, user_id: int):
         """Retrieve a user profile by user ID"""
         profile = UserProfile.objects.get(user__id=user_id)
@@ -136,22 +155,28 @@ class ProfileModelController:
                             setattr(profile, attr, value)
                     else:
 
-                        return JsonResponse({'error': f'Invalid field: {str(e)}'}, status=400)
+                        return ORJSONResponse({'error': f'Invalid field: {str(e)}'}, status=400)
             if pic:
-                profile.profile_pic.save(pic.name, pic)
+                profile.profile_pic.save(pic.name, pic, save=False)
             
             profile.save()
+            if pic:
+                images.schedule(profile, 'profile_pic')
             return profile  
         except Exception as e:
-            return JsonResponse({'error': f'Error during update: {str(e)}'}, status=500)
+            return ORJSONResponse({'error': f'Error during update: {str(e)}'}, status=500)
 
 api.register_controllers(ProfileModelController)
 
+HISTORY_MAX_LIMIT = 200
+HISTORY_KEYS = {'Request': 'unclaimed_requests', 'Pending': 'pending_requests', 'Collected': 'completed_requests'}
+
 #Client based operations
-@api_controller('/client', tags=['ClientOperations'],auth=JWTAuth(),permissions=[IsOwner])
+@api_controller('/client', tags=['ClientOperations'],auth=ProfileJWTAuth(),permissions=[IsOwner])
 class ClientModelController:
 
     @http_get('/{user_id}', response=dict)
+    @versions.conditional(lambda profile_id: [versions.profile_key(profile_id)])
     def get_total_points(self, request, user_id: int):
         """Retrieve total points of a user and plastic collected(in kg)"""
         profile = UserProfile.objects.get(user__id=user_id)
@@ -160,42 +185,55 @@ class ClientModelController:
     @http_get('/{user_id}/badges', response=list)
     def get_badges(self, request, user_id: int):
         """Retrieve badges earned by a user"""
-        badges = Badge.objects.filter(user__user__id=user_id)
+        badges = Badge.objects.filter(user_id=owned_profile_id(request, user_id))
         return [{'name': badge.name, 'issued_date': badge.issued_date} for badge in badges]
     
     @http_post('/{user_id}/collection', response=dict)
-    def post_collection_request(self, user_id: int, amount_collected: float, pic: UploadedFile):
-        """Post a request for plastic collection with an image of plastic waste"""
+    def post_collection_request(self, user_id: int, amount_collected: float, pic: UploadedFile,
+                                latitude: Optional[float] = None, longitude: Optional[float] = None):
+        """Post a request for plastic collection with an image of plastic waste, optionally with pickup coordinates"""
         profile = UserProfile.objects.get(user__id=user_id)
         if not profile.city or not profile.state:
-            return JsonResponse({'error': 'Please update your profile details, especially your location'}, status=400)
+            return ORJSONResponse({'error': 'Please update your profile details, especially your location'}, status=400)
+        if (latitude is None) != (longitude is None) or \
+                (latitude is not None and not (-90 <= latitude <= 90 and -180 <= longitude <= 180)):
+            return ORJSONResponse({'error': 'Invalid pickup coordinates'}, status=400)
         collection = PlasticCollection.objects.create(
             user=profile,
             amount_collected=amount_collected,
             collection_pic=pic,
-            status='Request'
+            status='Request',
+            latitude=latitude,
+            longitude=longitude
         )
-        collection.collection_pic.save(pic.name, pic)
-        collection.save()
+        images.schedule(collection, 'collection_pic')
         return {'message': 'Collection request posted successfully'}
     @http_get('/{user_id}/history', response=dict)
-    def get_history(self, request, user_id: int):
-        """Retrieve history of plastic collections showing pending and completed requests"""
-        unclaimed_requests = PlasticCollection.objects.filter(user__user__id=user_id, status='Request')
-        pending_requests = PlasticCollection.objects.filter(user__user__id=user_id, status='Pending')
-        completed_requests = PlasticCollection.objects.filter(user__user__id=user_id, status='Collected')
-        return {
-            'unclaimed_requests': [{'amount_collected': req.amount_collected, 'collection_date': req.collection_date} for req in unclaimed_requests],
-            'pending_requests': [{'amount_collected': req.amount_collected, 'collection_date': req.collection_date} for req in pending_requests],
-            'completed_requests': [{'amount_collected': req.amount_collected, 'collection_date': req.collection_date} for req in completed_requests]
-        }
+    @versions.conditional(lambda profile_id: [versions.collections_key(profile_id)])
+    async def get_history(self, request, user_id: int, limit: int = 50, offset: int = 0, include_totals: bool = False):
+        """Retrieve history of plastic collections showing pending and completed requests, newest first"""
+        limit = min(max(limit, 1), HISTORY_MAX_LIMIT)
+        offset = max(offset, 0)
+        # One query for the page (plus one row to detect whether another page exists)
+        profile_id = await aowned_profile_id(request, user_id)
+        rows = [row async for row in PlasticCollection.objects.filter(user_id=profile_id)
+                .order_by('-collection_date', '-id')
+                .values('id', 'status', 'amount_collected', 'collection_date')[offset:offset + limit + 1]]
+        history = {'unclaimed_requests': [], 'pending_requests': [], 'completed_requests': []}
+        for row in rows[:limit]:
+            history[HISTORY_KEYS[row.pop('status')]].append(row)
+        history['next_offset'] = offset + limit if len(rows) > limit else None
+        if include_totals:
+            history['totals'] = await acollection_totals(PlasticCollection.objects.filter(user_id=profile_id))
+        return history
     @http_get('/{user_id}/rewards', response=list)
-    def list_claimable_rewards(self, user_id: int):
+    @versions.conditional(lambda profile_id: [versions.profile_key(profile_id), versions.rewards_key(profile_id), versions.CATALOG_KEY])
+    def list_claimable_rewards(self, request, user_id: int):
         """List all claimable rewards for a user"""
-        profile = UserProfile.objects.get(user__id=user_id)
-        claimed_rewards = Reward.objects.filter(user__user__id=user_id).values_list('reward__id', flat=True)
-        claimable_rewards = ListReward.objects.exclude(pk__in=claimed_rewards).filter(points_required__lte=profile.earned_points)
-        return [{'id': reward.id, 'name': reward.title, 'points_required': reward.points_required} for reward in claimable_rewards]
+        profile_id, earned_points = UserProfile.objects.filter(user__id=user_id).values_list('id', 'earned_points').get()
+        claimed = catalog.claimed_reward_ids(profile_id)
+        return [{'id': reward['id'], 'name': reward['title'], 'points_required': reward['points_required']}
+                for reward in catalog.catalog.affordable(earned_points) if reward['id'] not in claimed]
 
     @http_post('/{user_id}/rewards/{reward_id}/claim', response=dict)
     def claim_reward(self, request, user_id: int, reward_id: int):
@@ -204,58 +242,106 @@ class ClientModelController:
         reward = ListReward.objects.get(id=reward_id)
         
         if profile.earned_points >= reward.points_required:
-            obj,created = Reward.objects.get_or_create(user=profile, reward=reward)
+            try:
+                obj,created = Reward.objects.get_or_create(user=profile, reward=reward)
+            except ValidationError:
+                # Balance was spent by a concurrent claim after we read it
+                return ORJSONResponse({'error': 'Not enough points to claim this reward'}, status=400)
             if created:
                 return {'message': 'Reward claimed successfully'}
             else:
-                return JsonResponse({'error': 'Already Claimed.'}, status=400)
+                return ORJSONResponse({'error': 'Already Claimed.'}, status=400)
             
-        return JsonResponse({'error': 'Not enough points to claim this reward'}, status=400)
+        return ORJSONResponse({'error': 'Not enough points to claim this reward'}, status=400)
 
     @http_get('/{user_id}/rewards/history', response=list)
     def claimed_rewards_history(self, request, user_id: int):
         """Retrieve claimed rewards history of a user"""
-        claimed_rewards = Reward.objects.filter(user__user__id=user_id)
+        claimed_rewards = Reward.objects.filter(user_id=owned_profile_id(request, user_id)).select_related('reward')
         return [{'title': reward.reward.title, 'claimed_date': reward.claimed_date} for reward in claimed_rewards]
 
 api.register_controllers(ClientModelController)
 
-@api_controller('/notifications', tags=['Notifications'],auth=JWTAuth())
+INBOX_MAX_LIMIT = 100
+
+@api_controller('/notifications', tags=['Notifications'],auth=ProfileJWTAuth())
 class NotificationModelController:
 
     @http_post('/{user_id}/send', response=dict)
     def send_notification(self, request, user_id: int, message: str, importance_level: Optional[str] = 'Low'):
         """Send a notification to a user"""
-        notification = Notification.objects.create(
-            user=user_id,
+        recipient = UserProfile.objects.get(user__id=user_id)
+        sender = UserProfile(pk=request.auth.profile_id) if request.auth.profile_id else recipient
+        Notification.objects.create(
+            user=sender,
+            to_user=recipient,
             message=message,
             importance_level=importance_level
         )
-        notification.save()
         return {'message': 'Notification sent successfully'}
 
+    @http_post('/broadcast', response=dict, permissions=[IsAgent])
+    def broadcast(self, request, message: str, importance_level: Optional[str] = 'Low', city: Optional[str] = None,
+                  state: Optional[str] = None, role: Optional[str] = None):
+        """Send a notification to every user in a city, state and/or role"""
+        if not (city or state or role):
+            return ORJSONResponse({'error': 'city, state or role is required'}, status=400)
+        recipients = UserProfile.objects.all()
+        if city:
+            recipients = recipients.filter(city__iexact=city)
+        if state:
+            recipients = recipients.filter(state__iexact=state)
+        if role:
+            recipients = recipients.filter(role=role)
+        sent = Notification.broadcast(request.auth.profile_id, recipients, message, importance_level)
+        return {'message': 'Notification broadcast successfully', 'recipients': sent}
+
     @http_get('/{user_id}', response=list)
-    def get_notifications(self, request, user_id: int):
+    async def get_notifications(self, request, user_id: int):
         """Retrieve all notifications for a user"""
         notifications = Notification.objects.filter(to_user__user__id=user_id).order_by('-notification_date')
-        return [{ 'id': notification.id,'message': notification.message, 'notification_date': notification.notification_date, 'is_read': notification.is_read} for notification in notifications]
+        return [row async for row in notifications.values('id', 'message', 'notification_date', 'is_read')]
+
+    @http_get('/{user_id}/inbox', response=dict, permissions=[IsOwner])
+    async def get_inbox(self, request, user_id: int, limit: int = 20, cursor: Optional[str] = None, unread_only: bool = False):
+        """Retrieve one page of notifications for a user, newest first. Pass next_cursor back to get the following page"""
+        limit = min(max(limit, 1), INBOX_MAX_LIMIT)
+        notifications = Notification.objects.filter(to_user_id=await aowned_profile_id(request, user_id))
+        if unread_only:
+            notifications = notifications.filter(is_read=False)
+        if cursor:
+            try:
+                notification_date, notification_id = decode_cursor(cursor)
+            except ValueError:
+                return ORJSONResponse({'error': 'Invalid cursor'}, status=400)
+            notifications = notifications.filter(Q(notification_date__lt=notification_date) |
+                                                 Q(notification_date=notification_date, id__lt=notification_id))
+        page = [row async for row in notifications.order_by('-notification_date', '-id')
+                .values('id', 'message', 'importance_level', 'notification_date', 'is_read')[:limit + 1]]
+        next_cursor = None
+        if len(page) > limit:
+            page = page[:limit]
+            next_cursor = encode_cursor(page[-1]['notification_date'], page[-1]['id'])
+        return {'notifications': page, 'next_cursor': next_cursor}
+
+    @http_get('/{user_id}/unread_count', response=dict, permissions=[IsOwner])
+    async def unread_count(self, request, user_id: int):
+        """Number of unread notifications for a user"""
+        count = await (UserProfile.objects.filter(pk=await aowned_profile_id(request, user_id))
+                       .values_list('unread_notifications', flat=True).afirst())
+        return {'unread_count': count or 0}
 
     @http_patch('/{notification_id}/read', response=dict)
     def mark_as_read(self, request, notification_id: int):
         """Mark a notification as read"""
-        try:
-            notification = Notification.objects.get(id=notification_id)
-        except Notification.DoesNotExist:
+        notification = Notification.objects.filter(id=notification_id)
+        if not Notification.mark_read(notification) and not notification.exists():
             return {'message': 'Notification does not exist'}
-        notification.is_read = True
-        notification.save()
         return {'message': 'Notification marked as read'}
     @http_patch('/{user_id}/read/all', response=dict)
     def mark_all_read(self, request, user_id: int):
         """Mark a notification as read"""
-        notifications = Notification.objects.filter(to_user__user__id=user_id,is_read=False).order_by('-notification_date')
-        if notifications.exists():
-            notifications.update(is_read=True)
+        if Notification.mark_read(Notification.objects.filter(to_user__user__id=user_id)):
             return {'message': 'All Notifications marked as read'}
         
         return {'message': 'Already marked as read'}
@@ -263,33 +349,51 @@ class NotificationModelController:
 api.register_controllers(NotificationModelController)
 
 
-@api_controller('/agent', tags=['AgentOperations'],auth=JWTAuth())
+BATCH_MAX_IDS = 200
+DISPATCH_MAX_LIMIT = 20
+
+@api_controller('/agent', tags=['AgentOperations'],auth=ProfileJWTAuth(),permissions=[IsOwner, IsAgent])
 class AgentModelController:
 
     @http_get('/{user_id}/requests', response={ 200:List[ListCollection], 406:ErrorSchema})
-    def list_requests(self, user_id: int):
-        """List all unclaimed collection requests, optionally filtered by city or state with fuzzy search"""
-        agent_profile = UserProfile.objects.get(user__id=user_id)
+    async def list_requests(self, request, user_id: int, latitude: Optional[float] = None, longitude: Optional[float] = None,
+                            radius_km: float = 10, limit: int = 50):
+        """List all unclaimed collection requests, nearest first when the agent's coordinates are given,
+        otherwise filtered by the agent's city and state"""
+        if latitude is not None and longitude is not None:
+            if radius_km <= 0 or limit <= 0:
+                return 406,{'message': 'radius_km and limit must be positive'}
+            agent_id = await aowned_profile_id(request, user_id)
+            return 200,await anearest_open_requests(latitude, longitude, radius_km, limit, agent_id=agent_id)
+
+        agent_profile = await UserProfile.objects.aget(user__id=user_id)
         city = agent_profile.city
         state = agent_profile.state
         
-        filters = Q(status='Request')
+        filters = Q(status='Request') & PlasticCollection.available_to(agent_profile.id)
         if city and state:
             filters &= Q(user__city__icontains=city)
             filters &= Q(user__state__icontains=state)
-            res = PlasticCollection.objects.filter(filters).order_by('user__city', 'user__state')
-            return 200,res
+            res = PlasticCollection.objects.filter(filters).select_related('user').order_by('user__city', 'user__state')
+            return 200,[collection async for collection in res]
         else:
             return 406,{'message': 'Please update your profile details, especially your location'}
-        
+
+
+    @http_post('/{user_id}/dispatch', response={ 200:List[ListCollection], 406:ErrorSchema})
+    def dispatch(self, request, user_id: int, latitude: float, longitude: float, radius_km: float = 10, limit: int = 5):
+        """Reserve the next nearest unclaimed requests for this agent for a short while. Claim them
+        before lease_expires, otherwise they go back to the other agents"""
+        if radius_km <= 0 or not 0 < limit <= DISPATCH_MAX_LIMIT:
+            return 406,{'message': f'radius_km must be positive and limit between 1 and {DISPATCH_MAX_LIMIT}'}
+        return 200,dispatch_requests(owned_profile_id(request, user_id), latitude, longitude, radius_km, limit)
 
     @http_post('/{user_id}/claim', response=dict)
     def claim_collection_request(self, request, user_id: int, collection_id: int):
         """Agent claims a plastic collection request"""
-        collection = PlasticCollection.objects.get(id=collection_id, status='Request')
-        collection.status = 'Pending'
-        collection.agent = UserProfile.objects.get(user__id=user_id)
-        collection.save()
+        result, = claim_collections(owned_profile_id(request, user_id), [collection_id])
+        if not result['ok']:
+            return ORJSONResponse({'error': result['error']}, status=400)
         return {'message': 'Collection request claimed successfully'}
 
     @http_patch('/{user_id}/collect', response=dict)
@@ -300,6 +404,22 @@ class AgentModelController:
         collection.save()
         return {'message': 'Plastic collected successfully'}
 
+    @http_post('/{user_id}/claim/batch', response=dict)
+    def claim_collection_requests(self, request, user_id: int, payload: CollectionIdsSchema):
+        """Agent claims several plastic collection requests at once"""
+        if not 0 < len(payload.collection_ids) <= BATCH_MAX_IDS:
+            return ORJSONResponse({'error': f'Send between 1 and {BATCH_MAX_IDS} collection ids'}, status=400)
+        results = claim_collections(owned_profile_id(request, user_id), payload.collection_ids)
+        return {'results': results, 'claimed': sum(result['ok'] for result in results)}
+
+    @http_patch('/{user_id}/collect/batch', response=dict)
+    def collect_plastic_batch(self, request, user_id: int, payload: CollectionIdsSchema):
+        """Agent marks several claimed collection requests as collected at once"""
+        if not 0 < len(payload.collection_ids) <= BATCH_MAX_IDS:
+            return ORJSONResponse({'error': f'Send between 1 and {BATCH_MAX_IDS} collection ids'}, status=400)
+        results = collect_collections(owned_profile_id(request, user_id), payload.collection_ids)
+        return {'results': results, 'collected': sum(result['ok'] for result in results)}
+
     @http_get('/{user_id}/history', response=dict)
     def get_agent_requests(self, request, user_id: int):
         """Retrieve pending and completed requests claimed by the agent"""
@@ -315,3 +435,131 @@ class AgentModelController:
         }
 
 api.register_controllers(AgentModelController)
+
+
+LEADERBOARD_MAX_LIMIT = 100
+
+@api_controller('/leaderboard', tags=['Leaderboard'])
+class LeaderboardController:
+
+    @http_get('', response=list)
+    def top(self, metric: str = 'points', state: Optional[str] = None, city: Optional[str] = None, limit: int = 10):
+        """Top recyclers by lifetime points earned or kg recycled, globally or within a state or city"""
+        if metric not in leaderboards.METRICS:
+            return ORJSONResponse({'error': f'Unknown metric: {metric}'}, status=400)
+        limit = min(max(limit, 1), LEADERBOARD_MAX_LIMIT)
+        entries = (LeaderboardEntry.objects.filter(board=leaderboards.board_key(state, city), metric=metric)
+                   .order_by('-score', 'profile_id')
+                   .values('score', 'profile__user__username', 'profile__city', 'profile__state')[:limit])
+        result = []
+        for position, entry in enumerate(entries, start=1):
+            # Standard competition ranking, ties share the better rank
+            rank = result[-1]['rank'] if result and result[-1]['score'] == entry['score'] else position
+            result.append({'rank': rank, 'username': entry['profile__user__username'], 'city': entry['profile__city'],
+                           'state': entry['profile__state'], 'score': entry['score']})
+        return result
+
+    @http_get('/{user_id}/rank', response=dict, auth=ProfileJWTAuth(), permissions=[IsOwner])
+    def my_rank(self, request, user_id: int, metric: str = 'points', scope: str = 'global'):
+        """Rank of a user on the global, state or city leaderboard"""
+        if metric not in leaderboards.METRICS or scope not in ('global', 'state', 'city'):
+            return ORJSONResponse({'error': 'Invalid metric or scope'}, status=400)
+        profile_id = owned_profile_id(request, user_id)
+        city, state = UserProfile.objects.filter(pk=profile_id).values_list('city', 'state').get()
+        board = leaderboards.board_key(state=state if scope != 'global' else None, city=city if scope == 'city' else None)
+        score = (LeaderboardEntry.objects.filter(board=board, metric=metric, profile_id=profile_id)
+                 .values_list('score', flat=True).first())
+        if score is None:
+            return {'board': board, 'rank': None, 'score': 0, 'total': leaderboards.rank_of(board, metric, 0)[1]}
+        rank, total = leaderboards.rank_of(board, metric, score)
+        return {'board': board, 'rank': rank, 'score': score, 'total': total}
+
+api.register_controllers(LeaderboardController)
+
+ANALYTICS_MAX_DAYS = 366
+
+def analytics_range(start, end):
+    end = end or timezone.localdate()
+    start = start or end - timedelta(days=29)
+    if start > end or (end - start).days >= ANALYTICS_MAX_DAYS:
+        raise ValueError(f'start must be before end and the range at most {ANALYTICS_MAX_DAYS} days')
+    return start, end
+
+@api_controller('/analytics', tags=['Analytics'], auth=ProfileJWTAuth(), permissions=[IsAdmin])
+class AnalyticsController:
+
+    @http_get('/daily', response=dict)
+    def daily(self, start: Optional[date] = None, end: Optional[date] = None, city: Optional[str] = None,
+              agent_id: Optional[int] = None):
+        """Collections, kg and points per day, overall or for one city or agent profile. Defaults to the last 30 days"""
+        try:
+            start, end = analytics_range(start, end)
+        except ValueError as e:
+            return ORJSONResponse({'error': str(e)}, status=400)
+        dimension = rollups.dimension_key(city, agent_id)
+        return {'dimension': dimension, 'days': rollups.daily_series(dimension, start, end),
+                'totals': rollups.range_totals(dimension, start, end)}
+
+    @http_get('/top', response=list)
+    def top(self, by: str = 'city', start: Optional[date] = None, end: Optional[date] = None, limit: int = 10):
+        """Cities or agents with the most kg collected in a date range"""
+        if by not in ('city', 'agent'):
+            return ORJSONResponse({'error': 'by must be city or agent'}, status=400)
+        try:
+            start, end = analytics_range(start, end)
+        except ValueError as e:
+            return ORJSONResponse({'error': str(e)}, status=400)
+        return rollups.top_dimensions(by, start, end, min(max(limit, 1), LEADERBOARD_MAX_LIMIT))
+
+api.register_controllers(AnalyticsController)
+
+@api_controller('/exports', tags=['Exports'], auth=ProfileJWTAuth(), permissions=[IsAdmin])
+class ExportController:
+
+    @http_get('/{name}')
+    def export(self, name: str, format: str = 'csv', start: Optional[date] = None, end: Optional[date] = None,
+               status: Optional[str] = None, state: Optional[str] = None):
+        """Stream collections, rewards, notifications or users as CSV or NDJSON. status filters the
+        collection status, notification importance or user role"""
+        if name not in exports.EXPORTS or format not in exports.FORMATS:
+            return ORJSONResponse({'error': 'Unknown export or format'}, status=400)
+        response = StreamingHttpResponse(exports.stream(name, format, start=start, end=end, status=status, state=state),
+                                         content_type=exports.FORMATS[format])
+        response['Content-Disposition'] = f'attachment; filename="{name}.{format}"'
+        return response
+
+api.register_controllers(ExportController)
+
+@api_controller('/imports', tags=['Imports'], auth=ProfileJWTAuth(), permissions=[IsAdmin])
+class ImportController:
+
+    @http_post('/{kind}', response=dict)
+    def start_import(self, kind: str, file: File[UploadedFile], format: str = 'csv'):
+        """Queue a CSV or NDJSON file of users or rewards for import, poll /imports/jobs/{job_id} for the report"""
+        if kind not in imports.KINDS or format not in ('csv', 'ndjson'):
+            return ORJSONResponse({'error': 'Unknown import or format'}, status=400)
+        name = imports.upload_storage().save(f'{kind}.{format}', file)
+        # Not retried: rows committed by a failed run would be rejected as duplicates. Long imports
+        # keep their lease through the worker's heartbeat and are not taken over while running
+        job = jobs.enqueue('main.imports.import_file', name, kind, format, max_attempts=1)
+        return {'job_id': job.id}
+
+    @http_get('/jobs/{job_id}', response=dict)
+    def import_status(self, job_id: int):
+        """Status of an import and, once it is done, how many rows were created and which were rejected"""
+        job = Job.objects.filter(pk=job_id, task='main.imports.import_file').values('status', 'result', 'last_error').first()
+        if job is None:
+            return ORJSONResponse({'error': 'Import does not exist'}, status=404)
+        return job
+
+api.register_controllers(ImportController)
+
+@api.get('/events/stream', tags=['Events'], url_name='event_stream', auth=[ProfileJWTAuth(), ProfileJWTQueryAuth()])
+async def event_stream(request):
+    """Server-sent events stream of new notifications and collection status changes for the authenticated user"""
+    if not request.auth.profile_id:
+        return ORJSONResponse({'error': 'User profile does not exist'}, status=400)
+    response = StreamingHttpResponse(events.sse_stream(request.auth.profile_id), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
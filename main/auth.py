@@ -0,0 +1,137 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.contrib.auth.models import User
+from ninja.security import APIKeyQuery
+from ninja_extra.security import HttpBearer
+from ninja_jwt.authentication import JWTBaseAuthentication
+from ninja_jwt.exceptions import AuthenticationFailed
+from ninja_jwt.settings import api_settings
+
+from main.models import UserProfile
+
+# Database-free authentication for the hot API paths. The authenticator verifies the
+# token signature and reads whether the account is still active, its profile id and its
+# role from a small per-process LRU that is refreshed from the database every
+# REVOCATION_TTL_SECONDS (sooner when a save signal evicts it), so revocations, demotions
+# and promotions take effect without waiting for the token to expire. The profile claims
+# in tokens minted by the login view are informational, they are not trusted here.
+
+REVOCATION_TTL_SECONDS = 30
+REVOCATION_CACHE_SIZE = 10000
+
+
+def add_profile_claims(token, profile, role):
+    token['profile_id'] = profile.id
+    token['role'] = role
+    return token
+
+
+class TokenProfile:
+    """request.auth for ProfileJWTAuth: the caller's ids and role, from the account cache"""
+
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, user_id, profile_id, role):
+        self.id = self.pk = user_id
+        self.profile_id = profile_id
+        self.role = role
+
+    @property
+    def is_superuser(self):
+        return self.role == 'Admin'
+
+    def __repr__(self):
+        return f"TokenProfile(id={self.id}, profile_id={self.profile_id}, role={self.role!r})"
+
+
+class AccountCache:
+    """Bounded LRU of user_id -> (is_active, profile_id, role) with a short TTL"""
+
+    def __init__(self, size=REVOCATION_CACHE_SIZE, ttl=REVOCATION_TTL_SECONDS):
+        self.size = size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry and now - entry[0] < self.ttl:
+                self._entries.move_to_end(user_id)
+                return entry[1]
+        account = self._load(user_id)
+        with self._lock:
+            self._entries[user_id] = (now, account)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return account
+
+    @staticmethod
+    def _load(user_id):
+        user = User.objects.filter(pk=user_id).values('is_active', 'is_superuser', 'userprofile__id', 'userprofile__role').first()
+        if user is None:
+            return None
+        role = 'Admin' if user['is_superuser'] else user['userprofile__role']
+        return user['is_active'], user['userprofile__id'], role
+
+    def forget(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+accounts = AccountCache()
+
+
+class ProfileTokenAuthentication(JWTBaseAuthentication):
+    def authenticate_token(self, request, token):
+        validated_token = self.get_validated_token(token)
+        user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+        account = accounts.get(user_id) if user_id is not None else None
+        if account is None:
+            raise AuthenticationFailed("User not found")
+        is_active, profile_id, role = account
+        if not is_active:
+            raise AuthenticationFailed("User is inactive")
+        # The account, not the claims: a role changed since the token was minted applies right away
+        profile = TokenProfile(user_id, profile_id, role)
+        request.user = profile
+        return profile
+
+
+class ProfileJWTAuth(ProfileTokenAuthentication, HttpBearer):
+    def authenticate(self, request, token):
+        return self.authenticate_token(request, token)
+
+
+class ProfileJWTQueryAuth(ProfileTokenAuthentication, APIKeyQuery):
+    # EventSource cannot send headers, so streams also accept ?token=<access token>
+    param_name = 'token'
+
+    def authenticate(self, request, key):
+        if key:
+            return self.authenticate_token(request, key)
+
+
+def owned_profile_id(request, user_id):
+    """Profile id behind a /{user_id}/ route, without a query when the caller owns it"""
+    auth = getattr(request, 'auth', None)
+    if isinstance(auth, TokenProfile) and auth.id == user_id and auth.profile_id:
+        return auth.profile_id
+    return UserProfile.objects.filter(user__id=user_id).values_list('id', flat=True).get()
+
+
+async def aowned_profile_id(request, user_id):
+    """Async version of owned_profile_id"""
+    auth = getattr(request, 'auth', None)
+    if isinstance(auth, TokenProfile) and auth.id == user_id and auth.profile_id:
+        return auth.profile_id
+    return await UserProfile.objects.filter(user__id=user_id).values_list('id', flat=True).aget()
@@ -0,0 +1,126 @@
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncWeek
+from django.utils import timezone
+
+from main import events, jobs
+
+# Batch badge awarding. Each run reads the collection credits added to the points ledger
+# since the previous run (tracked by a Checkpoint), evaluates the rules below for just
+# the profiles those credits touched, and inserts the new badges and their notifications
+# with bulk_create. Crediting a collection only queues a run (see schedule), credits that
+# arrive while a run is queued are picked up by that same run.
+#
+# The checkpoint is an id high-watermark, but ids are handed out before commit, so a
+# credit can become visible after a higher id was already read. A run therefore stops at
+# the first credit younger than SETTLE_SECONDS and only moves the checkpoint over older
+# ones, whose transactions have long committed; the rest wait for the next run.
+
+CHECKPOINT = 'badges'
+AWARD_DELAY_SECONDS = 60
+SETTLE_SECONDS = 30
+
+# (badge, statistic, threshold), statistics are computed per profile in compute_stats
+RULES = [
+    ('Recycler', 'collections', 1),
+    ('Eco Warrior', 'kg', 50),
+    ('Green Ambassador', 'collections', 25),
+    ('Sustainability Hero', 'weekly_streak', 4),
+]
+
+
+def longest_streak(weeks):
+    """Longest run of consecutive weeks in a set of week start dates"""
+    best = current = 0
+    previous = None
+    for week in sorted(weeks):
+        current = current + 1 if previous is not None and week - previous == timedelta(weeks=1) else 1
+        best = max(best, current)
+        previous = week
+    return best
+
+
+def compute_stats(profile_ids):
+    from main.models import PointsLedger
+    credits = PointsLedger.objects.filter(reason='Collection', user_id__in=profile_ids)
+    stats = {
+        row['user']: {'collections': row['collections'], 'kg': row['kg'], 'weekly_streak': 0}
+        for row in credits.values('user').annotate(collections=Count('id'), kg=Sum('plastic')).order_by()
+    }
+    weeks = {}
+    for profile_id, week in credits.annotate(week=TruncWeek('created_date')).values_list('user', 'week').distinct():
+        weeks.setdefault(profile_id, set()).add(week)
+    for profile_id, profile_weeks in weeks.items():
+        stats[profile_id]['weekly_streak'] = longest_streak(profile_weeks)
+    return stats
+
+
+def earned_badges(stats):
+    return [name for name, statistic, threshold in RULES if stats[statistic] >= threshold]
+
+
+def award_batch(batch_size=1000):
+    """Process up to batch_size new ledger credits, returns (credits processed, badges awarded)"""
+    from main.models import Badge, Checkpoint, Notification, PointsLedger, UserProfile
+    with transaction.atomic():
+        checkpoint, _ = Checkpoint.objects.get_or_create(name=CHECKPOINT)
+        # Serialize concurrent runs on backends that support row locks
+        checkpoint = Checkpoint.objects.select_for_update().get(pk=checkpoint.pk)
+        rows = list(PointsLedger.objects.filter(reason='Collection', id__gt=checkpoint.position)
+                    .order_by('id').values_list('id', 'user_id', 'created_date')[:batch_size])
+        settled_before = timezone.now() - timedelta(seconds=SETTLE_SECONDS)
+        settled = next((index for index, row in enumerate(rows) if row[2] >= settled_before), len(rows))
+        credits = [(credit_id, profile_id) for credit_id, profile_id, _ in rows[:settled]]
+        if not credits:
+            return 0, 0
+        touched = {profile_id for _, profile_id in credits}
+
+        stats = compute_stats(touched)
+        owned = set(Badge.objects.filter(user_id__in=touched).values_list('user_id', 'name'))
+        new_badges = [
+            Badge(user_id=profile_id, name=name)
+            for profile_id, profile_stats in stats.items()
+            for name in earned_badges(profile_stats)
+            if (profile_id, name) not in owned
+        ]
+        Badge.objects.bulk_create(new_badges, ignore_conflicts=True)
+
+        notifications = [
+            Notification(user_id=badge.user_id, to_user_id=badge.user_id, importance_level='Medium',
+                         message=f"Congratulations! You earned the {badge.name} badge.")
+            for badge in new_badges
+        ]
+        Notification.objects.bulk_create(notifications)
+        per_profile = {}
+        for notification in notifications:
+            per_profile[notification.to_user_id] = per_profile.get(notification.to_user_id, 0) + 1
+        for profile_id, count in per_profile.items():
+            UserProfile.objects.filter(pk=profile_id).update(unread_notifications=F('unread_notifications') + count)
+            events.publish(profile_id, 'badge', {'count': count})
+
+        checkpoint.position = credits[-1][0]
+        checkpoint.save(update_fields=['position', 'updated_date'])
+    return len(credits), len(new_badges)
+
+
+def award_pending(batch_size=1000):
+    """Run batches until the ledger is caught up to the settled credits"""
+    from main.models import Checkpoint, PointsLedger
+    processed = awarded = 0
+    while True:
+        batch_processed, batch_awarded = award_batch(batch_size)
+        processed += batch_processed
+        awarded += batch_awarded
+        if batch_processed < batch_size:
+            break
+    # Credits too recent to settle get a run of their own
+    position = Checkpoint.objects.filter(name=CHECKPOINT).values_list('position', flat=True).first() or 0
+    if PointsLedger.objects.filter(reason='Collection', id__gt=position).exists():
+        schedule(delay=SETTLE_SECONDS)
+    return processed, awarded
+
+
+def schedule(delay=AWARD_DELAY_SECONDS):
+    jobs.enqueue('main.badges.award_pending', key='award-badges', priority=-1, delay=delay)
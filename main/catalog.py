@@ -0,0 +1,66 @@
+import threading
+import time
+from bisect import bisect_right
+
+from django.core.cache import cache
+
+# Read-mostly reward data for the client dashboard. The ListReward catalog is kept per
+# process sorted by points_required, so "what can I afford" is a bisect. Catalog edits
+# invalidate it through signals (main/signals.py); the TTL bounds how long other worker
+# processes can serve a stale copy. Claimed reward ids per profile live in Django's cache,
+# which is shared between workers whenever a shared cache backend is configured.
+
+CATALOG_TTL_SECONDS = 300
+CLAIMED_TTL_SECONDS = 60
+
+
+class RewardCatalog:
+    def __init__(self, ttl=CATALOG_TTL_SECONDS):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._rewards = None
+        self._points = []
+        self._loaded_at = 0.0
+
+    def _load(self):
+        from main.models import ListReward
+        rewards = list(ListReward.objects.order_by('points_required', 'id').values('id', 'title', 'points_required'))
+        self._points = [reward['points_required'] for reward in rewards]
+        self._rewards = rewards
+        self._loaded_at = time.monotonic()
+
+    def rewards(self):
+        with self._lock:
+            if self._rewards is None or time.monotonic() - self._loaded_at > self.ttl:
+                self._load()
+            return self._rewards, self._points
+
+    def affordable(self, points):
+        """Catalog entries with points_required <= points, cheapest first"""
+        rewards, thresholds = self.rewards()
+        return rewards[:bisect_right(thresholds, points)]
+
+    def invalidate(self):
+        with self._lock:
+            self._rewards = None
+
+
+catalog = RewardCatalog()
+
+
+def _claimed_key(profile_id):
+    return f'claimed-rewards:{profile_id}'
+
+
+def claimed_reward_ids(profile_id):
+    """Ids of the rewards a profile has already claimed"""
+    claimed = cache.get(_claimed_key(profile_id))
+    if claimed is None:
+        from main.models import Reward
+        claimed = frozenset(Reward.objects.filter(user_id=profile_id).values_list('reward_id', flat=True))
+        cache.set(_claimed_key(profile_id), claimed, CLAIMED_TTL_SECONDS)
+    return claimed
+
+
+def invalidate_claimed(profile_id):
+    cache.delete(_claimed_key(profile_id))
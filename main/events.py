@@ -0,0 +1,204 @@
+import asyncio
+import json
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+# Pub/sub used to push notifications and collection status changes to connected
+# clients over server-sent events. Publishers are ordinary (sync) request handlers,
+# subscribers are long-lived async streams served by the ASGI application.
+
+HEARTBEAT_SECONDS = 15
+QUEUE_SIZE = 100
+
+
+def profile_channel(profile_id):
+    return f'profile-{profile_id}'
+
+
+class Subscription:
+    async def get(self, timeout):
+        """Next event for this subscriber, or None if nothing arrived within timeout seconds"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class BaseEventBackend:
+    def publish(self, channel, event):
+        raise NotImplementedError
+
+    def subscribe(self, channel):
+        raise NotImplementedError
+
+
+class _QueueSubscription(Subscription):
+    def __init__(self, backend, channel):
+        self.backend = backend
+        self.channel = channel
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+    async def get(self, timeout):
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # A stalled client only loses nudges, it can always refetch its inbox
+            pass
+
+    def close(self):
+        self.backend._unsubscribe(self)
+
+
+class LocalEventBackend(BaseEventBackend):
+    """In-process fan-out, only reaches subscribers connected to the same worker process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+
+    def publish(self, channel, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for subscription in subscribers:
+            subscription.loop.call_soon_threadsafe(subscription.put, event)
+
+    def subscribe(self, channel):
+        subscription = _QueueSubscription(self, channel)
+        with self._lock:
+            self._subscribers.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def _unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.channel, set())
+            subscribers.discard(subscription)
+            if not subscribers:
+                self._subscribers.pop(subscription.channel, None)
+
+
+class _SpoolSubscription(Subscription):
+    def __init__(self, path, poll_interval):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.offset = os.path.getsize(path) if os.path.exists(path) else 0
+        self.pending = []
+
+    def _read(self):
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            return
+        if size < self.offset:
+            # The publisher rotated the file
+            self.offset = 0
+        if size == self.offset:
+            return
+        with open(self.path, 'rb') as spool:
+            spool.seek(self.offset)
+            data = spool.read()
+        # Only consume complete lines, a partial write is picked up on the next poll
+        complete = data[:data.rfind(b'\n') + 1]
+        self.offset += len(complete)
+        for line in complete.splitlines():
+            if line:
+                self.pending.append(json.loads(line))
+
+    async def get(self, timeout):
+        deadline = time.monotonic() + timeout
+        while not self.pending:
+            self._read()
+            if self.pending:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            await asyncio.sleep(min(self.poll_interval, remaining))
+        return self.pending.pop(0)
+
+
+class SpoolEventBackend(BaseEventBackend):
+    """Fan-out across worker processes on one host through append-only files in a shared directory.
+
+    A local stand-in for a Redis/Postgres LISTEN broker: publishers (gunicorn workers) append
+    one JSON line per event, subscribers (uvicorn workers) tail the file of their channel.
+    """
+
+    def __init__(self, directory=None, poll_interval=0.5, max_bytes=1024 * 1024):
+        self.directory = directory or settings.EVENTS_SPOOL_DIR
+        self.poll_interval = poll_interval
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, channel):
+        return os.path.join(self.directory, f'{channel}.jsonl')
+
+    def publish(self, channel, event):
+        path = self._path(channel)
+        line = (json.dumps(event, cls=DjangoJSONEncoder) + '\n').encode()
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+        if os.path.exists(path) and os.path.getsize(path) > self.max_bytes:
+            flags |= os.O_TRUNC
+        fd = os.open(path, flags, 0o644)
+        try:
+            # O_APPEND writes of a single small line are not interleaved between processes
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def subscribe(self, channel):
+        return _SpoolSubscription(self._path(channel), self.poll_interval)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = import_string(settings.EVENTS_BACKEND)()
+    return _backend
+
+
+def publish(profile_id, event_type, data):
+    """Publish an event to a profile once the current transaction commits"""
+    event = {'type': event_type, 'data': data}
+    transaction.on_commit(lambda: get_backend().publish(profile_channel(profile_id), event))
+
+
+def publish_many(profile_ids, event_type, data):
+    """Publish one event to many profiles right away, for jobs fanning out committed broadcasts"""
+    backend = get_backend()
+    event = {'type': event_type, 'data': data}
+    for profile_id in profile_ids:
+        backend.publish(profile_channel(profile_id), event)
+
+
+async def sse_stream(profile_id):
+    """Server-sent events body for one profile, with keep-alive comments between events"""
+    subscription = get_backend().subscribe(profile_channel(profile_id))
+    try:
+        yield 'retry: 5000\n\n'
+        while True:
+            event = await subscription.get(HEARTBEAT_SECONDS)
+            if event is None:
+                yield ': keep-alive\n\n'
+                continue
+            yield f"event: {event['type']}\ndata: {json.dumps(event['data'], cls=DjangoJSONEncoder)}\n\n"
+    finally:
+        subscription.close()
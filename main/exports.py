@@ -0,0 +1,103 @@
+import csv
+import json
+from datetime import datetime, time, timedelta
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+# Streaming exports for reporting. Rows are read as plain tuples with values_list() and
+# QuerySet.iterator(chunk_size=...), and are rendered a chunk at a time, so memory stays
+# flat however many rows an export has. Used by /api/exports and `manage.py export_data`.
+
+CHUNK_SIZE = 2000
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+class Export:
+    def __init__(self, model, columns, date_field, state_field, status_field=None):
+        self.model = model
+        # (column name, field lookup)
+        self.columns = columns
+        self.date_field = date_field
+        self.state_field = state_field
+        self.status_field = status_field
+
+    def queryset(self, start=None, end=None, status=None, state=None):
+        from main import models
+        rows = getattr(models, self.model).objects.all()
+        if start:
+            rows = rows.filter(**{f'{self.date_field}__gte': _day_start(start)})
+        if end:
+            rows = rows.filter(**{f'{self.date_field}__lt': _day_start(end, next_day=True)})
+        if status and self.status_field:
+            rows = rows.filter(**{self.status_field: status})
+        if state:
+            rows = rows.filter(**{f'{self.state_field}__iexact': state})
+        return rows.order_by('pk').values_list(*[lookup for _, lookup in self.columns])
+
+
+def _day_start(day, next_day=False):
+    moment = timezone.make_aware(datetime.combine(day, time.min))
+    return moment + timedelta(days=1) if next_day else moment
+
+
+EXPORTS = {
+    'collections': Export('PlasticCollection', [
+        ('id', 'id'), ('client', 'user__user__username'), ('city', 'user__city'), ('state', 'user__state'),
+        ('agent', 'agent__user__username'), ('amount_collected', 'amount_collected'), ('status', 'status'),
+        ('collection_date', 'collection_date'), ('latitude', 'latitude'), ('longitude', 'longitude'),
+    ], date_field='collection_date', state_field='user__state', status_field='status'),
+    'rewards': Export('Reward', [
+        ('id', 'id'), ('client', 'user__user__username'), ('state', 'user__state'), ('reward', 'reward__title'),
+        ('points', 'reward__points_required'), ('claimed_date', 'claimed_date'),
+    ], date_field='claimed_date', state_field='user__state'),
+    'notifications': Export('Notification', [
+        ('id', 'id'), ('sender', 'user__user__username'), ('recipient', 'to_user__user__username'),
+        ('message', 'message'), ('importance_level', 'importance_level'), ('is_read', 'is_read'),
+        ('notification_date', 'notification_date'),
+    ], date_field='notification_date', state_field='to_user__state', status_field='importance_level'),
+    'users': Export('UserProfile', [
+        ('id', 'id'), ('username', 'user__username'), ('first_name', 'user__first_name'),
+        ('last_name', 'user__last_name'), ('email', 'user__email'), ('role', 'role'), ('city', 'city'),
+        ('state', 'state'), ('country', 'country'), ('total_plastic_recycled', 'total_plastic_recycled'),
+        ('earned_points', 'earned_points'), ('date_joined', 'user__date_joined'),
+    ], date_field='user__date_joined', state_field='state', status_field='role'),
+}
+
+
+class _Lines:
+    """File-like object for csv.writer that hands back what was written"""
+
+    def write(self, value):
+        return value
+
+
+def _csv_lines(names, rows):
+    writer = csv.writer(_Lines())
+    yield writer.writerow(names)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def _ndjson_lines(names, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(names, row)), cls=DjangoJSONEncoder) + '\n'
+
+
+def stream(name, fmt, chunk_size=CHUNK_SIZE, **filters):
+    """Export name rendered as fmt, yielded roughly one database chunk at a time"""
+    export = EXPORTS[name]
+    names = [column for column, _ in export.columns]
+    rows = export.queryset(**filters).iterator(chunk_size=chunk_size)
+    lines = _csv_lines(names, rows) if fmt == 'csv' else _ndjson_lines(names, rows)
+    buffer = []
+    for line in lines:
+        buffer.append(line)
+        if len(buffer) >= chunk_size:
+            yield ''.join(buffer)
+            buffer = []
+    if buffer:
+        yield ''.join(buffer)
@@ -0,0 +1,85 @@
+from django.db import transaction
+from django.db.models import Q
+from PIL import Image
+
+# Perceptual fingerprints of collection photos, used to flag the same picture being
+# submitted again to farm points. A 64-bit difference hash survives re-encoding and
+# resizing; near-duplicates are found with multi-index hashing: the hash is split into
+# CHUNKS disjoint bit ranges stored in indexed columns, and by the pigeonhole principle
+# any hash within MAX_DISTANCE bits of another matches it exactly on at least one chunk.
+# A lookup is therefore a handful of equality probes plus an exact hamming check on the
+# few rows they return, instead of a comparison against every past submission.
+
+HASH_BITS = 64
+CHUNK_BITS = (13, 13, 13, 13, 12)
+MAX_DISTANCE = len(CHUNK_BITS) - 1
+
+
+def dhash(image):
+    """64-bit difference hash: brightness gradient signs of a 9x8 grayscale thumbnail"""
+    small = image.convert('L').resize((9, 8), Image.LANCZOS)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def chunks(value):
+    """Split a hash into the CHUNK_BITS bit ranges stored in the index columns"""
+    parts = []
+    shift = HASH_BITS
+    for bits in CHUNK_BITS:
+        shift -= bits
+        parts.append((value >> shift) & ((1 << bits) - 1))
+    return parts
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+def to_signed(value):
+    # BigIntegerField is signed 64-bit
+    return value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+
+
+def to_unsigned(value):
+    return value + (1 << HASH_BITS) if value < 0 else value
+
+
+def find_matches(value, exclude_collection=None, max_distance=MAX_DISTANCE):
+    """(distance, collection_id) of every fingerprint within max_distance bits, closest first"""
+    from main.models import PhotoFingerprint
+    probes = Q()
+    for position, part in enumerate(chunks(value)):
+        probes |= Q(**{f'chunk_{position}': part})
+    candidates = PhotoFingerprint.objects.filter(probes)
+    if exclude_collection is not None:
+        candidates = candidates.exclude(collection_id=exclude_collection)
+    matches = []
+    for collection_id, stored in candidates.values_list('collection_id', 'hash'):
+        distance = hamming(value, to_unsigned(stored))
+        if distance <= max_distance:
+            matches.append((distance, collection_id))
+    matches.sort()
+    return matches
+
+
+def index_collection(collection_id, image):
+    """Store the fingerprint of a collection photo and flag it if it resembles an earlier one"""
+    from main.models import PhotoFingerprint, PlasticCollection
+    value = dhash(image)
+    with transaction.atomic():
+        PhotoFingerprint.objects.update_or_create(
+            collection_id=collection_id,
+            defaults={'hash': to_signed(value), **{f'chunk_{i}': part for i, part in enumerate(chunks(value))}},
+        )
+        # Only earlier submissions count as originals, so the first upload is never the one flagged
+        earlier = [match for match in find_matches(value, exclude_collection=collection_id) if match[1] < collection_id]
+        PlasticCollection.objects.filter(pk=collection_id).update(
+            possible_duplicate_of_id=earlier[0][1] if earlier else None)
+    return earlier
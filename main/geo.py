@@ -0,0 +1,115 @@
+import math
+
+# Geohash helpers used to index PlasticCollection locations.
+# A geohash is a base32 string where every extra character narrows the cell,
+# so "all rows inside a cell" is a plain indexed prefix lookup.
+
+_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+_DECODE = {c: i for i, c in enumerate(_BASE32)}
+
+EARTH_RADIUS_KM = 6371.0088
+GEOHASH_PRECISION = 9
+
+# Approximate cell (width, height) in km at the equator for each precision
+_CELL_SIZE_KM = {
+    1: (5009.4, 4992.6),
+    2: (1252.3, 624.1),
+    3: (156.5, 156.0),
+    4: (39.1, 19.5),
+    5: (4.89, 4.87),
+    6: (1.22, 0.61),
+    7: (0.153, 0.152),
+    8: (0.038, 0.019),
+}
+
+
+def prefix_range(cell):
+    """(lower, upper) bounds of the geohashes starting with cell, upper is None past the last cell.
+    The bounds only use base32 characters, so the range holds under any database collation"""
+    prefix = cell.rstrip(_BASE32[-1])
+    if not prefix:
+        return cell, None
+    return cell, prefix[:-1] + _BASE32[_DECODE[prefix[-1]] + 1]
+
+
+def encode(latitude, longitude, precision=GEOHASH_PRECISION):
+    """Encode a coordinate pair into a geohash of the given length"""
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    chars = []
+    bit, ch, even = 0, 0, True
+    while len(chars) < precision:
+        rng, value = (lng_range, longitude) if even else (lat_range, latitude)
+        mid = (rng[0] + rng[1]) / 2
+        if value >= mid:
+            ch = (ch << 1) | 1
+            rng[0] = mid
+        else:
+            ch = ch << 1
+            rng[1] = mid
+        even = not even
+        bit += 1
+        if bit == 5:
+            chars.append(_BASE32[ch])
+            bit, ch = 0, 0
+    return ''.join(chars)
+
+
+def decode_bbox(geohash):
+    """Return (min_lat, min_lng, max_lat, max_lng) of a geohash cell"""
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    even = True
+    for c in geohash:
+        bits = _DECODE[c]
+        for shift in range(4, -1, -1):
+            rng = lng_range if even else lat_range
+            mid = (rng[0] + rng[1]) / 2
+            if (bits >> shift) & 1:
+                rng[0] = mid
+            else:
+                rng[1] = mid
+            even = not even
+    return lat_range[0], lng_range[0], lat_range[1], lng_range[1]
+
+
+def neighbours(geohash):
+    """Return the cell itself plus its eight surrounding cells"""
+    min_lat, min_lng, max_lat, max_lng = decode_bbox(geohash)
+    lat_step = max_lat - min_lat
+    lng_step = max_lng - min_lng
+    centre_lat = (min_lat + max_lat) / 2
+    centre_lng = (min_lng + max_lng) / 2
+    cells = set()
+    for dlat in (-1, 0, 1):
+        lat = centre_lat + dlat * lat_step
+        if not -90 <= lat <= 90:
+            continue
+        for dlng in (-1, 0, 1):
+            lng = (centre_lng + dlng * lng_step + 180) % 360 - 180
+            cells.add(encode(lat, lng, len(geohash)))
+    return sorted(cells)
+
+
+def precision_for_radius(radius_km, latitude=0.0):
+    """Longest geohash whose 3x3 block still covers a circle of radius_km"""
+    shrink = max(math.cos(math.radians(latitude)), 0.01)
+    best = 1
+    for precision, (width, height) in _CELL_SIZE_KM.items():
+        if min(width * shrink, height) >= radius_km:
+            best = precision
+    return best
+
+
+def covering_cells(latitude, longitude, radius_km):
+    """Geohash prefixes that together contain every point within radius_km"""
+    precision = precision_for_radius(radius_km, latitude)
+    return neighbours(encode(latitude, longitude, precision))
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """Great-circle distance between two points in km"""
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
@@ -0,0 +1,138 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+from django.utils.module_loading import import_string
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# Uploaded pictures are stored once by the request, then cleaned up and resized
+# off the request path: EXIF (GPS, device info) is stripped, the original is capped
+# at ORIGINAL_MAX_SIZE and small WebP derivatives are written for list endpoints.
+
+ORIGINAL_MAX_SIZE = 2048
+ORIGINAL_QUALITY = 85
+DERIVATIVES = {
+    # suffix: (max size in px, WebP quality)
+    'thumb': (320, 70),
+    'webp': (1280, 80),
+}
+
+# Source image field -> fields holding its derivatives, per model
+PIPELINES = {
+    'main.PlasticCollection': {'collection_pic': {'thumb': 'collection_thumb', 'webp': 'collection_webp'}},
+    'main.UserProfile': {'profile_pic': {'thumb': 'profile_thumb', 'webp': 'profile_webp'}},
+}
+
+# Called as hook(pk, image) with the oriented image once a field has been processed
+ON_PROCESSED = {
+    ('main.PlasticCollection', 'collection_pic'): 'main.fingerprints.index_collection',
+    ('main.UserProfile', 'profile_pic'): 'main.versions.profile_image_processed',
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=settings.IMAGE_PIPELINE_WORKERS,
+                                               thread_name_prefix='image-pipeline')
+    return _executor
+
+
+def schedule(instance, field_name):
+    """Process instance.<field_name> in the background once the current transaction commits"""
+    label = instance._meta.label
+    pk = instance.pk
+
+    def submit():
+        if settings.IMAGE_PIPELINE_WORKERS:
+            _get_executor().submit(_run, label, pk, field_name)
+            return
+        # Inline: the upload is already committed, a failure here must not turn the response into a 500
+        try:
+            process(label, pk, field_name)
+        except Exception:
+            logger.exception("Image processing failed for %s %s.%s", label, pk, field_name)
+    transaction.on_commit(submit)
+
+
+def _run(label, pk, field_name):
+    # Worker threads own their DB connections, release them after every job
+    close_old_connections()
+    try:
+        process(label, pk, field_name)
+    except Exception:
+        logger.exception("Image processing failed for %s %s.%s", label, pk, field_name)
+    finally:
+        close_old_connections()
+
+
+def _encode(image, fmt, quality):
+    buffer = BytesIO()
+    if fmt == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    # No exif= argument, so metadata is not carried over
+    image.save(buffer, fmt, quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+def process(label, pk, field_name):
+    """Strip metadata from and downscale the stored picture, then write its derivatives"""
+    model = apps.get_model(label)
+    instance = model.objects.filter(pk=pk).first()
+    if instance is None:
+        return
+    picture = getattr(instance, field_name)
+    default = model._meta.get_field(field_name).default
+    if not picture or picture.name == default:
+        return
+
+    with picture.open('rb') as stored:
+        image = Image.open(stored)
+        image.load()
+    # Bake the EXIF orientation into the pixels before the metadata is dropped
+    image = ImageOps.exif_transpose(image)
+    base, _ = os.path.splitext(os.path.basename(picture.name))
+    updates = {}
+
+    old_name = picture.name
+    if max(image.size) > ORIGINAL_MAX_SIZE or image.getexif() or image.info.get('exif'):
+        image.thumbnail((ORIGINAL_MAX_SIZE, ORIGINAL_MAX_SIZE), Image.LANCZOS)
+        picture.save(f'{base}.jpg', ContentFile(_encode(image, 'JPEG', ORIGINAL_QUALITY)), save=False)
+        updates[field_name] = picture.name
+
+    superseded = []
+    for suffix, target in PIPELINES[label][field_name].items():
+        size, quality = DERIVATIVES[suffix]
+        derivative = image.copy()
+        derivative.thumbnail((size, size), Image.LANCZOS)
+        field = getattr(instance, target)
+        previous = field.name
+        field.save(f'{base}.{suffix}.webp', ContentFile(_encode(derivative, 'WEBP', quality)), save=False)
+        updates[target] = field.name
+        if previous and previous != field.name:
+            superseded.append((field.storage, previous))
+
+    # Plain UPDATE, so model save() side effects (points, events) are not re-triggered
+    model.objects.filter(pk=pk).update(**updates)
+    if field_name in updates and old_name != picture.name:
+        superseded.append((picture.storage, old_name))
+    # Derivatives of an earlier picture, and the original the cleaned copy replaced
+    for storage, name in superseded:
+        storage.delete(name)
+
+    hook = ON_PROCESSED.get((label, field_name))
+    if hook:
+        import_string(hook)(pk, image)
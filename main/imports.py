@@ -0,0 +1,232 @@
+import csv
+import io
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+import django
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.db import IntegrityError, transaction
+
+from main import catalog, versions
+
+# Bulk onboarding of accounts and reward catalog entries. Files are parsed as a stream,
+# validated and inserted a chunk at a time with bulk_create, each chunk in its own
+# transaction. Password hashing, by far the slowest part, is spread over a process pool.
+# Bad rows are reported with their line number instead of failing the import.
+# Uploaded files hold plaintext passwords: they wait for their job in IMPORTS_DIR, which
+# is not served, and are deleted as soon as the job has read them.
+
+CHUNK_SIZE = 1000
+MAX_REPORTED_REJECTS = 1000
+KINDS = ('users', 'rewards')
+
+
+class ImportReport:
+    def __init__(self, max_rejects=MAX_REPORTED_REJECTS):
+        self.max_rejects = max_rejects
+        self.created = 0
+        self.rejected = 0
+        self.rejects = []
+
+    def reject(self, line, error):
+        self.rejected += 1
+        if self.max_rejects is None or len(self.rejects) < self.max_rejects:
+            self.rejects.append({'line': line, 'error': error})
+
+    def as_dict(self):
+        return {'created': self.created, 'rejected': self.rejected, 'rejects': self.rejects}
+
+
+def read_rows(stream, fmt):
+    """(line number, row dict or None, parse error) for every record of a text stream"""
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row, None
+        return
+    for number, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield number, None, 'invalid JSON'
+            continue
+        yield number, row, None if isinstance(row, dict) else 'expected a JSON object'
+
+
+def _text(row, key):
+    value = row.get(key)
+    return str(value).strip() if value not in (None, '') else None
+
+
+def _validate_user(row):
+    from main.models import UserProfile
+    if not _text(row, 'username'):
+        return 'username is required'
+    if not _text(row, 'password'):
+        return 'password is required'
+    role = _text(row, 'role') or 'Client'
+    if role not in ('Client', 'Agent'):
+        return f'unknown role {role}'
+    state, city = _text(row, 'state'), _text(row, 'city')
+    if state and state not in UserProfile.CITY_CHOICES:
+        return f'unknown state {state}'
+    cities = UserProfile.CITY_CHOICES[state] if state else [name for names in UserProfile.CITY_CHOICES.values() for name in names]
+    if city and city not in cities:
+        return f'unknown city {city}'
+    phone_number = _text(row, 'phone_number')
+    if phone_number and len(phone_number) > 10:
+        return 'phone_number is longer than 10 characters'
+    return None
+
+
+def _profile_fields(row):
+    return {
+        'role': _text(row, 'role') or 'Client',
+        'address': _text(row, 'address'),
+        'phone_number': _text(row, 'phone_number'),
+        'city': _text(row, 'city'),
+        'state': _text(row, 'state'),
+        'country': _text(row, 'country') or 'India',
+    }
+
+
+def _insert_users(rows, hashes):
+    from main.models import UserProfile
+    users = [
+        User(username=_text(row, 'username'), password=password, first_name=_text(row, 'first_name') or '',
+             last_name=_text(row, 'last_name') or '', email=_text(row, 'email') or '')
+        for (_, row), password in zip(rows, hashes)
+    ]
+    with transaction.atomic():
+        User.objects.bulk_create(users)
+        UserProfile.objects.bulk_create([UserProfile(user=user, **_profile_fields(row)) for user, (_, row) in zip(users, rows)])
+
+
+def import_users(chunk, report, hash_passwords):
+    valid = []
+    seen = set()
+    for line, row in chunk:
+        error = _validate_user(row)
+        if not error and _text(row, 'username') in seen:
+            error = 'duplicate username in file'
+        if error:
+            report.reject(line, error)
+            continue
+        seen.add(_text(row, 'username'))
+        valid.append((line, row))
+    existing = set(User.objects.filter(username__in=seen).values_list('username', flat=True))
+    rows = []
+    for line, row in valid:
+        if _text(row, 'username') in existing:
+            report.reject(line, 'username already exists')
+        else:
+            rows.append((line, row))
+    if not rows:
+        return
+    hashes = hash_passwords([_text(row, 'password') for _, row in rows])
+    try:
+        _insert_users(rows, hashes)
+        report.created += len(rows)
+    except IntegrityError:
+        # Someone registered one of these usernames meanwhile, retry row by row to find it
+        for row, password in zip(rows, hashes):
+            try:
+                _insert_users([row], [password])
+                report.created += 1
+            except IntegrityError:
+                report.reject(row[0], 'username already exists')
+
+
+def import_rewards(chunk, report, hash_passwords=None):
+    from main.models import ListReward
+    reward_types = [choice for choice, _ in ListReward._meta.get_field('reward_type').choices]
+    existing = set(ListReward.objects.filter(title__in=[_text(row, 'title') for _, row in chunk])
+                   .values_list('title', flat=True))
+    rewards = []
+    for line, row in chunk:
+        title = _text(row, 'title')
+        try:
+            points = Decimal(str(row.get('points_required')))
+        except (InvalidOperation, ValueError):
+            points = None
+        if not title:
+            report.reject(line, 'title is required')
+        elif title in existing:
+            report.reject(line, 'reward already exists')
+        elif points is None or not points.is_finite() or points < 0:
+            report.reject(line, 'points_required must be a non-negative number')
+        elif _text(row, 'reward_type') not in reward_types:
+            report.reject(line, f"reward_type must be one of {', '.join(reward_types)}")
+        else:
+            existing.add(title)
+            rewards.append(ListReward(title=title, points_required=points, reward_type=_text(row, 'reward_type')))
+    with transaction.atomic():
+        ListReward.objects.bulk_create(rewards)
+        versions.bump(versions.CATALOG_KEY)
+        # bulk_create sends no signals, drop the cached catalog here
+        transaction.on_commit(catalog.catalog.invalidate)
+    report.created += len(rewards)
+
+
+IMPORTERS = {
+    'users': import_users,
+    'rewards': import_rewards,
+}
+
+
+def run_import(kind, stream, fmt, workers=None, chunk_size=CHUNK_SIZE, max_rejects=MAX_REPORTED_REJECTS):
+    """Import every row of a text stream, returns the report as a dict.
+    workers=0 hashes passwords in this process, None uses one process per CPU"""
+    report = ImportReport(max_rejects)
+    executor = None
+    workers = os.cpu_count() if workers is None else workers
+    if kind == 'users' and workers:
+        # Spawned, not forked, so the children never share this process' database connections
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=django.setup,
+                                       mp_context=multiprocessing.get_context('spawn'))
+
+    def hash_passwords(passwords):
+        if executor is None:
+            return [make_password(password) for password in passwords]
+        return list(executor.map(make_password, passwords, chunksize=max(len(passwords) // (workers * 4), 1)))
+
+    try:
+        rows = read_rows(stream, fmt)
+        while records := list(islice(rows, chunk_size)):
+            chunk = []
+            for line, row, error in records:
+                if error:
+                    report.reject(line, error)
+                else:
+                    chunk.append((line, row))
+            if chunk:
+                IMPORTERS[kind](chunk, report, hash_passwords)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return report.as_dict()
+
+
+def upload_storage():
+    """Plain file storage for uploads waiting to be imported, outside MEDIA_ROOT and without
+    the blob reference counting of the default storage"""
+    return FileSystemStorage(location=settings.IMPORTS_DIR)
+
+
+def import_file(name, kind, fmt, workers=None):
+    """Job entry point: import an uploaded file from upload_storage, then remove it"""
+    storage = upload_storage()
+    try:
+        with storage.open(name, 'rb') as stored:
+            return run_import(kind, io.TextIOWrapper(stored, encoding='utf-8-sig', newline=''), fmt, workers)
+    finally:
+        storage.delete(name)
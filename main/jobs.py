@@ -0,0 +1,184 @@
+import logging
+import multiprocessing
+import random
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from datetime import timedelta
+
+import django
+from django.db import IntegrityError, close_old_connections, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+# Durable background jobs kept in the database, so no broker is needed. Handlers call
+# enqueue() inside their own transaction and return; `manage.py run_jobs` claims due jobs
+# by priority, runs them on a thread or process pool and retries failures with exponential
+# backoff. A claimed job holds a lease that its worker renews every LEASE_SECONDS / 3 for
+# as long as the task runs, if the worker dies it is picked up again once the lease expires.
+
+LEASE_SECONDS = 300
+BACKOFF_BASE_SECONDS = 10
+BACKOFF_MAX_SECONDS = 3600
+KEEP_FINISHED_DAYS = 7
+
+
+def enqueue(task, *args, priority=0, delay=0, max_attempts=5, key=None, **kwargs):
+    """Queue the function at dotted path task, returns the Job, or None if a job with key is already queued"""
+    from main.models import Job
+    try:
+        with transaction.atomic():
+            return Job.objects.create(task=task, args=list(args), kwargs=kwargs, priority=priority,
+                                      max_attempts=max_attempts, key=key,
+                                      run_after=timezone.now() + timedelta(seconds=delay))
+    except IntegrityError:
+        return None
+
+
+def backoff(attempts):
+    delay = min(BACKOFF_BASE_SECONDS * 2 ** (attempts - 1), BACKOFF_MAX_SECONDS)
+    return delay * random.uniform(0.5, 1.0)
+
+
+def claim(limit, lease=LEASE_SECONDS):
+    """Lease up to limit due jobs, highest priority first, returns their ids"""
+    from main.models import Job
+    now = timezone.now()
+    claimable = Q(status='Queued', run_after__lte=now) | Q(status='Running', locked_until__lt=now)
+    candidates = Job.objects.filter(claimable).order_by('-priority', 'run_after', 'id').values_list('id', 'attempts')
+    claimed = []
+    for job_id, attempts in candidates[:limit * 2]:
+        # Conditional UPDATE, only one worker wins a given job
+        if Job.objects.filter(claimable, pk=job_id, attempts=attempts).update(
+                status='Running', attempts=attempts + 1, locked_until=now + timedelta(seconds=lease)):
+            claimed.append(job_id)
+            if len(claimed) == limit:
+                break
+    return claimed
+
+
+def touch(job_id, attempts):
+    """Renew the lease of a running job, False once it is no longer this run's"""
+    from main.models import Job
+    return bool(Job.objects.filter(pk=job_id, status='Running', attempts=attempts).update(
+        locked_until=timezone.now() + timedelta(seconds=LEASE_SECONDS)))
+
+
+class Heartbeat(threading.Thread):
+    """Keeps renewing a job's lease while its task runs"""
+
+    def __init__(self, job_id, attempts):
+        super().__init__(name=f'job-{job_id}-lease', daemon=True)
+        self.job_id = job_id
+        self.attempts = attempts
+        self.stopping = threading.Event()
+
+    def run(self):
+        try:
+            while not self.stopping.wait(LEASE_SECONDS / 3):
+                if not touch(self.job_id, self.attempts):
+                    return
+        except Exception:
+            logger.exception("Could not renew the lease of job %s", self.job_id)
+        finally:
+            connection.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopping.set()
+        self.join()
+
+
+def execute(job_id):
+    """Run one claimed job and record its outcome"""
+    from main.models import Job
+    close_old_connections()
+    try:
+        job = Job.objects.filter(pk=job_id, status='Running').first()
+        if job is None:
+            return
+        # Updates are conditional on attempts, a worker whose lease expired cannot overwrite a newer run
+        current = Job.objects.filter(pk=job.pk, status='Running', attempts=job.attempts)
+        if job.attempts > job.max_attempts:
+            current.update(status='Failed', locked_until=None, finished_date=timezone.now(),
+                           last_error="Lease expired on the final attempt")
+            return
+        try:
+            with Heartbeat(job.pk, job.attempts):
+                result = import_string(job.task)(*job.args, **job.kwargs)
+        except Exception as error:
+            logger.exception("Job %s (%s) failed on attempt %s", job.pk, job.task, job.attempts)
+            if job.attempts >= job.max_attempts:
+                current.update(status='Failed', locked_until=None, finished_date=timezone.now(), last_error=repr(error))
+            else:
+                try:
+                    with transaction.atomic():
+                        current.update(status='Queued', locked_until=None, last_error=repr(error),
+                                       run_after=timezone.now() + timedelta(seconds=backoff(job.attempts)))
+                except IntegrityError:
+                    # A job with the same key was queued while this one ran, it does the work again
+                    current.update(status='Failed', locked_until=None, finished_date=timezone.now(),
+                                   last_error=f"{error!r}, superseded by the queued job with key {job.key}")
+        else:
+            if not current.update(status='Done', locked_until=None, finished_date=timezone.now(), result=result):
+                logger.warning("Job %s (%s) finished after its lease was taken over, result dropped", job.pk, job.task)
+    finally:
+        close_old_connections()
+
+
+def run_pending(limit=100):
+    """Claim and run due jobs in this thread until none are left, returns how many ran"""
+    ran = 0
+    while True:
+        job_ids = claim(limit)
+        for job_id in job_ids:
+            execute(job_id)
+        ran += len(job_ids)
+        if len(job_ids) < limit:
+            return ran
+
+
+def prune(days=KEEP_FINISHED_DAYS):
+    from main.models import Job
+    cutoff = timezone.now() - timedelta(days=days)
+    return Job.objects.filter(status__in=['Done', 'Failed'], finished_date__lt=cutoff).delete()[0]
+
+
+class Worker:
+    """Keeps up to concurrency jobs running on a thread or process pool"""
+
+    def __init__(self, concurrency=4, pool='thread', poll_interval=1.0):
+        self.concurrency = concurrency
+        self.pool = pool
+        self.poll_interval = poll_interval
+        self.stopping = threading.Event()
+
+    def _executor(self):
+        if self.pool == 'process':
+            # Spawned, not forked, so children never share the parent's database connections
+            return ProcessPoolExecutor(max_workers=self.concurrency, initializer=django.setup,
+                                       mp_context=multiprocessing.get_context('spawn'))
+        return ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='jobs')
+
+    def run(self):
+        in_flight = set()
+        with self._executor() as executor:
+            while not self.stopping.is_set():
+                in_flight = {future for future in in_flight if not future.done()}
+                free = self.concurrency - len(in_flight)
+                job_ids = claim(free) if free else []
+                in_flight.update(executor.submit(execute, job_id) for job_id in job_ids)
+                if job_ids and len(in_flight) < self.concurrency:
+                    continue
+                if in_flight:
+                    wait(in_flight, timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+                else:
+                    self.stopping.wait(self.poll_interval)
+
+    def stop(self, *args):
+        self.stopping.set()
@@ -0,0 +1,139 @@
+import threading
+import time
+from bisect import bisect_right, insort
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+# Leaderboards of lifetime points earned and kg recycled, globally and per state/city.
+# LeaderboardEntry rows are bumped incrementally whenever a collection is credited, and
+# the (board, metric, -score) index serves top-N directly. Ranks are answered from a
+# per-process sorted array of scores per board (bisect, O(log n)), adjusted in place by
+# this process' own writes and reloaded from the index every RANK_TTL_SECONDS.
+# A profile is ranked on the boards of its current location with its lifetime score, so
+# when its city or state changes relocate() moves its entries (saves through the ORM do it
+# from a signal, bulk UPDATEs of profiles need `manage.py rebuild_leaderboards`).
+
+METRICS = ('points', 'plastic')
+RANK_TTL_SECONDS = 60
+
+
+def boards_for(city, state):
+    boards = ['global']
+    if state:
+        boards.append(f'state:{state}')
+    if city:
+        boards.append(f'city:{city}')
+    return boards
+
+
+def board_key(state=None, city=None):
+    if city:
+        return f'city:{city}'
+    if state:
+        return f'state:{state}'
+    return 'global'
+
+
+class RankIndex:
+    """Ascending scores of one board, rank = 1 + number of strictly higher scores"""
+
+    def __init__(self, board, metric):
+        self.board = board
+        self.metric = metric
+        self.scores = []
+        self.loaded_at = None
+
+    def load(self):
+        from main.models import LeaderboardEntry
+        self.scores = list(LeaderboardEntry.objects.filter(board=self.board, metric=self.metric)
+                           .order_by('score').values_list('score', flat=True))
+        self.loaded_at = time.monotonic()
+
+    def stale(self):
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > RANK_TTL_SECONDS
+
+    def rank(self, score):
+        return len(self.scores) - bisect_right(self.scores, score) + 1
+
+    def move(self, old_score, new_score):
+        if old_score is not None:
+            position = bisect_right(self.scores, old_score) - 1
+            if position >= 0 and self.scores[position] == old_score:
+                del self.scores[position]
+        insort(self.scores, new_score)
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def rank_of(board, metric, score):
+    """(rank, board size) of a score"""
+    with _indexes_lock:
+        index = _indexes.setdefault((board, metric), RankIndex(board, metric))
+        if index.stale():
+            index.load()
+        return index.rank(score), len(index.scores)
+
+
+def _apply_locally(moves):
+    with _indexes_lock:
+        for (board, metric), old_score, new_score in moves:
+            index = _indexes.get((board, metric))
+            if index is not None and not index.stale():
+                index.move(old_score, new_score)
+
+
+def reset_rank_indexes(boards=None):
+    with _indexes_lock:
+        if boards is None:
+            _indexes.clear()
+            return
+        for board in boards:
+            for metric in METRICS:
+                _indexes.pop((board, metric), None)
+
+
+def relocate(profile_id, old_city, old_state, city, state):
+    """Move a profile's entries from the boards of its old location to those of the new one"""
+    from main.models import LeaderboardEntry
+    old_boards = set(boards_for(old_city, old_state))
+    new_boards = set(boards_for(city, state))
+    if old_boards == new_boards:
+        return
+    with transaction.atomic():
+        LeaderboardEntry.objects.filter(profile_id=profile_id, board__in=old_boards - new_boards).delete()
+        # The global board holds the lifetime score
+        lifetime = dict(LeaderboardEntry.objects.filter(profile_id=profile_id, board='global').values_list('metric', 'score'))
+        for board in new_boards - old_boards:
+            for metric, score in lifetime.items():
+                LeaderboardEntry.objects.update_or_create(profile_id=profile_id, metric=metric, board=board,
+                                                          defaults={'score': score})
+        # Ranks on the affected boards are reloaded on next use
+        transaction.on_commit(lambda: reset_rank_indexes(old_boards ^ new_boards))
+
+
+def record_collection(profile_id, city, state, points, plastic):
+    """Add a credited collection to every board the profile belongs to"""
+    from main.models import LeaderboardEntry
+    boards = boards_for(city, state)
+    moves = []
+    with transaction.atomic():
+        for metric, amount in (('points', points), ('plastic', plastic)):
+            entries = LeaderboardEntry.objects.filter(profile_id=profile_id, metric=metric, board__in=boards)
+            previous = dict(entries.values_list('board', 'score'))
+            entries.update(score=F('score') + amount)
+            for board in boards:
+                if board in previous:
+                    moves.append(((board, metric), previous[board], previous[board] + amount))
+                    continue
+                try:
+                    with transaction.atomic():
+                        LeaderboardEntry.objects.create(profile_id=profile_id, metric=metric, board=board, score=amount)
+                    moves.append(((board, metric), None, Decimal(amount)))
+                except IntegrityError:
+                    # Created concurrently, fall back to incrementing it
+                    LeaderboardEntry.objects.filter(profile_id=profile_id, metric=metric, board=board).update(score=F('score') + amount)
+        transaction.on_commit(lambda: _apply_locally(moves))
@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from main.badges import award_pending
+
+
+class Command(BaseCommand):
+    help = "Award badges to the profiles with collection credits added since the previous run"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--loop', action='store_true', help="Keep running, polling for new credits")
+        parser.add_argument('--interval', type=float, default=60, help="Seconds between runs with --loop")
+
+    def handle(self, *args, **options):
+        while True:
+            processed, awarded = award_pending(options['batch_size'])
+            self.stdout.write(self.style.SUCCESS(f"Processed {processed} credits, awarded {awarded} badges"))
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,74 @@
+import time
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from ninja.renderers import JSONRenderer
+
+from main.middleware import brotli, compress
+from main.renderers import ORJSONRenderer
+
+
+def request_list(items):
+    """Payload shaped like GET /agent/{id}/requests: ListCollection rows with nested ClientData"""
+    now = timezone.now()
+    return [{
+        'id': number,
+        'user': {
+            'profile_pic': f'profile_pics/{number % 97}.jpg', 'profile_thumb': f'profile_pics/thumbs/{number % 97}.jpg',
+            'address': f'{number} MG Road, Shivajinagar', 'phone_number': f'98{number:08d}',
+            'state': 'Maharashtra', 'city': 'Pune', 'country': 'India',
+        },
+        'collection_pic': f'plastic_collection/{number}.jpg', 'collection_thumb': f'plastic_collection/thumbs/{number}.jpg',
+        'collection_webp': f'plastic_collection/webp/{number}.webp',
+        'amount_collected': Decimal(number % 40) + Decimal('0.25'),
+        'collection_date': now - timedelta(minutes=number), 'latitude': 18.52 + number / 10000,
+        'longitude': 73.85 + number / 10000, 'lease_expires': None, 'distance_km': number / 7,
+        'possible_duplicate_of': None,
+    } for number in range(items)]
+
+
+def inbox(items):
+    """Payload shaped like GET /notifications/{id}/inbox"""
+    now = timezone.now()
+    return {'notifications': [{
+        'id': number, 'message': f'Your collection request #{number} was collected, {number % 40} points earned',
+        'importance_level': 'Low', 'notification_date': now - timedelta(minutes=number), 'is_read': number % 3 == 0,
+    } for number in range(items)], 'next_cursor': 'MjAyNi0xMC0xOFQxMDowMDowMCswMDowMHwxMjM0'}
+
+
+PAYLOADS = {
+    'requests': request_list,
+    'inbox': inbox,
+}
+
+
+class Command(BaseCommand):
+    help = "Compare the stdlib and orjson API renderers, and response compression, on realistic list payloads"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=50, help="Rows per payload")
+        parser.add_argument('--repeat', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        renderers = {'json': JSONRenderer(), 'orjson': ORJSONRenderer()}
+        for name, build in PAYLOADS.items():
+            data = build(options['items'])
+            for renderer_name, renderer in renderers.items():
+                started = time.perf_counter()
+                for _ in range(options['repeat']):
+                    rendered = renderer.render(None, data, response_status=200)
+                elapsed = time.perf_counter() - started
+                body = rendered.encode() if isinstance(rendered, str) else rendered
+                self.stdout.write(f"{name:<9} {renderer_name:<7} {elapsed / options['repeat'] * 1e6:>9.1f} us/response  "
+                                  f"{len(body):>7} bytes")
+            # Compression of the orjson body, as the middleware would send it
+            rounds = max(options['repeat'] // 10, 1)
+            for encoding in ('gzip', 'br') if brotli else ('gzip',):
+                started = time.perf_counter()
+                for _ in range(rounds):
+                    compressed = compress(body, encoding)
+                elapsed = time.perf_counter() - started
+                self.stdout.write(f"{name:<9} {encoding:<7} {elapsed / rounds * 1e6:>9.1f} us/response  "
+                                  f"{len(compressed):>7} bytes")
@@ -0,0 +1,106 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connections
+
+# Each mode is a set of sqlite OPTIONS: SQLite's defaults (rollback journal, deferred
+# transactions) against the production mode from settings.
+MODES = {
+    'default': {},
+    'production': settings.SQLITE_PRODUCTION_OPTIONS,
+}
+
+
+def _use_database(path, options):
+    """Point this process' default connection at the benchmark database"""
+    connection = connections['default']
+    connection.close()
+    connection.settings_dict.update(NAME=path, OPTIONS=options)
+
+
+def _init_worker(path, options):
+    django.setup()
+    _use_database(path, options)
+
+
+def _connect(_):
+    connections['default'].ensure_connection()
+
+
+def _write(args):
+    """Run requests through the client request, agent claim and collect steps, each its own
+    transaction, returns (committed transactions, transactions failed with a locked database)"""
+    from main.models import PlasticCollection
+    from main.services import claim_collections, collect_collections
+    client_id, agent_id, requests = args
+    steps = [
+        lambda collection: collection.save(),
+        lambda collection: claim_collections(agent_id, [collection.pk]),
+        lambda collection: collect_collections(agent_id, [collection.pk]),
+    ]
+    committed = locked = 0
+    for _ in range(requests):
+        collection = PlasticCollection(user_id=client_id, amount_collected=1)
+        for step in steps:
+            try:
+                step(collection)
+                committed += 1
+            except OperationalError as error:
+                if 'locked' not in str(error):
+                    raise
+                locked += 1
+                break
+    return committed, locked
+
+
+class Command(BaseCommand):
+    help = "Compare SQLite write throughput of concurrent worker processes with and without the production mode"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help="Writer processes, like gunicorn workers")
+        parser.add_argument('--requests', type=int, default=100, help="Collection requests each worker runs through")
+        parser.add_argument('--mode', choices=list(MODES), action='append', dest='modes')
+
+    def handle(self, *args, **options):
+        workers, requests = options['workers'], options['requests']
+        with tempfile.TemporaryDirectory() as directory:
+            template = os.path.join(directory, 'template.sqlite3')
+            clients, agent = self.prepare(template, workers)
+            for mode in options['modes'] or list(MODES):
+                path = os.path.join(directory, f'{mode}.sqlite3')
+                shutil.copyfile(template, path)
+                with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(path, MODES[mode]),
+                                         mp_context=multiprocessing.get_context('spawn')) as executor:
+                    # Start every process and open its connection before the clock starts
+                    list(executor.map(_connect, range(workers)))
+                    started = time.perf_counter()
+                    results = list(executor.map(_write, [(client, agent, requests) for client in clients]))
+                    elapsed = time.perf_counter() - started
+                committed = sum(done for done, _ in results)
+                locked = sum(failed for _, failed in results)
+                self.stdout.write(f"{mode:<11} {workers} workers  {committed:>6} committed  {locked:>6} locked  "
+                                  f"{committed / elapsed:>8.1f} transactions/s")
+
+    def prepare(self, path, workers):
+        """Migrate a fresh database with one client per worker and an agent, returns their profile ids"""
+        from django.contrib.auth.models import User
+        from main.models import UserProfile
+        _use_database(path, {})
+        call_command('migrate', verbosity=0)
+        agent = UserProfile.objects.create(user=User.objects.create(username='benchmark-agent'), role='Agent',
+                                           city='Pune', state='Maharashtra')
+        clients = [
+            UserProfile.objects.create(user=User.objects.create(username=f'benchmark-client-{number}'),
+                                       city='Pune', state='Maharashtra').pk
+            for number in range(workers)
+        ]
+        connections['default'].close()
+        return clients, agent.pk
@@ -0,0 +1,31 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from main import exports
+
+
+class Command(BaseCommand):
+    help = "Stream collections, rewards, notifications or users to a CSV or NDJSON file"
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', choices=sorted(exports.EXPORTS))
+        parser.add_argument('--format', choices=sorted(exports.FORMATS), default='csv')
+        parser.add_argument('--output', default='-', help="File to write, - for stdout")
+        parser.add_argument('--start', type=date.fromisoformat)
+        parser.add_argument('--end', type=date.fromisoformat)
+        parser.add_argument('--status', help="Collection status, notification importance or user role")
+        parser.add_argument('--state')
+        parser.add_argument('--chunk-size', type=int, default=exports.CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        chunks = exports.stream(options['name'], options['format'], chunk_size=options['chunk_size'],
+                                start=options['start'], end=options['end'], status=options['status'], state=options['state'])
+        if options['output'] == '-':
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
+            return
+        with open(options['output'], 'w', newline='', encoding='utf-8') as output:
+            for chunk in chunks:
+                output.write(chunk)
+        self.stderr.write(self.style.SUCCESS(f"Exported {options['name']} to {options['output']}"))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from PIL import Image, ImageOps
+
+from main.fingerprints import index_collection
+from main.models import PlasticCollection
+
+
+class Command(BaseCommand):
+    help = "Fingerprint collection photos submitted before the duplicate index existed"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        default = PlasticCollection._meta.get_field('collection_pic').default
+        # Oldest first, so the earliest submission of a photo is the one others point at
+        pending = (PlasticCollection.objects.filter(fingerprint__isnull=True).exclude(collection_pic=default)
+                   .order_by('id').only('id', 'collection_pic'))
+        indexed = flagged = missing = 0
+        for collection in pending.iterator(chunk_size=options['batch_size']):
+            try:
+                with collection.collection_pic.open('rb') as stored:
+                    image = ImageOps.exif_transpose(Image.open(stored))
+                    image.load()
+            except (OSError, ValueError):
+                missing += 1
+                continue
+            if index_collection(collection.id, image):
+                flagged += 1
+            indexed += 1
+        self.stdout.write(self.style.SUCCESS(
+            f"Fingerprinted {indexed} collection(s), {flagged} flagged as possible duplicates, {missing} unreadable"))
@@ -0,0 +1,79 @@
+import os
+import time
+from collections import Counter
+from datetime import timedelta
+
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db.models import FileField
+from django.utils import timezone
+
+from main.models import MediaBlob
+from main.storage import BLOB_DIR, ContentAddressedStorage
+
+
+class Command(BaseCommand):
+    help = "Recount media blob references and delete blobs no ImageField points at"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace-hours', type=float, default=24,
+                            help="Keep unreferenced blobs younger than this, their row may not be committed yet")
+        parser.add_argument('--dry-run', action='store_true')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def referenced_names(self, batch_size):
+        references = Counter()
+        storage = None
+        for model in apps.get_models():
+            for field in model._meta.concrete_fields:
+                if isinstance(field, FileField) and isinstance(field.storage, ContentAddressedStorage):
+                    storage = field.storage
+                    names = model._default_manager.filter(**{f'{field.attname}__startswith': BLOB_DIR + '/'})
+                    references.update(names.values_list(field.attname, flat=True).iterator(chunk_size=batch_size))
+        return references, storage
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        cutoff = timezone.now() - timedelta(hours=options['grace_hours'])
+        references, storage = self.referenced_names(options['batch_size'])
+        if storage is None:
+            self.stdout.write("No content-addressed file fields, nothing to do")
+            return
+
+        recounted, orphans, known = [], [], set()
+        for blob in MediaBlob.objects.only('id', 'name', 'ref_count', 'created_date').iterator(chunk_size=options['batch_size']):
+            known.add(blob.name)
+            count = references.get(blob.name, 0)
+            if count != blob.ref_count:
+                blob.ref_count = count
+                recounted.append(blob)
+            if count == 0 and blob.created_date < cutoff:
+                orphans.append(blob)
+
+        removed = len(orphans)
+        if not dry_run:
+            MediaBlob.objects.bulk_update(recounted, ['ref_count'], batch_size=options['batch_size'])
+            removed = 0
+            for blob in orphans:
+                # Skip blobs an upload started referencing again since the recount
+                deleted, _ = MediaBlob.objects.filter(pk=blob.pk, ref_count=0).delete()
+                if deleted:
+                    storage.delete_blob(blob.name)
+                    removed += 1
+
+        # Files without a MediaBlob row: interrupted uploads and rolled back transactions
+        strays = 0
+        root = storage.path(BLOB_DIR)
+        oldest = time.time() - options['grace_hours'] * 3600
+        for directory, _, files in os.walk(root):
+            for filename in files:
+                path = os.path.join(directory, filename)
+                name = os.path.relpath(path, storage.location).replace(os.sep, '/')
+                if name not in known and name not in references and os.path.getmtime(path) < oldest:
+                    strays += 1
+                    if not dry_run:
+                        os.remove(path)
+
+        action = "Would remove" if dry_run else "Removed"
+        self.stdout.write(self.style.SUCCESS(
+            f"{action} {removed} orphaned blob(s) and {strays} stray file(s), recounted {len(recounted)} blob(s)"))
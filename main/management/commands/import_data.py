@@ -0,0 +1,31 @@
+import csv
+import json
+
+from django.core.management.base import BaseCommand
+
+from main import imports
+
+
+class Command(BaseCommand):
+    help = "Bulk import users or reward catalog entries from a CSV or NDJSON file"
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=imports.KINDS)
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['csv', 'ndjson'], default='csv')
+        parser.add_argument('--workers', type=int, help="Password hashing processes, 0 hashes inline (default: one per CPU)")
+        parser.add_argument('--chunk-size', type=int, default=imports.CHUNK_SIZE)
+        parser.add_argument('--rejects', help="Write rejected lines and their errors to this CSV file")
+
+    def handle(self, *args, **options):
+        with open(options['path'], encoding='utf-8-sig', newline='') as source:
+            report = imports.run_import(options['kind'], source, options['format'], options['workers'],
+                                        options['chunk_size'], max_rejects=None)
+        if options['rejects']:
+            with open(options['rejects'], 'w', newline='', encoding='utf-8') as output:
+                writer = csv.DictWriter(output, ['line', 'error'])
+                writer.writeheader()
+                writer.writerows(report['rejects'])
+        elif report['rejects']:
+            self.stderr.write(json.dumps(report['rejects'][:20], indent=2))
+        self.stdout.write(self.style.SUCCESS(f"Created {report['created']}, rejected {report['rejected']}"))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+
+from main.leaderboards import boards_for, reset_rank_indexes
+from main.models import LeaderboardEntry, PointsLedger
+
+
+class Command(BaseCommand):
+    help = "Rebuild every leaderboard from the collection credits in the points ledger"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        totals = (PointsLedger.objects.filter(reason='Collection')
+                  .values('user', 'user__city', 'user__state')
+                  .annotate(points=Sum('points'), plastic=Sum('plastic')).order_by())
+        entries = []
+        for row in totals.iterator(chunk_size=options['batch_size']):
+            for board in boards_for(row['user__city'], row['user__state']):
+                entries.append(LeaderboardEntry(profile_id=row['user'], board=board, metric='points', score=row['points']))
+                entries.append(LeaderboardEntry(profile_id=row['user'], board=board, metric='plastic', score=row['plastic']))
+        with transaction.atomic():
+            LeaderboardEntry.objects.all().delete()
+            LeaderboardEntry.objects.bulk_create(entries, batch_size=options['batch_size'])
+        reset_rank_indexes()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {len(entries)} leaderboard entries"))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from main.models import DailyRollup, PointsLedger
+from main.rollups import compute
+
+
+class Command(BaseCommand):
+    help = "Rebuild the daily analytics rollups from the points ledger"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        rows = [
+            DailyRollup(day=day, dimension=dimension, **counters)
+            for (day, dimension), counters in compute(PointsLedger).items()
+        ]
+        with transaction.atomic():
+            DailyRollup.objects.all().delete()
+            DailyRollup.objects.bulk_create(rows, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {len(rows)} rollup rows"))
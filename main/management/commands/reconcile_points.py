@@ -0,0 +1,40 @@
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+
+from main import versions
+from main.models import UserProfile, PointsLedger
+
+
+class Command(BaseCommand):
+    help = "Rebuild UserProfile.earned_points and total_plastic_recycled from the points ledger"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Only report profiles whose balance drifted")
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        # One GROUP BY over the ledger, then only drifted profiles are written back
+        totals = {
+            row['user']: (row['points'], row['plastic'])
+            for row in PointsLedger.objects.values('user').annotate(points=Sum('points'), plastic=Sum('plastic')).order_by()
+        }
+        zero = (Decimal(0), Decimal(0))
+        drifted = []
+        for profile in UserProfile.objects.only('id', 'earned_points', 'total_plastic_recycled').iterator(chunk_size=options['batch_size']):
+            points, plastic = totals.get(profile.id, zero)
+            if profile.earned_points != points or profile.total_plastic_recycled != plastic:
+                profile.earned_points = points
+                profile.total_plastic_recycled = plastic
+                drifted.append(profile)
+
+        if not options['dry_run'] and drifted:
+            with transaction.atomic():
+                UserProfile.objects.bulk_update(drifted, ['earned_points', 'total_plastic_recycled'],
+                                                batch_size=options['batch_size'])
+                for start in range(0, len(drifted), options['batch_size']):
+                    versions.bump(*[versions.profile_key(profile.pk) for profile in drifted[start:start + options['batch_size']]])
+        action = "Would fix" if options['dry_run'] else "Fixed"
+        self.stdout.write(self.style.SUCCESS(f"{action} {len(drifted)} profile balance(s)"))
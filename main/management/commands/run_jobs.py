@@ -0,0 +1,29 @@
+import signal
+
+from django.core.management.base import BaseCommand
+
+from main import jobs
+
+
+class Command(BaseCommand):
+    help = "Run queued background jobs"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=4, help="Jobs running at the same time")
+        parser.add_argument('--pool', choices=['thread', 'process'], default='thread')
+        parser.add_argument('--poll-interval', type=float, default=1.0)
+        parser.add_argument('--once', action='store_true', help="Run the jobs that are due now, then exit")
+
+    def handle(self, *args, **options):
+        pruned = jobs.prune()
+        if pruned:
+            self.stdout.write(f"Pruned {pruned} finished jobs")
+        if options['once']:
+            ran = jobs.run_pending()
+            self.stdout.write(self.style.SUCCESS(f"Ran {ran} jobs"))
+            return
+        worker = jobs.Worker(options['concurrency'], options['pool'], options['poll_interval'])
+        signal.signal(signal.SIGTERM, worker.stop)
+        signal.signal(signal.SIGINT, worker.stop)
+        self.stdout.write(f"Running jobs with {options['concurrency']} {options['pool']} workers")
+        worker.run()
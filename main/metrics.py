@@ -0,0 +1,213 @@
+import atexit
+import contextvars
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Per-endpoint request metrics in the Prometheus text format, served on /metrics.
+# MetricsMiddleware observes each response under its route: the URL name (api:login,
+# api:get_user, admin:index, ...) and pattern, as operations of different controllers can
+# share a name. Latency, number of SQL queries and time spent in them, and body size.
+# Observations go to an in-memory registry of the process. With METRICS_DIR set, every
+# process also writes its registry to <METRICS_DIR>/<pid>.json at most every
+# METRICS_FLUSH_SECONDS and at exit, and /metrics sums the files of all workers, so the
+# numbers do not depend on which gunicorn or uvicorn worker answers the scrape. The
+# directory should be emptied when the server starts. Periodic writes happen on a
+# background thread, never on the request path or the event loop.
+# Streaming responses (event streams, exports) are only counted: their body is produced
+# after the middleware returns, so latency, queries and size would not describe them.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000)
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'cygree_http_request_duration_seconds': ('histogram', 'Time to produce the response', LATENCY_BUCKETS),
+    'cygree_http_request_db_queries': ('histogram', 'SQL queries run for the request', QUERY_BUCKETS),
+    'cygree_http_request_db_seconds': ('histogram', 'Time spent in SQL queries for the request', LATENCY_BUCKETS),
+    'cygree_http_response_size_bytes': ('histogram', 'Response body size, after compression', SIZE_BUCKETS),
+    'cygree_http_responses_total': ('counter', 'Responses by status code', None),
+}
+
+# [queries, seconds] of the request being served. A context variable rather than a
+# thread local: async handlers run their queries in sync_to_async threads, which get a
+# copy of the context holding the same list.
+_request_db = contextvars.ContextVar('metrics_request_db', default=None)
+
+
+def _measure(execute, sql, params, many, context):
+    stats = _request_db.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats[0] += 1
+        stats[1] += time.perf_counter() - started
+
+
+def instrument(connection):
+    """Count the queries of a database connection, on connection_created"""
+    if _measure not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_measure)
+
+
+class Registry:
+    """Series of one process: (name, labels) -> histogram bucket counts followed by the
+    sum of the observations, or a counter value"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.series = {}
+        self.flushed = 0.0
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][2]
+        with self._lock:
+            data = self.series.get((name, labels))
+            if data is None:
+                data = self.series[(name, labels)] = [0] * (len(buckets) + 1) + [0]
+            # Buckets are upper bounds, inclusive; the last count is the +Inf overflow
+            data[bisect_left(buckets, value)] += 1
+            data[-1] += value
+
+    def inc(self, name, labels):
+        with self._lock:
+            self.series[(name, labels)] = self.series.get((name, labels), 0) + 1
+
+    def snapshot(self):
+        with self._lock:
+            return {key: list(data) if isinstance(data, list) else data for key, data in self.series.items()}
+
+    def clear(self):
+        with self._lock:
+            self.series.clear()
+
+
+registry = Registry()
+_exit_registered = False
+_flushing = threading.Lock()
+
+
+def route_labels(request):
+    """(route, path) labels of a request: its URL name, or the pattern for unnamed routes,
+    and its URL pattern"""
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return ('route', 'unmatched'), ('path', '')
+    return ('route', match.view_name if match.url_name else match.route), ('path', match.route)
+
+
+def record(request, response, duration, queries, db_seconds):
+    labels = route_labels(request) + (('method', request.method),)
+    if not response.streaming:
+        registry.observe('cygree_http_request_duration_seconds', labels, duration)
+        registry.observe('cygree_http_request_db_queries', labels, queries)
+        registry.observe('cygree_http_request_db_seconds', labels, db_seconds)
+        registry.observe('cygree_http_response_size_bytes', labels, len(response.content))
+    registry.inc('cygree_http_responses_total', labels + (('status', str(response.status_code)),))
+    if settings.METRICS_DIR and time.monotonic() - registry.flushed >= settings.METRICS_FLUSH_SECONDS \
+            and _flushing.acquire(blocking=False):
+        registry.flushed = time.monotonic()
+        threading.Thread(target=_background_flush, name='metrics-flush', daemon=True).start()
+
+
+def _background_flush():
+    try:
+        flush()
+    except OSError:
+        logger.exception("Could not write the metrics file")
+    finally:
+        _flushing.release()
+
+
+def _encode(series):
+    return [[name, list(labels), data] for (name, labels), data in series.items()]
+
+
+def _decode(rows):
+    return {(name, tuple(tuple(pair) for pair in labels)): data for name, labels, data in rows}
+
+
+def flush():
+    """Write this process's registry to its file in METRICS_DIR"""
+    global _exit_registered
+    directory = settings.METRICS_DIR
+    if not directory:
+        return
+    registry.flushed = time.monotonic()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{os.getpid()}.json')
+    temporary = f'{path}.{threading.get_ident()}.tmp'
+    with open(temporary, 'w') as file:
+        json.dump(_encode(registry.snapshot()), file)
+    # Readers see either the previous file or this one, never a partial write
+    os.replace(temporary, path)
+    if not _exit_registered:
+        # Last observations of a worker that is shut down between two flushes
+        _exit_registered = True
+        atexit.register(flush)
+
+
+def merge(snapshots):
+    merged = {}
+    for series in snapshots:
+        for key, data in series.items():
+            if key not in merged:
+                merged[key] = list(data) if isinstance(data, list) else data
+            elif isinstance(data, list):
+                merged[key] = [total + value for total, value in zip(merged[key], data)]
+            else:
+                merged[key] += data
+    return merged
+
+
+def collect():
+    """Series of all workers with METRICS_DIR set, of this process otherwise"""
+    if not settings.METRICS_DIR:
+        return registry.snapshot()
+    flush()
+    snapshots = []
+    for path in glob.glob(os.path.join(settings.METRICS_DIR, '*.json')):
+        try:
+            with open(path) as file:
+                snapshots.append(_decode(json.load(file)))
+        except (OSError, ValueError):
+            continue
+    return merge(snapshots)
+
+
+def _labels(labels):
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped))
+
+
+def render(series):
+    """Prometheus text exposition format, version 0.0.4"""
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for (metric, labels), data in sorted(series.items(), key=lambda item: item[0]):
+            if metric != name:
+                continue
+            if kind == 'counter':
+                lines.append(f'{name}{{{_labels(labels)}}} {data}')
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets + ('+Inf',), data):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{_labels(labels + (("le", str(bound)),))}}} {cumulative}')
+            lines.append(f'{name}_sum{{{_labels(labels)}}} {data[-1]}')
+            lines.append(f'{name}_count{{{_labels(labels)}}} {cumulative}')
+    return '\n'.join(lines) + '\n'
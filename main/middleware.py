@@ -0,0 +1,161 @@
+import gzip
+import time
+import zlib
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.text import compress_sequence
+
+from main import metrics
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+# Negotiated response compression. Brotli is used when the client accepts it and the
+# brotli package is installed, gzip otherwise. Bodies smaller than COMPRESSION_MIN_SIZE
+# are sent as they are, the encoding overhead would eat the saving. Only text-like
+# content types are compressed. Event streams are skipped, a compressor buffers events
+# the client is waiting for.
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'application/javascript', 'application/xml', 'text/')
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def accepted_encodings(header):
+    """{encoding: q} from an Accept-Encoding header"""
+    accepted = {}
+    for part in header.split(','):
+        name, _, params = part.partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name] = quality
+    return accepted
+
+
+def negotiate(header):
+    """Encoding to use for a request's Accept-Encoding header, or None"""
+    accepted = accepted_encodings(header)
+    for encoding in ('br', 'gzip') if brotli else ('gzip',):
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+def _brotli_sequence(sequence):
+    compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+    for item in sequence:
+        data = compressor.process(item) + compressor.flush()
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+async def _abrotli_sequence(sequence):
+    compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+    async for item in sequence:
+        data = compressor.process(item) + compressor.flush()
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+async def _agzip_sequence(sequence):
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    async for item in sequence:
+        data = compressor.compress(item) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def compress(content, encoding):
+    if encoding == 'br':
+        return brotli.compress(content, quality=BROTLI_QUALITY)
+    return gzip.compress(content, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+class CompressionMiddleware(MiddlewareMixin):
+    def process_response(self, request, response):
+        content_type = response.get('Content-Type', '').split(';')[0].strip().lower()
+        if not content_type.startswith(COMPRESSIBLE_TYPES) or content_type == 'text/event-stream' \
+                or response.has_header('Content-Encoding'):
+            return response
+        if not response.streaming and len(response.content) < settings.COMPRESSION_MIN_SIZE:
+            return response
+        # Vary even when this client gets it uncompressed, caches must not hand it to others
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = negotiate(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            if response.is_async:
+                sequence = _abrotli_sequence if encoding == 'br' else _agzip_sequence
+            else:
+                sequence = _brotli_sequence if encoding == 'br' else compress_sequence
+            response.streaming_content = sequence(response.streaming_content)
+            del response['Content-Length']
+        else:
+            compressed = compress(response.content, encoding)
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response.headers['Content-Length'] = str(len(compressed))
+
+        # The body differs from the uncompressed one, a strong ETag would be wrong
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response.headers['ETag'] = 'W/' + etag
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+
+class MetricsMiddleware:
+    """Records per-route request metrics, see main/metrics.py. Sync and async capable so
+    async handlers are not pushed through a thread by it"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        stats = [0, 0.0]
+        token = metrics._request_db.set(stats)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            metrics._request_db.reset(token)
+        metrics.record(request, response, time.perf_counter() - started, *stats)
+        return response
+
+    async def __acall__(self, request):
+        stats = [0, 0.0]
+        token = metrics._request_db.set(stats)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            metrics._request_db.reset(token)
+        metrics.record(request, response, time.perf_counter() - started, *stats)
+        return response
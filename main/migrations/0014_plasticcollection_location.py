@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0013_alter_reward_unique_together'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='plasticcollection',
+            name='geohash',
+            field=models.CharField(blank=True, max_length=12, null=True),
+        ),
+        migrations.AddField(
+            model_name='plasticcollection',
+            name='latitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='plasticcollection',
+            name='longitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='plasticcollection',
+            index=models.Index(fields=['status', 'geohash'], name='collection_status_geohash_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:29
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0014_plasticcollection_location'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PointsLedger',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reason', models.CharField(choices=[('Collection', 'Collection'), ('Reward', 'Reward'), ('Adjustment', 'Adjustment')], max_length=50)),
+                ('points', models.DecimalField(decimal_places=2, default=0.0, max_digits=20)),
+                ('plastic', models.DecimalField(decimal_places=2, default=0.0, max_digits=20)),
+                ('created_date', models.DateTimeField(default=django.utils.timezone.now)),
+                ('collection', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='main.plasticcollection')),
+                ('reward', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='main.reward')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ledger', to='main.userprofile')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(condition=models.Q(('collection__isnull', False)), fields=('collection',), name='ledger_unique_collection'), models.UniqueConstraint(condition=models.Q(('reward__isnull', False)), fields=('reward',), name='ledger_unique_reward')],
+            },
+        ),
+    ]
@@ -0,0 +1,46 @@
+from decimal import Decimal
+
+from django.db import migrations
+
+
+def seed_ledger(apps, schema_editor):
+    """Backfill ledger rows for existing balances so reconcile_points is a no-op afterwards"""
+    UserProfile = apps.get_model('main', 'UserProfile')
+    PlasticCollection = apps.get_model('main', 'PlasticCollection')
+    Reward = apps.get_model('main', 'Reward')
+    PointsLedger = apps.get_model('main', 'PointsLedger')
+
+    entries = []
+    totals = {}
+    for collection in PlasticCollection.objects.filter(status='Collected').iterator():
+        points = collection.amount_collected * 10
+        entries.append(PointsLedger(user_id=collection.user_id, reason='Collection', collection_id=collection.id,
+                                    points=points, plastic=collection.amount_collected,
+                                    created_date=collection.collection_date))
+        total = totals.setdefault(collection.user_id, [Decimal(0), Decimal(0)])
+        total[0] += points
+        total[1] += collection.amount_collected
+    for reward in Reward.objects.select_related('reward').iterator():
+        entries.append(PointsLedger(user_id=reward.user_id, reason='Reward', reward_id=reward.id,
+                                    points=-reward.reward.points_required, created_date=reward.claimed_date))
+        totals.setdefault(reward.user_id, [Decimal(0), Decimal(0)])[0] -= reward.reward.points_required
+
+    # Whatever the history does not explain becomes an opening adjustment
+    for profile in UserProfile.objects.iterator():
+        points, plastic = totals.get(profile.id, (Decimal(0), Decimal(0)))
+        if profile.earned_points != points or profile.total_plastic_recycled != plastic:
+            entries.append(PointsLedger(user_id=profile.id, reason='Adjustment',
+                                        points=profile.earned_points - points,
+                                        plastic=profile.total_plastic_recycled - plastic))
+    PointsLedger.objects.bulk_create(entries, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0015_pointsledger'),
+    ]
+
+    operations = [
+        migrations.RunPython(seed_ledger, migrations.RunPython.noop),
+    ]
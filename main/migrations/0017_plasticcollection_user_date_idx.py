@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0016_seed_pointsledger'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='plasticcollection',
+            index=models.Index(fields=['user', '-collection_date'], name='collection_user_date_idx'),
+        ),
+    ]
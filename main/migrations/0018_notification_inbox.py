@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:30
+
+from django.db import migrations, models
+
+
+def seed_unread_counts(apps, schema_editor):
+    UserProfile = apps.get_model('main', 'UserProfile')
+    Notification = apps.get_model('main', 'Notification')
+    unread = (Notification.objects.filter(is_read=False, to_user__isnull=False)
+              .values('to_user').annotate(count=models.Count('id')).order_by())
+    for row in unread:
+        UserProfile.objects.filter(pk=row['to_user']).update(unread_notifications=row['count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0017_plasticcollection_user_date_idx'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='notification',
+            options={'ordering': ['-notification_date', '-id']},
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='unread_notifications',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['to_user', 'is_read', '-notification_date', '-id'], name='notification_inbox_unread_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['to_user', '-notification_date', '-id'], name='notification_inbox_idx'),
+        ),
+        migrations.RunPython(seed_unread_counts, migrations.RunPython.noop),
+    ]
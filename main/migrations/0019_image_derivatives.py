@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0018_notification_inbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='plasticcollection',
+            name='collection_thumb',
+            field=models.ImageField(blank=True, null=True, upload_to='plastic_collection/derivatives/'),
+        ),
+        migrations.AddField(
+            model_name='plasticcollection',
+            name='collection_webp',
+            field=models.ImageField(blank=True, null=True, upload_to='plastic_collection/derivatives/'),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='profile_thumb',
+            field=models.ImageField(blank=True, null=True, upload_to='profile_pics/derivatives/'),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='profile_webp',
+            field=models.ImageField(blank=True, null=True, upload_to='profile_pics/derivatives/'),
+        ),
+    ]
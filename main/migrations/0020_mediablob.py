@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:35
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0019_image_derivatives'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('digest', models.CharField(max_length=64)),
+                ('size', models.PositiveBigIntegerField(default=0)),
+                ('ref_count', models.PositiveIntegerField(default=0)),
+                ('created_date', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['ref_count', 'created_date'], name='mediablob_orphan_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0020_mediablob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='plasticcollection',
+            name='possible_duplicate_of',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='duplicates', to='main.plasticcollection'),
+        ),
+        migrations.CreateModel(
+            name='PhotoFingerprint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hash', models.BigIntegerField()),
+                ('chunk_0', models.IntegerField(db_index=True)),
+                ('chunk_1', models.IntegerField(db_index=True)),
+                ('chunk_2', models.IntegerField(db_index=True)),
+                ('chunk_3', models.IntegerField(db_index=True)),
+                ('chunk_4', models.IntegerField(db_index=True)),
+                ('collection', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='fingerprint', to='main.plasticcollection')),
+            ],
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:42
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def build_leaderboards(apps, schema_editor):
+    from main.leaderboards import boards_for
+    PointsLedger = apps.get_model('main', 'PointsLedger')
+    LeaderboardEntry = apps.get_model('main', 'LeaderboardEntry')
+    totals = (PointsLedger.objects.filter(reason='Collection')
+              .values('user', 'user__city', 'user__state')
+              .annotate(points=models.Sum('points'), plastic=models.Sum('plastic')).order_by())
+    entries = []
+    for row in totals:
+        for board in boards_for(row['user__city'], row['user__state']):
+            entries.append(LeaderboardEntry(profile_id=row['user'], board=board, metric='points', score=row['points']))
+            entries.append(LeaderboardEntry(profile_id=row['user'], board=board, metric='plastic', score=row['plastic']))
+    LeaderboardEntry.objects.bulk_create(entries, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0021_photo_fingerprints'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LeaderboardEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('board', models.CharField(max_length=300)),
+                ('metric', models.CharField(choices=[('points', 'points'), ('plastic', 'plastic')], max_length=20)),
+                ('score', models.DecimalField(decimal_places=2, default=0.0, max_digits=20)),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='leaderboard_entries', to='main.userprofile')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['board', 'metric', '-score', 'profile'], name='leaderboard_top_idx')],
+                'constraints': [models.UniqueConstraint(fields=('board', 'metric', 'profile'), name='leaderboard_unique_entry')],
+            },
+        ),
+        migrations.RunPython(build_leaderboards, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:44
+
+from django.db import migrations, models
+
+
+def drop_duplicate_badges(apps, schema_editor):
+    Badge = apps.get_model('main', 'Badge')
+    keep = (Badge.objects.values('user', 'name').annotate(first=models.Min('id'))
+            .values_list('first', flat=True).order_by())
+    Badge.objects.exclude(id__in=list(keep)).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0022_leaderboardentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Checkpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('position', models.BigIntegerField(default=0)),
+                ('updated_date', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(drop_duplicate_badges, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='badge',
+            constraint=models.UniqueConstraint(fields=('user', 'name'), name='badge_unique_per_user'),
+        ),
+    ]
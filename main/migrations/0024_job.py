@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:46
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0023_badge_awards'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task', models.CharField(max_length=200)),
+                ('args', models.JSONField(blank=True, default=list)),
+                ('kwargs', models.JSONField(blank=True, default=dict)),
+                ('key', models.CharField(blank=True, max_length=200, null=True)),
+                ('priority', models.IntegerField(default=0)),
+                ('status', models.CharField(choices=[('Queued', 'Queued'), ('Running', 'Running'), ('Done', 'Done'), ('Failed', 'Failed')], default='Queued', max_length=20)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('max_attempts', models.PositiveIntegerField(default=5)),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now)),
+                ('locked_until', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True)),
+                ('created_date', models.DateTimeField(default=django.utils.timezone.now)),
+                ('finished_date', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', '-priority', 'run_after', 'id'], name='job_due_idx'), models.Index(fields=['status', 'locked_until'], name='job_lease_idx')],
+                'constraints': [models.UniqueConstraint(condition=models.Q(('status', 'Queued')), fields=('key',), name='job_unique_queued_key')],
+            },
+        ),
+    ]
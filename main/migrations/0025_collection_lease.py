@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:52
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0024_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='plasticcollection',
+            name='lease_expires',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='plasticcollection',
+            name='leased_to',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='leases', to='main.userprofile'),
+        ),
+    ]
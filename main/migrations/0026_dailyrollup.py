@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:54
+
+from django.db import migrations, models
+
+
+def build_rollups(apps, schema_editor):
+    from main.rollups import compute
+    PointsLedger = apps.get_model('main', 'PointsLedger')
+    DailyRollup = apps.get_model('main', 'DailyRollup')
+    DailyRollup.objects.bulk_create([
+        DailyRollup(day=day, dimension=dimension, **counters)
+        for (day, dimension), counters in compute(PointsLedger, city_field='user__city').items()
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0025_collection_lease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('dimension', models.CharField(max_length=300)),
+                ('collections', models.PositiveIntegerField(default=0)),
+                ('kg', models.DecimalField(decimal_places=2, default=0.0, max_digits=20)),
+                ('points_issued', models.DecimalField(decimal_places=2, default=0.0, max_digits=20)),
+                ('rewards', models.PositiveIntegerField(default=0)),
+                ('points_redeemed', models.DecimalField(decimal_places=2, default=0.0, max_digits=20)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('dimension', 'day'), name='rollup_unique_day')],
+            },
+        ),
+        migrations.RunPython(build_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0026_dailyrollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='result',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
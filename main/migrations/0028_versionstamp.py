@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:17
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0027_job_result'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VersionStamp',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=100, unique=True)),
+                ('version', models.PositiveBigIntegerField(default=0)),
+                ('modified_date', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
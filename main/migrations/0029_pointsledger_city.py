@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:00
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_city(apps, schema_editor):
+    """Existing entries get the profile's current city, the only one known for them"""
+    UserProfile = apps.get_model('main', 'UserProfile')
+    PointsLedger = apps.get_model('main', 'PointsLedger')
+    PointsLedger.objects.update(city=Subquery(UserProfile.objects.filter(pk=OuterRef('user_id')).values('city')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0028_versionstamp'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pointsledger',
+            name='city',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.RunPython(backfill_city, migrations.RunPython.noop),
+    ]
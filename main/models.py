@@ -1,11 +1,21 @@
+from decimal import Decimal
+from itertools import islice
+
 from django.db import models
 from django.contrib.auth.models import User
 from django.utils import timezone
+from django.db import transaction, IntegrityError
+from django.db.models import F, Q, Case, When, Value, DecimalField
+from django.db.models.functions import Greatest
 from django.core.exceptions import ValidationError
+from main import geo, events, leaderboards, badges, jobs, rollups, versions
 
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     profile_pic=models.ImageField(upload_to='profile_pics/',default='profile_pics/default.jpg')
+    # Derivatives written by the image pipeline (main/images.py)
+    profile_thumb = models.ImageField(upload_to='profile_pics/derivatives/', null=True, blank=True)
+    profile_webp = models.ImageField(upload_to='profile_pics/derivatives/', null=True, blank=True)
     role = models.CharField(max_length=100, choices=[('Client', 'Client'), ('Agent', 'Agent')],default='Client')
     address = models.CharField(max_length=255, blank=True, null=True)
     
@@ -92,6 +102,8 @@ class UserProfile(models.Model):
     phone_number = models.CharField(max_length=10, blank=True, null=True)
     total_plastic_recycled = models.DecimalField(max_digits=20, decimal_places=2, default=0.00)
     earned_points = models.DecimalField(max_digits=20, decimal_places=2, default=0.00)
+    # Denormalized count of unread notifications addressed to this profile
+    unread_notifications = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return self.user.username
@@ -106,19 +118,60 @@ class PlasticCollection(models.Model):
     user = models.ForeignKey(UserProfile, on_delete=models.CASCADE)
     agent=models.ForeignKey(UserProfile, on_delete=models.SET_NULL, related_name='agent',null=True,blank=True)
     collection_pic=models.ImageField(upload_to='plastic_collection/',default='default.jpg')
+    collection_thumb = models.ImageField(upload_to='plastic_collection/derivatives/', null=True, blank=True)
+    collection_webp = models.ImageField(upload_to='plastic_collection/derivatives/', null=True, blank=True)
     amount_collected = models.DecimalField(max_digits=6, decimal_places=2)
     collection_date = models.DateTimeField(default=timezone.now)
     status = models.CharField(max_length=50, choices=[('Request', 'Request'),('Pending', 'Pending'), ('Collected', 'Collected')], default='Request')
+    # Pickup location, geohash is derived from latitude/longitude on save
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
+    geohash = models.CharField(max_length=12, null=True, blank=True)
+    # Set when the photo is a perceptual near-duplicate of an earlier submission (main/fingerprints.py)
+    possible_duplicate_of = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, related_name='duplicates')
+    # Short reservation handed out by the agent dispatch queue, open to everyone again once it expires
+    leased_to = models.ForeignKey(UserProfile, on_delete=models.SET_NULL, null=True, blank=True, related_name='leases')
+    lease_expires = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'geohash'], name='collection_status_geohash_idx'),
+            models.Index(fields=['user', '-collection_date'], name='collection_user_date_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.user.username} - {self.amount_collected} kg"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored status so save() can tell when it actually changes
+        instance._loaded_status = instance.__dict__.get('status')
+        return instance
+
     def save(self, *args, **kwargs):
-        if self.status == 'Collected':
-            self.user.total_plastic_recycled += self.amount_collected
-            self.user.earned_points += self.amount_collected * 10
-            self.user.save()
-        super().save(*args, **kwargs)
+        if self.latitude is not None and self.longitude is not None:
+            self.geohash = geo.encode(self.latitude, self.longitude)
+        status_changed = self.status != getattr(self, '_loaded_status', None)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            versions.bump(versions.collections_key(self.user_id))
+            if self.status == 'Collected':
+                PointsLedger.credit_collection(self)
+            if status_changed:
+                self.publish_status()
+        self._loaded_status = self.status
+
+    @staticmethod
+    def available_to(agent_id, now=None):
+        """Q for requests that are not reserved by another agent"""
+        return Q(leased_to__isnull=True) | Q(lease_expires__lt=now or timezone.now()) | Q(leased_to=agent_id)
+
+    def publish_status(self):
+        """Push the current status to the client and the assigned agent"""
+        data = {'id': self.id, 'status': self.status, 'amount_collected': self.amount_collected}
+        for profile_id in {self.user_id, self.agent_id} - {None}:
+            events.publish(profile_id, 'collection', data)
 
 class ListReward(models.Model):
     title = models.CharField(max_length=100,null=True)
@@ -143,13 +196,23 @@ class Reward(models.Model):
             return f"{self.user.user.username} - {self.reward.reward_type}"
 
         def save(self, *args, **kwargs):
-            if self.user.earned_points >= self.reward.points_required:
-                self.user.earned_points -= self.reward.points_required
-                self.user.save()
-            else:
-                raise ValidationError(
-                    ('Not enough points to claim this reward'))
-            super().save(*args, **kwargs)
+            if not self._state.adding:
+                return super().save(*args, **kwargs)
+            with transaction.atomic():
+                # Conditional decrement, so concurrent claims can never overdraw the balance
+                debited = UserProfile.objects.filter(
+                    pk=self.user_id, earned_points__gte=self.reward.points_required
+                ).update(earned_points=F('earned_points') - self.reward.points_required)
+                if not debited:
+                    raise ValidationError(
+                        ('Not enough points to claim this reward'))
+                super().save(*args, **kwargs)
+                versions.bump(versions.profile_key(self.user_id))
+                city = UserProfile.objects.filter(pk=self.user_id).values_list('city', flat=True).get()
+                entry = PointsLedger.objects.create(user_id=self.user_id, reason='Reward', reward=self,
+                                                    points=-self.reward.points_required, city=city)
+                rollups.add(rollups.day_of(entry.created_date), rollups.dimensions_for(entry.city),
+                            rollups.reward_counters(self.reward.points_required))
         class Meta:
             unique_together = ["user", "reward"]
 
@@ -169,6 +232,11 @@ class Badge(models.Model):
     )
     issued_date = models.DateTimeField(default=timezone.now)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'name'], name='badge_unique_per_user'),
+        ]
+
 class Notification(models.Model):
     user = models.ForeignKey(UserProfile, on_delete=models.CASCADE)
     to_user = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name='to_user', null=True, blank=True)
@@ -178,14 +246,290 @@ class Notification(models.Model):
     is_read = models.BooleanField(default=False)
 
     class Meta:
-        ordering = ['-importance_level', '-notification_date']
+        ordering = ['-notification_date', '-id']
+        indexes = [
+            # Inbox pages and unread filters for one recipient, newest first
+            models.Index(fields=['to_user', 'is_read', '-notification_date', '-id'], name='notification_inbox_unread_idx'),
+            models.Index(fields=['to_user', '-notification_date', '-id'], name='notification_inbox_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.user.username} - {self.importance_level} - {self.message[:20]}"
 
+    BROADCAST_CHUNK_SIZE = 1000
+
+    @staticmethod
+    def importance_for(message, importance_level):
+        if 'role change' in message.lower():
+            return 'High'
+        if 'badge' in message.lower():
+            return 'Medium'
+        return importance_level
+
     def save(self, *args, **kwargs):
-        if 'role change' in self.message.lower():
-            self.importance_level = 'High'
-        elif 'badge' in self.message.lower():
-            self.importance_level = 'Medium'
-        super().save(*args, **kwargs)
\ No newline at end of file
+        self.importance_level = self.importance_for(self.message, self.importance_level)
+        adding = self._state.adding
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if adding and self.to_user_id and not self.is_read:
+                UserProfile.objects.filter(pk=self.to_user_id).update(unread_notifications=F('unread_notifications') + 1)
+                events.publish(self.to_user_id, 'notification', self.event_data())
+
+    def event_data(self):
+        return {'id': self.id, 'message': self.message, 'importance_level': self.importance_level,
+                'notification_date': self.notification_date}
+
+    @classmethod
+    def broadcast(cls, sender_id, recipients, message, importance_level='Low', chunk_size=None):
+        """Send one message to every profile in the recipients queryset, returns how many were sent.
+        Rows are inserted chunk by chunk so memory stays bounded, live events are fanned out by a job"""
+        chunk_size = chunk_size or cls.BROADCAST_CHUNK_SIZE
+        importance_level = cls.importance_for(message, importance_level)
+        notification_date = timezone.now()
+        sent = 0
+        with transaction.atomic():
+            recipient_ids = recipients.order_by('pk').values_list('pk', flat=True).iterator(chunk_size=chunk_size)
+            while chunk := list(islice(recipient_ids, chunk_size)):
+                cls.objects.bulk_create([
+                    cls(user_id=sender_id or profile_id, to_user_id=profile_id, message=message,
+                        importance_level=importance_level, notification_date=notification_date)
+                    for profile_id in chunk
+                ])
+                UserProfile.objects.filter(pk__in=chunk).update(unread_notifications=F('unread_notifications') + 1)
+                jobs.enqueue('main.events.publish_many', chunk, 'notification',
+                             {'message': message, 'importance_level': importance_level,
+                              'notification_date': notification_date.isoformat()})
+                sent += len(chunk)
+        return sent
+
+    @staticmethod
+    def mark_read(queryset):
+        """Mark the unread notifications in queryset as read and keep recipients' unread counters in sync"""
+        marked = 0
+        unread = queryset.filter(is_read=False)
+        with transaction.atomic():
+            # UPDATE row counts are exact even when two requests mark the same rows concurrently
+            for to_user in unread.values_list('to_user', flat=True).distinct().order_by():
+                count = unread.filter(to_user=to_user).update(is_read=True)
+                if to_user and count:
+                    UserProfile.objects.filter(pk=to_user).update(
+                        unread_notifications=Greatest(F('unread_notifications') - count, 0))
+                marked += count
+        return marked
+
+# Append-only record of every change to UserProfile.earned_points / total_plastic_recycled.
+# Balances on UserProfile are a cache of SUM(points) / SUM(plastic) per user and can be
+# rebuilt with `manage.py reconcile_points`.
+class PointsLedger(models.Model):
+    user = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name='ledger')
+    reason = models.CharField(max_length=50, choices=[('Collection', 'Collection'), ('Reward', 'Reward'), ('Adjustment', 'Adjustment')])
+    collection = models.ForeignKey(PlasticCollection, on_delete=models.SET_NULL, null=True, blank=True)
+    reward = models.ForeignKey(Reward, on_delete=models.SET_NULL, null=True, blank=True)
+    points = models.DecimalField(max_digits=20, decimal_places=2, default=0.00)
+    plastic = models.DecimalField(max_digits=20, decimal_places=2, default=0.00)
+    # The profile's city when the entry was written, analytics rollups attribute the entry to it
+    city = models.CharField(max_length=255, blank=True, null=True)
+    created_date = models.DateTimeField(default=timezone.now)
+
+    POINTS_PER_KG = 10
+
+    class Meta:
+        constraints = [
+            # A collection is credited and a reward debited exactly once
+            models.UniqueConstraint(fields=['collection'], condition=Q(collection__isnull=False), name='ledger_unique_collection'),
+            models.UniqueConstraint(fields=['reward'], condition=Q(reward__isnull=False), name='ledger_unique_reward'),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id} - {self.reason} - {self.points}"
+
+    @classmethod
+    def credit_collection(cls, collection):
+        """Credit points and plastic for a collected request, returns False if it was already credited"""
+        if cls.objects.filter(collection=collection).exists():
+            return False
+        points = collection.amount_collected * cls.POINTS_PER_KG
+        with transaction.atomic():
+            city, state = UserProfile.objects.filter(pk=collection.user_id).values_list('city', 'state').get()
+            try:
+                with transaction.atomic():
+                    entry = cls.objects.create(user_id=collection.user_id, reason='Collection', collection=collection,
+                                               points=points, plastic=collection.amount_collected, city=city)
+            except IntegrityError:
+                # Lost the race against a concurrent save of the same collection
+                return False
+            UserProfile.objects.filter(pk=collection.user_id).update(
+                earned_points=F('earned_points') + points,
+                total_plastic_recycled=F('total_plastic_recycled') + collection.amount_collected,
+            )
+            versions.bump(versions.profile_key(collection.user_id))
+            leaderboards.record_collection(collection.user_id, city, state, points, collection.amount_collected)
+            rollups.add(rollups.day_of(entry.created_date), rollups.dimensions_for(city, collection.agent_id),
+                        rollups.collection_counters(points, collection.amount_collected))
+            badges.schedule()
+        return True
+
+    @classmethod
+    def credit_collections(cls, collections):
+        """Credit many collected requests at once, with one ledger insert and one aggregated
+        profile UPDATE. Returns the collections that were credited"""
+        credited = set(cls.objects.filter(collection__in=[collection.pk for collection in collections])
+                       .values_list('collection_id', flat=True))
+        collections = [collection for collection in collections if collection.pk not in credited]
+        if not collections:
+            return []
+        locations = {profile_id: (city, state) for profile_id, city, state in UserProfile.objects.filter(
+            pk__in={collection.user_id for collection in collections}).values_list('id', 'city', 'state')}
+        entries = []
+        totals = {}
+        for collection in collections:
+            points = collection.amount_collected * cls.POINTS_PER_KG
+            entries.append(cls(user_id=collection.user_id, reason='Collection', collection_id=collection.pk,
+                               points=points, plastic=collection.amount_collected,
+                               city=locations[collection.user_id][0]))
+            profile_points, profile_plastic = totals.get(collection.user_id, (Decimal(0), Decimal(0)))
+            totals[collection.user_id] = (profile_points + points, profile_plastic + collection.amount_collected)
+        amount = DecimalField(max_digits=20, decimal_places=2)
+        with transaction.atomic():
+            cls.objects.bulk_create(entries)
+            UserProfile.objects.filter(pk__in=totals).update(
+                earned_points=F('earned_points') + Case(
+                    *[When(pk=pk, then=Value(points)) for pk, (points, _) in totals.items()], output_field=amount),
+                total_plastic_recycled=F('total_plastic_recycled') + Case(
+                    *[When(pk=pk, then=Value(plastic)) for pk, (_, plastic) in totals.items()], output_field=amount),
+            )
+            versions.bump(*[versions.profile_key(profile_id) for profile_id in totals])
+            for profile_id, (city, state) in locations.items():
+                leaderboards.record_collection(profile_id, city, state, *totals[profile_id])
+            rollups.add_many(
+                (rollups.day_of(entry.created_date), rollups.dimensions_for(entry.city, collection.agent_id),
+                 rollups.collection_counters(entry.points, entry.plastic))
+                for entry, collection in zip(entries, collections)
+            )
+            badges.schedule()
+        return collections
+
+
+# One stored file of main.storage.ContentAddressedStorage, shared by every ImageField value that
+# points at the same bytes. ref_count is maintained on save/delete and recounted by gc_media.
+class MediaBlob(models.Model):
+    name = models.CharField(max_length=255, unique=True)
+    digest = models.CharField(max_length=64)
+    size = models.PositiveBigIntegerField(default=0)
+    ref_count = models.PositiveIntegerField(default=0)
+    created_date = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['ref_count', 'created_date'], name='mediablob_orphan_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.ref_count} refs)"
+
+
+# Perceptual hash of a collection photo, split into indexed chunks for near-duplicate lookup
+class PhotoFingerprint(models.Model):
+    collection = models.OneToOneField(PlasticCollection, on_delete=models.CASCADE, related_name='fingerprint')
+    hash = models.BigIntegerField()
+    chunk_0 = models.IntegerField(db_index=True)
+    chunk_1 = models.IntegerField(db_index=True)
+    chunk_2 = models.IntegerField(db_index=True)
+    chunk_3 = models.IntegerField(db_index=True)
+    chunk_4 = models.IntegerField(db_index=True)
+
+    def __str__(self):
+        return f"{self.collection_id} - {self.hash:x}"
+
+
+# Score of one profile on one leaderboard ('global', 'state:<name>' or 'city:<name>'), see main/leaderboards.py
+class LeaderboardEntry(models.Model):
+    profile = models.ForeignKey(UserProfile, on_delete=models.CASCADE, related_name='leaderboard_entries')
+    board = models.CharField(max_length=300)
+    metric = models.CharField(max_length=20, choices=[('points', 'points'), ('plastic', 'plastic')])
+    score = models.DecimalField(max_digits=20, decimal_places=2, default=0.00)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['board', 'metric', 'profile'], name='leaderboard_unique_entry'),
+        ]
+        indexes = [
+            models.Index(fields=['board', 'metric', '-score', 'profile'], name='leaderboard_top_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.board} - {self.metric} - {self.profile_id}: {self.score}"
+
+
+# Progress marker of a batch job over an append-only table, e.g. the last ledger id main/badges.py has evaluated
+class Checkpoint(models.Model):
+    name = models.CharField(max_length=100, unique=True)
+    position = models.BigIntegerField(default=0)
+    updated_date = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name}: {self.position}"
+
+
+# Deferred work for `manage.py run_jobs`, see main/jobs.py
+class Job(models.Model):
+    task = models.CharField(max_length=200)
+    args = models.JSONField(default=list, blank=True)
+    kwargs = models.JSONField(default=dict, blank=True)
+    key = models.CharField(max_length=200, null=True, blank=True)
+    priority = models.IntegerField(default=0)
+    status = models.CharField(max_length=20, default='Queued', choices=[
+        ('Queued', 'Queued'), ('Running', 'Running'), ('Done', 'Done'), ('Failed', 'Failed')])
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    # JSON-serializable return value of the task
+    result = models.JSONField(null=True, blank=True)
+    created_date = models.DateTimeField(default=timezone.now)
+    finished_date = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            # At most one queued job per key, later enqueues are folded into it
+            models.UniqueConstraint(fields=['key'], condition=Q(status='Queued'), name='job_unique_queued_key'),
+        ]
+        indexes = [
+            models.Index(fields=['status', '-priority', 'run_after', 'id'], name='job_due_idx'),
+            models.Index(fields=['status', 'locked_until'], name='job_lease_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.task} - {self.status}"
+
+
+# Per-day analytics totals for one dimension ('global', 'city:<name>' or 'agent:<profile id>'), see main/rollups.py
+class DailyRollup(models.Model):
+    day = models.DateField()
+    dimension = models.CharField(max_length=300)
+    collections = models.PositiveIntegerField(default=0)
+    kg = models.DecimalField(max_digits=20, decimal_places=2, default=0.00)
+    points_issued = models.DecimalField(max_digits=20, decimal_places=2, default=0.00)
+    rewards = models.PositiveIntegerField(default=0)
+    points_redeemed = models.DecimalField(max_digits=20, decimal_places=2, default=0.00)
+
+    class Meta:
+        constraints = [
+            # Also the index behind date range queries for one dimension
+            models.UniqueConstraint(fields=['dimension', 'day'], name='rollup_unique_day'),
+        ]
+
+    def __str__(self):
+        return f"{self.day} - {self.dimension}"
+
+
+# Version of one cacheable resource ('profile:<id>', 'collections:<id>', 'rewards:<id>' or 'catalog'),
+# see main/versions.py
+class VersionStamp(models.Model):
+    key = models.CharField(max_length=100, unique=True)
+    version = models.PositiveBigIntegerField(default=0)
+    modified_date = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.key}: {self.version}"
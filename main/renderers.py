@@ -0,0 +1,43 @@
+from decimal import Decimal
+
+import orjson
+from django.http import HttpResponse
+from ninja.parser import Parser
+from ninja.renderers import BaseRenderer
+from ninja.responses import NinjaJSONEncoder
+
+# JSON for the API through orjson instead of the stdlib encoder. orjson serializes
+# datetime, date, UUID and dataclasses natively, Decimal is written as a string like
+# DjangoJSONEncoder does, anything else falls back to ninja's encoder.
+
+_fallback = NinjaJSONEncoder()
+
+
+def _default(obj):
+    if isinstance(obj, Decimal):
+        return str(obj)
+    return _fallback.default(obj)
+
+
+def dumps(data):
+    return orjson.dumps(data, default=_default, option=orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS)
+
+
+class ORJSONRenderer(BaseRenderer):
+    media_type = "application/json"
+
+    def render(self, request, data, *, response_status):
+        return dumps(data)
+
+
+class ORJSONParser(Parser):
+    def parse_body(self, request):
+        return orjson.loads(request.body)
+
+
+class ORJSONResponse(HttpResponse):
+    """JsonResponse rendered with orjson, for handlers that build their response by hand"""
+
+    def __init__(self, data, **kwargs):
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__(content=dumps(data), **kwargs)
@@ -0,0 +1,129 @@
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+# Daily analytics rollups. Every points ledger write adds its amounts to one DailyRollup row
+# per dimension it belongs to ('global', 'city:<name>', 'agent:<profile id>'), so date
+# range queries read one short row per day instead of scanning collections and rewards.
+# `manage.py rebuild_rollups` recomputes everything from the ledger. Both attribute an
+# entry to the city stored on it, the profile's city when it was written, so a rebuild
+# does not move history when a user moves.
+
+COUNTERS = ('collections', 'kg', 'points_issued', 'rewards', 'points_redeemed')
+
+
+def dimensions_for(city=None, agent_id=None):
+    dimensions = ['global']
+    if city:
+        dimensions.append(f'city:{city}')
+    if agent_id:
+        dimensions.append(f'agent:{agent_id}')
+    return dimensions
+
+
+def dimension_key(city=None, agent_id=None):
+    if agent_id:
+        return f'agent:{agent_id}'
+    if city:
+        return f'city:{city}'
+    return 'global'
+
+
+def day_of(moment):
+    return timezone.localdate(moment)
+
+
+def collection_counters(points, plastic):
+    return {'collections': 1, 'kg': plastic, 'points_issued': points}
+
+
+def reward_counters(points):
+    return {'rewards': 1, 'points_redeemed': points}
+
+
+def add(day, dimensions, counters):
+    """Add counters to the rollup row of each dimension for day"""
+    from main.models import DailyRollup
+    increments = {name: F(name) + value for name, value in counters.items()}
+    with transaction.atomic():
+        for dimension in dimensions:
+            if DailyRollup.objects.filter(day=day, dimension=dimension).update(**increments):
+                continue
+            try:
+                with transaction.atomic():
+                    DailyRollup.objects.create(day=day, dimension=dimension, **counters)
+            except IntegrityError:
+                # Created concurrently, fall back to incrementing it
+                DailyRollup.objects.filter(day=day, dimension=dimension).update(**increments)
+
+
+def add_many(rows):
+    """rows of (day, dimensions, counters), merged per (day, dimension) before writing"""
+    merged = defaultdict(lambda: defaultdict(Decimal))
+    for day, dimensions, counters in rows:
+        for dimension in dimensions:
+            for name, value in counters.items():
+                merged[day, dimension][name] += value
+    for (day, dimension), counters in merged.items():
+        add(day, [dimension], counters)
+
+
+def compute(ledger_model, city_field='city'):
+    """All rollup rows as {(day, dimension): counters}, from the ledger alone. Migrations from
+    before the ledger stored the city pass city_field='user__city'"""
+    rows = (ledger_model.objects.filter(reason__in=['Collection', 'Reward'])
+            .values_list('reason', 'created_date', city_field, 'collection__agent_id', 'points', 'plastic')
+            .order_by())
+    totals = defaultdict(lambda: dict.fromkeys(COUNTERS, Decimal(0)))
+    for reason, created_date, city, agent_id, points, plastic in rows.iterator(chunk_size=2000):
+        if reason == 'Collection':
+            dimensions, counters = dimensions_for(city, agent_id), collection_counters(points, plastic)
+        else:
+            # Reward rows carry a negative amount
+            dimensions, counters = dimensions_for(city), reward_counters(-points)
+        for dimension in dimensions:
+            row = totals[day_of(created_date), dimension]
+            for name, value in counters.items():
+                row[name] += value
+    return totals
+
+
+def _zero():
+    return {'collections': 0, 'kg': Decimal(0), 'points_issued': Decimal(0), 'rewards': 0, 'points_redeemed': Decimal(0)}
+
+
+def daily_series(dimension, start, end):
+    """One row per day from start to end inclusive, days without activity are zero"""
+    from main.models import DailyRollup
+    stored = {row['day']: row for row in DailyRollup.objects.filter(dimension=dimension, day__range=(start, end))
+              .values('day', *COUNTERS)}
+    days = []
+    day = start
+    while day <= end:
+        days.append(stored.get(day) or {'day': day, **_zero()})
+        day += timedelta(days=1)
+    return days
+
+
+def range_totals(dimension, start, end):
+    from main.models import DailyRollup
+    return DailyRollup.objects.filter(dimension=dimension, day__range=(start, end)).aggregate(
+        collections=Coalesce(Sum('collections'), 0),
+        **{name: Coalesce(Sum(name), Decimal(0)) for name in ('kg', 'points_issued', 'points_redeemed')},
+        rewards=Coalesce(Sum('rewards'), 0),
+    )
+
+
+def top_dimensions(kind, start, end, limit=10):
+    """Cities or agents with the most kg collected between start and end"""
+    from main.models import DailyRollup
+    prefix = f'{kind}:'
+    rows = (DailyRollup.objects.filter(dimension__startswith=prefix, day__range=(start, end))
+            .values('dimension').annotate(collections=Sum('collections'), kg=Sum('kg'), points_issued=Sum('points_issued'))
+            .order_by('-kg', 'dimension')[:limit])
+    return [{kind: row.pop('dimension')[len(prefix):], **row} for row in rows]
@@ -2,7 +2,7 @@ from django.contrib.auth.models import User
 from ninja import ModelSchema
 from ninja import Schema,Field
 from main.models import UserProfile,PlasticCollection
-from typing import Optional
+from typing import Optional, List
 
 
 class UserSchemaIn(ModelSchema):
@@ -28,22 +28,37 @@ class UserProfileSchemaIn(ModelSchema):
 class UserProfileSchemaOut(ModelSchema):
     user: UserSchemaOut
     profile_pic: Optional[str] = None
+    profile_thumb: Optional[str] = None
+    profile_webp: Optional[str] = None
     class Meta:
         model = UserProfile
-        fields = ["user", "profile_pic", "role", "address", "phone_number", "state", "city", "country", "total_plastic_recycled", "earned_points"]
+        fields = ["user", "profile_pic", "profile_thumb", "profile_webp", "role", "address", "phone_number", "state", "city", "country", "total_plastic_recycled", "earned_points"]
 
 
 class ClientData(ModelSchema):
+    profile_thumb: Optional[str] = None
     class Meta:
         model = UserProfile
-        fields = ["profile_pic", "address", "phone_number", "state", "city", "country"]
+        fields = ["profile_pic", "profile_thumb", "address", "phone_number", "state", "city", "country"]
 
 class ListCollection(ModelSchema):
     user: ClientData
     collection_pic: Optional[str] = None
+    collection_thumb: Optional[str] = None
+    collection_webp: Optional[str] = None
+    distance_km: Optional[float] = None
+    possible_duplicate_of: Optional[int] = None
     class Meta:
         model = PlasticCollection
-        fields = ["id","user", "collection_pic", "amount_collected", "collection_date"]
+        fields = ["id","user", "collection_pic", "collection_thumb", "collection_webp", "amount_collected", "collection_date", "latitude", "longitude", "lease_expires"]
+
+    @staticmethod
+    def resolve_possible_duplicate_of(obj):
+        # Id only, so flagging a row never costs a join
+        return obj.possible_duplicate_of_id
 
 class ErrorSchema(Schema):
-    message: str
\ No newline at end of file
+    message: str
+
+class CollectionIdsSchema(Schema):
+    collection_ids: List[int]
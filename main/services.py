@@ -1,6 +1,15 @@
 from django.contrib.auth.models import User
 from ninja_extra import ModelService
 from django.contrib.auth.hashers import make_password
+from django.db import connection, transaction
+from django.utils import timezone
+from django.db.models import Q, Count, Sum
+from django.db.models.functions import Coalesce
+from decimal import Decimal
+from datetime import datetime, timedelta
+import base64
+from main.models import PlasticCollection, PointsLedger
+from main import geo, versions
 
 class UserModelService(ModelService):
     def create(self, schema, **kwargs):
@@ -19,3 +28,182 @@ class UserModelService(ModelService):
             setattr(instance, attr, value)
         instance.save()
         return instance
+
+
+DISPATCH_LEASE_SECONDS = 120
+
+
+def _open_requests_near(latitude, longitude, radius_km, agent_id=None):
+    # Each covering cell is an index range scan on (status, geohash), the exact
+    # distance check only runs on the handful of rows inside those cells
+    cells = Q()
+    for cell in geo.covering_cells(latitude, longitude, radius_km):
+        lower, upper = geo.prefix_range(cell)
+        cells |= Q(geohash__gte=lower, geohash__lt=upper) if upper else Q(geohash__gte=lower)
+    filters = Q(status='Request') & cells
+    if agent_id is not None:
+        filters &= PlasticCollection.available_to(agent_id)
+    return PlasticCollection.objects.filter(filters).select_related('user')
+
+
+def _nearest(candidates, latitude, longitude, radius_km, limit):
+    nearby = []
+    for collection in candidates:
+        collection.distance_km = geo.haversine_km(latitude, longitude, collection.latitude, collection.longitude)
+        if collection.distance_km <= radius_km:
+            nearby.append(collection)
+    nearby.sort(key=lambda collection: collection.distance_km)
+    return nearby[:limit]
+
+
+def nearest_open_requests(latitude, longitude, radius_km, limit, agent_id=None):
+    """Unclaimed collection requests within radius_km of a point, nearest first. With agent_id,
+    requests reserved by other agents are left out"""
+    candidates = _open_requests_near(latitude, longitude, radius_km, agent_id)
+    return _nearest(candidates, latitude, longitude, radius_km, limit)
+
+
+async def anearest_open_requests(latitude, longitude, radius_km, limit, agent_id=None):
+    """Async version of nearest_open_requests"""
+    candidates = [collection async for collection in _open_requests_near(latitude, longitude, radius_km, agent_id)]
+    return _nearest(candidates, latitude, longitude, radius_km, limit)
+
+
+def dispatch_requests(agent_id, latitude, longitude, radius_km, limit, lease_seconds=DISPATCH_LEASE_SECONDS):
+    """Reserve the agent's next limit nearest open requests for lease_seconds, returns the leased rows.
+    Agents asking at the same time get disjoint rows instead of racing for the same ones"""
+    now = timezone.now()
+    expires = now + timedelta(seconds=lease_seconds)
+    # Over-fetch a little, some candidates may be taken by the time they are leased
+    candidates = nearest_open_requests(latitude, longitude, radius_km, limit * 2, agent_id=agent_id)
+    leasable = Q(status='Request') & PlasticCollection.available_to(agent_id, now)
+    leased = []
+    with transaction.atomic():
+        if connection.features.has_select_for_update_skip_locked:
+            # Rows locked by a concurrent dispatch are skipped rather than waited on
+            free = set(PlasticCollection.objects.select_for_update(skip_locked=True, of=('self',))
+                       .filter(leasable, pk__in=[candidate.pk for candidate in candidates])
+                       .values_list('pk', flat=True))
+            leased = [candidate for candidate in candidates if candidate.pk in free][:limit]
+            PlasticCollection.objects.filter(pk__in=[collection.pk for collection in leased]).update(
+                leased_to_id=agent_id, lease_expires=expires)
+        else:
+            # No row locks (SQLite): each lease is a conditional UPDATE that only one agent can win
+            for candidate in candidates:
+                if PlasticCollection.objects.filter(leasable, pk=candidate.pk).update(leased_to_id=agent_id, lease_expires=expires):
+                    leased.append(candidate)
+                    if len(leased) == limit:
+                        break
+    for collection in leased:
+        collection.leased_to_id, collection.lease_expires = agent_id, expires
+    return leased
+
+
+def _totals_aggregates():
+    aggregates = {}
+    for status in ('Request', 'Pending', 'Collected'):
+        aggregates[f'{status}_count'] = Count('id', filter=Q(status=status))
+        aggregates[f'{status}_kg'] = Coalesce(Sum('amount_collected', filter=Q(status=status)), Decimal(0))
+    return aggregates
+
+
+def _totals(result):
+    return {
+        status.lower(): {'count': result[f'{status}_count'], 'kg': result[f'{status}_kg']}
+        for status in ('Request', 'Pending', 'Collected')
+    }
+
+
+def collection_totals(queryset):
+    """Count and kg per collection status, computed in a single aggregate query"""
+    return _totals(queryset.aggregate(**_totals_aggregates()))
+
+
+async def acollection_totals(queryset):
+    """Async version of collection_totals"""
+    return _totals(await queryset.aaggregate(**_totals_aggregates()))
+
+
+def encode_cursor(date, pk):
+    """Opaque keyset cursor pointing just after the (date, pk) row"""
+    return base64.urlsafe_b64encode(f'{date.isoformat()}|{pk}'.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor, raises ValueError on anything malformed"""
+    try:
+        date, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(date), int(pk)
+    except (TypeError, UnicodeDecodeError, base64.binascii.Error) as e:
+        raise ValueError(str(e))
+
+
+def _batch_results(collection_ids, succeeded, errors):
+    return [{'id': pk, 'ok': True} if pk in succeeded else {'id': pk, 'ok': False, 'error': errors[pk]}
+            for pk in collection_ids]
+
+
+def claim_collections(agent_id, collection_ids):
+    """Claim many open requests for an agent with one conditional UPDATE, returns a result per id"""
+    collection_ids = list(dict.fromkeys(collection_ids))
+    collections = PlasticCollection.objects.filter(pk__in=collection_ids)
+    now = timezone.now()
+    with transaction.atomic():
+        before = dict(collections.values_list('pk', 'status'))
+        collections.filter(Q(status='Request') & PlasticCollection.available_to(agent_id, now)).update(
+            status='Pending', agent_id=agent_id, leased_to=None, lease_expires=None)
+        # Rows another agent claimed or reserved first are left out by the WHERE clause
+        claimed = list(collections.filter(pk__in=[pk for pk, status in before.items() if status == 'Request'],
+                                          status='Pending', agent_id=agent_id)
+                       .only('id', 'user_id', 'agent_id', 'status', 'amount_collected'))
+        versions.bump(*[versions.collections_key(collection.user_id) for collection in claimed])
+        for collection in claimed:
+            collection.publish_status()
+        claimed_ids = {collection.pk for collection in claimed}
+        # Open requests the UPDATE skipped: reserved by another agent, or claimed (even collected)
+        # by a concurrent request since they were read. Report what they are now
+        lost = [pk for pk, status in before.items() if status == 'Request' and pk not in claimed_ids]
+        current = {pk: status for pk, status in before.items() if pk not in lost}
+        current.update(collections.filter(pk__in=lost).values_list('pk', 'status'))
+    errors = {}
+    for pk in collection_ids:
+        status = current.get(pk)
+        if status is None:
+            errors[pk] = 'Collection request not found'
+        elif status == 'Request':
+            errors[pk] = 'Collection request is reserved by another agent'
+        elif status == 'Collected':
+            errors[pk] = 'Collection request already collected'
+        else:
+            errors[pk] = 'Collection request already claimed'
+    return _batch_results(collection_ids, claimed_ids, errors)
+
+
+def collect_collections(agent_id, collection_ids):
+    """Mark many of an agent's pending requests as collected with one conditional UPDATE and
+    credit their clients in bulk, returns a result per id"""
+    collection_ids = list(dict.fromkeys(collection_ids))
+    collections = PlasticCollection.objects.filter(pk__in=collection_ids)
+    with transaction.atomic():
+        before = {pk: (status, agent) for pk, status, agent in collections.values_list('pk', 'status', 'agent_id')}
+        collections.filter(agent_id=agent_id, status='Pending').update(status='Collected')
+        collected = list(collections.filter(pk__in=[pk for pk, (status, agent) in before.items()
+                                                    if status == 'Pending' and agent == agent_id],
+                                            status='Collected', agent_id=agent_id)
+                         .only('id', 'user_id', 'agent_id', 'status', 'amount_collected'))
+        versions.bump(*[versions.collections_key(collection.user_id) for collection in collected])
+        PointsLedger.credit_collections(collected)
+        for collection in collected:
+            collection.publish_status()
+    errors = {}
+    for pk in collection_ids:
+        status, agent = before.get(pk, (None, None))
+        if status is None:
+            errors[pk] = 'Collection request not found'
+        elif agent != agent_id:
+            errors[pk] = 'Collection request is not claimed by this agent'
+        elif status == 'Collected':
+            errors[pk] = 'Collection request already collected'
+        else:
+            errors[pk] = 'Collection request is not pending'
+    return _batch_results(collection_ids, {collection.pk for collection in collected}, errors)
@@ -0,0 +1,81 @@
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models import FileField
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from django.contrib.auth.models import User
+
+from main import catalog, leaderboards, metrics, versions
+from main.auth import accounts
+from main.models import ListReward, PlasticCollection, Reward, UserProfile
+from main.storage import ContentAddressedStorage
+
+
+@receiver(connection_created)
+def count_queries(sender, connection, **kwargs):
+    metrics.instrument(connection)
+
+
+@receiver(post_delete)
+def release_media(sender, instance, **kwargs):
+    """Drop the blob references held by a deleted row's file fields"""
+    for field in sender._meta.concrete_fields:
+        if isinstance(field, FileField) and isinstance(field.storage, ContentAddressedStorage):
+            name = getattr(instance, field.attname)
+            name = getattr(name, 'name', name)
+            if name:
+                field.storage.delete(name)
+
+
+@receiver([post_save, post_delete], sender=ListReward)
+def invalidate_reward_catalog(sender, instance, **kwargs):
+    versions.bump(versions.CATALOG_KEY)
+    transaction.on_commit(catalog.catalog.invalidate)
+
+
+@receiver([post_save, post_delete], sender=Reward)
+def invalidate_claimed_rewards(sender, instance, **kwargs):
+    versions.bump(versions.rewards_key(instance.user_id))
+    transaction.on_commit(lambda: catalog.invalidate_claimed(instance.user_id))
+
+
+@receiver(post_delete, sender=PlasticCollection)
+def bump_collections(sender, instance, **kwargs):
+    # Saves bump in PlasticCollection.save
+    versions.bump(versions.collections_key(instance.user_id))
+
+
+# User fields that are not part of any response, saves of only these leave the profile stamp alone
+UNRENDERED_USER_FIELDS = {'last_login', 'password'}
+
+
+@receiver([post_save, post_delete], sender=User)
+def forget_account(sender, instance, update_fields=None, **kwargs):
+    # Deactivations and deletions take effect immediately in this process, others within the TTL
+    accounts.forget(instance.pk)
+    if update_fields is not None and set(update_fields) <= UNRENDERED_USER_FIELDS:
+        return
+    # The user's fields are part of the profile response
+    versions.bump(*[versions.profile_key(pk) for pk in UserProfile.objects.filter(user_id=instance.pk).values_list('pk', flat=True)])
+
+
+@receiver(pre_save, sender=UserProfile)
+def remember_location(sender, instance, update_fields=None, **kwargs):
+    if instance.pk is None or (update_fields is not None and not {'city', 'state'} & set(update_fields)):
+        instance._previous_location = None
+        return
+    instance._previous_location = UserProfile.objects.filter(pk=instance.pk).values_list('city', 'state').first()
+
+
+@receiver(post_save, sender=UserProfile)
+def relocate_leaderboard_entries(sender, instance, created, **kwargs):
+    previous = getattr(instance, '_previous_location', None)
+    if previous and previous != (instance.city, instance.state):
+        leaderboards.relocate(instance.pk, *previous, instance.city, instance.state)
+
+
+@receiver([post_save, post_delete], sender=UserProfile)
+def forget_profile_account(sender, instance, **kwargs):
+    accounts.forget(instance.user_id)
+    versions.bump(versions.profile_key(instance.pk))
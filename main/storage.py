@@ -0,0 +1,86 @@
+import hashlib
+import os
+import re
+import tempfile
+
+from django.core.files.storage import FileSystemStorage
+from django.db.models import F
+from django.db.models.functions import Greatest
+
+# Content-addressed media storage. Every upload is hashed while it is streamed to a
+# temporary file and stored once as blobs/<aa>/<sha256><ext>; uploading identical bytes
+# again (mobile retries, the shared default picture) reuses the existing blob.
+# MediaBlob.ref_count tracks how many ImageField values point at a blob, orphans are
+# removed by `manage.py gc_media`.
+
+BLOB_DIR = 'blobs'
+_EXTENSION = re.compile(r'^\.[a-z0-9]{1,10}$')
+
+
+def blob_name(digest, extension):
+    return f'{BLOB_DIR}/{digest[:2]}/{digest}{extension}'
+
+
+class ContentAddressedStorage(FileSystemStorage):
+
+    def get_available_name(self, name, max_length=None):
+        # The final name is derived from the content in _save, never from the upload name
+        return name
+
+    def _save(self, name, content):
+        extension = os.path.splitext(name)[1].lower()
+        if not _EXTENSION.match(extension):
+            extension = ''
+
+        tmp_dir = self.path(os.path.join(BLOB_DIR, 'tmp'))
+        os.makedirs(tmp_dir, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                if hasattr(content, 'seek'):
+                    content.seek(0)
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    tmp.write(chunk)
+                    size += len(chunk)
+            name = blob_name(digest.hexdigest(), extension)
+            full_path = self.path(name)
+            if os.path.exists(full_path):
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                if self.file_permissions_mode is not None:
+                    os.chmod(tmp_path, self.file_permissions_mode)
+                # Atomic on the same filesystem, concurrent identical uploads converge on one file
+                os.replace(tmp_path, full_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        self._add_reference(name, digest.hexdigest(), size)
+        return name
+
+    def delete(self, name):
+        # Dropping a reference never removes bytes another row may still point at. Names
+        # outside blobs/ (the shared default pictures, files from before content addressing)
+        # are not reference counted and are left alone, only gc_media removes files
+        if name and name.startswith(BLOB_DIR + '/'):
+            self._remove_reference(name)
+
+    def delete_blob(self, name):
+        """Remove the stored bytes, only gc_media calls this once nothing references the blob"""
+        super().delete(name)
+
+    @staticmethod
+    def _add_reference(name, digest, size):
+        from main.models import MediaBlob
+        MediaBlob.objects.get_or_create(name=name, defaults={'digest': digest, 'size': size})
+        MediaBlob.objects.filter(name=name).update(ref_count=F('ref_count') + 1)
+
+    @staticmethod
+    def _remove_reference(name):
+        from main.models import MediaBlob
+        MediaBlob.objects.filter(name=name).update(ref_count=Greatest(F('ref_count') - 1, 0))
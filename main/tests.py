@@ -1,9 +1,35 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+from io import StringIO, BytesIO
+from PIL import Image
+from unittest import mock
+from django.test import AsyncClient, Client, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from django.utils.http import http_date
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.base import ContentFile
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.exceptions import ValidationError
 from django.urls import reverse
 from django.contrib.auth.models import User
-from main.models import UserProfile
-from ninja_extra.testing import TestAsyncClient
+from django.contrib.auth.hashers import make_password
+from main.models import UserProfile, PlasticCollection, PointsLedger, ListReward, Reward, Notification, MediaBlob, LeaderboardEntry, Badge, Job, DailyRollup, VersionStamp
+from asgiref.sync import async_to_sync
+from ninja.testing.client import NinjaResponse
+from ninja_extra.testing import TestAsyncClient, TestClient
+from ninja_jwt.tokens import RefreshToken, AccessToken
 from main.api import api
+from main.services import collect_collections
+from main import geo, events, images, fingerprints, catalog, leaderboards, badges, jobs, exports, imports, versions, metrics
+from main.auth import accounts
+from main.events import BaseEventBackend, LocalEventBackend, SpoolEventBackend
 
 class UserTests(TestCase):
     def setUp(self):
@@ -71,4 +97,1153 @@ class UserTests(TestCase):
         }
         response = self.client.post(self.login_url, json=login_data)
         self.assertEqual(response.status_code, 400)
-        self.assertEqual(response.json()['error'], 'Invalid credentials')
\ No newline at end of file
+        self.assertEqual(response.json()['error'], 'Invalid credentials')
+
+class MixedClient(TestClient):
+    """TestClient that also runs async routes, from the test's thread so they share its transaction"""
+
+    def _call(self, func, request, kwargs):
+        response = func(request, **kwargs)
+        if asyncio.iscoroutine(response):
+            response = async_to_sync(lambda: response)()
+        return NinjaResponse(response)
+
+
+class APITestMixin:
+    def make_user(self, username, role='Client', city='Pune', state='Maharashtra'):
+        user = User.objects.create_user(username=username, password='testpassword')
+        profile = UserProfile.objects.create(user=user, role=role, city=city, state=state)
+        return profile
+
+    def auth(self, profile):
+        return {'Authorization': f'Bearer {RefreshToken.for_user(profile.user).access_token}'}
+
+
+class NearestRequestsTests(APITestMixin, TestCase):
+    def setUp(self):
+        self.client = MixedClient(api)
+        self.agent = self.make_user('agent', role='Agent')
+        client = self.make_user('client')
+        # Pune centre, ~3 km away, ~8 km away and Mumbai (~120 km away)
+        for lat, lng in [(18.5204, 73.8567), (18.5460, 73.8700), (18.5900, 73.8900), (19.0760, 72.8777)]:
+            PlasticCollection.objects.create(user=client, amount_collected=1, latitude=lat, longitude=lng)
+
+    def test_prefix_range(self):
+        self.assertEqual(geo.prefix_range('tek'), ('tek', 'tem'))
+        self.assertEqual(geo.prefix_range('te9z'), ('te9z', 'teb'))
+        self.assertEqual(geo.prefix_range('zz'), ('zz', None))
+        lower, upper = geo.prefix_range('tek9')
+        self.assertTrue(lower <= geo.encode(18.5204, 73.8567) < upper)
+
+    def test_geohash_is_stored(self):
+        collection = PlasticCollection.objects.first()
+        self.assertEqual(collection.geohash, geo.encode(collection.latitude, collection.longitude))
+
+    def test_nearest_first_within_radius(self):
+        response = self.client.get(f'/agent/{self.agent.user.id}/requests?latitude=18.52&longitude=73.85&radius_km=10',
+                                   headers=self.auth(self.agent))
+        self.assertEqual(response.status_code, 200)
+        distances = [item['distance_km'] for item in response.json()]
+        self.assertEqual(len(distances), 3)
+        self.assertEqual(distances, sorted(distances))
+        self.assertTrue(all(distance <= 10 for distance in distances))
+
+    def dispatch(self, agent, limit):
+        return self.client.post(f'/agent/{agent.user.id}/dispatch?latitude=18.52&longitude=73.85&limit={limit}',
+                                headers=self.auth(agent)).json()
+
+    def test_dispatch_leases_disjoint_rows(self):
+        other = self.make_user('other', role='Agent')
+        mine = [item['id'] for item in self.dispatch(self.agent, 2)]
+        theirs = [item['id'] for item in self.dispatch(other, 2)]
+        self.assertEqual(len(mine), 2)
+        self.assertEqual(len(theirs), 1)
+        self.assertFalse(set(mine) & set(theirs))
+        # Leased rows are hidden from other agents and cannot be claimed by them
+        listed = self.client.get(f'/agent/{other.user.id}/requests?latitude=18.52&longitude=73.85', headers=self.auth(other)).json()
+        self.assertEqual([item['id'] for item in listed], theirs)
+        response = self.client.post(f'/agent/{other.user.id}/claim?collection_id={mine[0]}', headers=self.auth(other))
+        self.assertEqual(response.json()['error'], 'Collection request is reserved by another agent')
+        response = self.client.post(f'/agent/{self.agent.user.id}/claim?collection_id={mine[0]}', headers=self.auth(self.agent))
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(PlasticCollection.objects.get(pk=mine[0]).leased_to)
+
+        # Expired leases go back to the pool
+        PlasticCollection.objects.filter(pk=mine[1]).update(lease_expires=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(sorted(item['id'] for item in self.dispatch(other, 5)), sorted(theirs + [mine[1]]))
+
+
+class PointsLedgerTests(APITestMixin, TestCase):
+    def setUp(self):
+        self.profile = self.make_user('client')
+
+    def test_collection_is_credited_once(self):
+        collection = PlasticCollection.objects.create(user=self.profile, amount_collected=2)
+        collection.status = 'Collected'
+        collection.save()
+        collection.save()
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.earned_points, 20)
+        self.assertEqual(self.profile.total_plastic_recycled, 2)
+        self.assertEqual(PointsLedger.objects.filter(collection=collection).count(), 1)
+
+    def test_reward_debit_and_reconcile(self):
+        collection = PlasticCollection.objects.create(user=self.profile, amount_collected=5, status='Collected')
+        reward = ListReward.objects.create(title='Coupon', points_required=30, reward_type='Offer')
+        Reward.objects.create(user=UserProfile.objects.get(pk=self.profile.pk), reward=reward)
+        with self.assertRaises(ValidationError):
+            other = ListReward.objects.create(title='Cash', points_required=30, reward_type='Cash')
+            Reward.objects.create(user=UserProfile.objects.get(pk=self.profile.pk), reward=other)
+
+        UserProfile.objects.filter(pk=self.profile.pk).update(earned_points=999)
+        call_command('reconcile_points', stdout=StringIO())
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.earned_points, 20)
+        self.assertEqual(self.profile.total_plastic_recycled, 5)
+
+
+class ClientHistoryTests(APITestMixin, TestCase):
+    def setUp(self):
+        self.client = MixedClient(api)
+        self.profile = self.make_user('client')
+        for amount, status in [(1, 'Request'), (2, 'Pending'), (3, 'Collected'), (4, 'Collected')]:
+            PlasticCollection.objects.create(user=self.profile, amount_collected=amount, status=status)
+
+    def test_paginated_history(self):
+        url = f'/client/{self.profile.user.id}/history?limit=3'
+        data = self.client.get(url, headers=self.auth(self.profile)).json()
+        self.assertEqual(sum(len(data[key]) for key in ['unclaimed_requests', 'pending_requests', 'completed_requests']), 3)
+        self.assertEqual(data['next_offset'], 3)
+        data = self.client.get(url + '&offset=3', headers=self.auth(self.profile)).json()
+        self.assertIsNone(data['next_offset'])
+        self.assertNotIn('totals', data)
+
+    def test_history_totals(self):
+        url = f'/client/{self.profile.user.id}/history?include_totals=true'
+        # Authentication, the version stamp, the page and the aggregate
+        with self.assertNumQueries(4):
+            totals = self.client.get(url, headers=self.auth(self.profile)).json()['totals']
+        self.assertEqual(totals['collected']['count'], 2)
+        self.assertEqual(float(totals['collected']['kg']), 7)
+        self.assertEqual(totals['request']['count'], 1)
+
+
+class NotificationInboxTests(APITestMixin, TestCase):
+    def setUp(self):
+        self.client = MixedClient(api)
+        self.profile = self.make_user('client')
+        self.other = self.make_user('other')
+        for i in range(5):
+            Notification.objects.create(user=self.other, to_user=self.profile, message=f'message {i}')
+
+    def test_unread_counter(self):
+        url = f'/notifications/{self.profile.user.id}/unread_count'
+        self.assertEqual(self.client.get(url, headers=self.auth(self.profile)).json()['unread_count'], 5)
+        notification = Notification.objects.first()
+        self.client.patch(f'/notifications/{notification.id}/read', headers=self.auth(self.profile))
+        self.client.patch(f'/notifications/{notification.id}/read', headers=self.auth(self.profile))
+        self.assertEqual(self.client.get(url, headers=self.auth(self.profile)).json()['unread_count'], 4)
+        self.client.patch(f'/notifications/{self.profile.user.id}/read/all', headers=self.auth(self.profile))
+        self.assertEqual(self.client.get(url, headers=self.auth(self.profile)).json()['unread_count'], 0)
+
+    def test_send_notification_increments_counter(self):
+        response = self.client.post(f'/notifications/{self.profile.user.id}/send?message=hello', headers=self.auth(self.other))
+        self.assertEqual(response.status_code, 200)
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.unread_notifications, 6)
+
+    def test_keyset_pagination(self):
+        url = f'/notifications/{self.profile.user.id}/inbox?limit=2'
+        seen = []
+        cursor = None
+        while True:
+            data = self.client.get(url + (f'&cursor={cursor}' if cursor else ''), headers=self.auth(self.profile)).json()
+            seen += [notification['id'] for notification in data['notifications']]
+            cursor = data['next_cursor']
+            if not cursor:
+                break
+        self.assertEqual(seen, list(Notification.objects.order_by('-notification_date', '-id').values_list('id', flat=True)))
+
+    def test_list_notifications(self):
+        data = self.client.get(f'/notifications/{self.profile.user.id}', headers=self.auth(self.profile)).json()
+        self.assertEqual([notification['message'] for notification in data], [f'message {i}' for i in reversed(range(5))])
+        self.assertEqual(set(data[0]), {'id', 'message', 'notification_date', 'is_read'})
+
+    def test_inbox_is_owner_only(self):
+        response = self.client.get(f'/notifications/{self.profile.user.id}/inbox', headers=self.auth(self.other))
+        self.assertEqual(response.status_code, 403)
+
+
+class BroadcastTests(APITestMixin, TestCase):
+    def setUp(self):
+        self.client = TestClient(api)
+        self.agent = self.make_user('agent', role='Agent')
+        self.pune = [self.make_user(f'pune{i}') for i in range(5)]
+        self.delhi = self.make_user('delhi', city='New Delhi', state='Delhi')
+
+    def test_broadcast_to_city_in_chunks(self):
+        backend = RecordingEventBackend()
+        with mock.patch.object(Notification, 'BROADCAST_CHUNK_SIZE', 2), self.assertNumQueries(19):
+            response = self.client.post('/notifications/broadcast?message=Pickup drive on Sunday&city=pune&role=Client',
+                                        headers=self.auth(self.agent))
+        self.assertEqual(response.json()['recipients'], 5)
+        self.assertEqual(set(Notification.objects.values_list('to_user', flat=True)), {profile.id for profile in self.pune})
+        self.assertEqual(set(UserProfile.objects.filter(unread_notifications=1).values_list('id', flat=True)),
+                         {profile.id for profile in self.pune})
+        with mock.patch.object(events, '_backend', backend):
+            jobs.run_pending()
+        self.assertEqual(sorted(channel for channel, _ in backend.published),
+                         sorted(f'profile-{profile.id}' for profile in self.pune))
+
+    def test_broadcast_needs_agent_and_target(self):
+        url = '/notifications/broadcast?message=hello'
+        self.assertEqual(self.client.post(url + '&state=Delhi', headers=self.auth(self.pune[0])).status_code, 403)
+        self.assertEqual(self.client.post(url, headers=self.auth(self.agent)).status_code, 400)
+        self.assertEqual(self.client.post(url + '&state=Delhi', headers=self.auth(self.agent)).json()['recipients'], 1)
+
+
+class RecordingEventBackend(BaseEventBackend):
+    def __init__(self):
+        self.published = []
+
+    def publish(self, channel, event):
+        self.published.append((channel, event['type']))
+
+
+class EventStreamTests(APITestMixin, TestCase):
+    def test_local_backend_fan_out(self):
+        async def scenario():
+            backend = LocalEventBackend()
+            subscription = backend.subscribe('profile-1')
+            threading.Thread(target=backend.publish, args=('profile-1', {'type': 'notification', 'data': {}})).start()
+            event = await subscription.get(timeout=1)
+            subscription.close()
+            return event, backend._subscribers
+        event, subscribers = asyncio.run(scenario())
+        self.assertEqual(event['type'], 'notification')
+        self.assertEqual(subscribers, {})
+
+    def test_spool_backend_across_instances(self):
+        async def scenario(directory):
+            subscription = SpoolEventBackend(directory, poll_interval=0.01).subscribe('profile-1')
+            SpoolEventBackend(directory).publish('profile-1', {'type': 'collection', 'data': {'id': 1}})
+            return await subscription.get(timeout=1), await subscription.get(timeout=0.05)
+        with tempfile.TemporaryDirectory() as directory:
+            event, nothing = asyncio.run(scenario(directory))
+        self.assertEqual(event, {'type': 'collection', 'data': {'id': 1}})
+        self.assertIsNone(nothing)
+
+    def test_sse_stream_formats_events(self):
+        async def scenario():
+            stream = events.sse_stream(7)
+            first = await stream.__anext__()
+            events.get_backend().publish(events.profile_channel(7), {'type': 'notification', 'data': {'id': 3}})
+            second = await stream.__anext__()
+            await stream.aclose()
+            return first, second
+        with mock.patch.object(events, '_backend', LocalEventBackend()):
+            first, second = asyncio.run(scenario())
+        self.assertTrue(first.startswith('retry:'))
+        self.assertEqual(second, 'event: notification\ndata: {"id": 3}\n\n')
+
+    def test_models_publish_on_commit(self):
+        backend = RecordingEventBackend()
+        client, agent = self.make_user('client'), self.make_user('agent', role='Agent')
+        with mock.patch.object(events, '_backend', backend), self.captureOnCommitCallbacks(execute=True):
+            Notification.objects.create(user=agent, to_user=client, message='hello')
+            collection = PlasticCollection.objects.create(user=client, amount_collected=1)
+            collection = PlasticCollection.objects.get(pk=collection.pk)
+            collection.save()
+            collection.status, collection.agent = 'Pending', agent
+            collection.save()
+        self.assertEqual(backend.published, [
+            (f'profile-{client.id}', 'notification'),
+            (f'profile-{client.id}', 'collection'),
+            (f'profile-{client.id}', 'collection'),
+            (f'profile-{agent.id}', 'collection'),
+        ])
+
+
+@override_settings(IMAGE_PIPELINE_WORKERS=0)
+class ImagePipelineTests(APITestMixin, TestCase):
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media.name)
+        self.settings_override.enable()
+        self.client = TestClient(api)
+        self.profile = self.make_user('client')
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.media.cleanup()
+
+    def make_photo(self):
+        image = Image.new('RGB', (4000, 3000), 'green')
+        exif = Image.Exif()
+        exif[0x010F] = 'PhoneMaker'
+        buffer = BytesIO()
+        image.save(buffer, 'JPEG', exif=exif)
+        return SimpleUploadedFile('photo.jpg', buffer.getvalue(), content_type='image/jpeg')
+
+    def test_collection_picture_is_processed(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f'/client/{self.profile.user.id}/collection?amount_collected=2',
+                                        FILES={'pic': self.make_photo()}, headers=self.auth(self.profile))
+        self.assertEqual(response.status_code, 200)
+        collection = PlasticCollection.objects.get()
+        with Image.open(collection.collection_pic.path) as original:
+            self.assertLessEqual(max(original.size), images.ORIGINAL_MAX_SIZE)
+            self.assertFalse(original.getexif())
+        with Image.open(collection.collection_thumb.path) as thumb:
+            self.assertEqual(thumb.format, 'WEBP')
+            self.assertLessEqual(max(thumb.size), 320)
+        self.assertTrue(collection.collection_webp)
+        # The upload is stored once and released once its cleaned copy replaces it
+        self.assertEqual(MediaBlob.objects.count(), 4)
+        self.assertEqual(MediaBlob.objects.filter(ref_count=1).count(), 3)
+        self.assertEqual(MediaBlob.objects.get(name=collection.collection_pic.name).ref_count, 1)
+
+
+    def test_reprocessing_releases_previous_derivatives(self):
+        collection = PlasticCollection.objects.create(user=self.profile, amount_collected=1)
+        collection.collection_pic.save('first.jpg', self.make_photo(), save=False)
+        PlasticCollection.objects.filter(pk=collection.pk).update(collection_pic=collection.collection_pic.name)
+        images.process('main.PlasticCollection', collection.pk, 'collection_pic')
+        first = PlasticCollection.objects.get(pk=collection.pk)
+        buffer = BytesIO()
+        Image.new('RGB', (400, 300), 'blue').save(buffer, 'JPEG')
+        first.collection_pic.save('second.jpg', ContentFile(buffer.getvalue()), save=False)
+        PlasticCollection.objects.filter(pk=collection.pk).update(collection_pic=first.collection_pic.name)
+        images.process('main.PlasticCollection', collection.pk, 'collection_pic')
+        second = PlasticCollection.objects.get(pk=collection.pk)
+        self.assertNotEqual(second.collection_thumb.name, first.collection_thumb.name)
+        for name in (first.collection_thumb.name, first.collection_webp.name):
+            self.assertEqual(MediaBlob.objects.get(name=name).ref_count, 0)
+        self.assertEqual(MediaBlob.objects.get(name=second.collection_thumb.name).ref_count, 1)
+
+    @override_settings(IMAGE_PIPELINE_WORKERS=0)
+    def test_inline_failure_keeps_the_upload(self):
+        with mock.patch.object(images, 'process', side_effect=OSError('truncated')), \
+                self.assertLogs('main.images', 'ERROR'), self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f'/client/{self.profile.user.id}/collection?amount_collected=2',
+                                        FILES={'pic': self.make_photo()}, headers=self.auth(self.profile))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(PlasticCollection.objects.get().collection_pic.name.startswith('blobs/'))
+
+class ContentAddressedStorageTests(APITestMixin, TestCase):
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media.name)
+        self.settings_override.enable()
+        self.profile = self.make_user('client')
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.media.cleanup()
+
+    def upload(self, content=b'same bytes'):
+        collection = PlasticCollection(user=self.profile, amount_collected=1)
+        collection.collection_pic.save('retry.jpg', ContentFile(content))
+        return collection
+
+    def test_identical_uploads_share_one_blob(self):
+        first, second = self.upload(), self.upload()
+        self.assertEqual(first.collection_pic.name, second.collection_pic.name)
+        self.assertTrue(first.collection_pic.name.startswith('blobs/'))
+        blob = MediaBlob.objects.get()
+        self.assertEqual(blob.ref_count, 2)
+        first.delete()
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 1)
+        self.assertTrue(os.path.exists(second.collection_pic.path))
+
+    def test_gc_removes_orphans_only(self):
+        kept = self.upload(b'kept')
+        orphan = self.upload(b'orphan')
+        path = orphan.collection_pic.path
+        # Replaced without going through delete(), only a recount can notice
+        PlasticCollection.objects.filter(pk=orphan.pk).update(collection_pic='default.jpg')
+        call_command('gc_media', '--grace-hours=0', stdout=StringIO())
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(os.path.exists(kept.collection_pic.path))
+        self.assertEqual(list(MediaBlob.objects.values_list('name', 'ref_count')), [(kept.collection_pic.name, 1)])
+
+
+    def test_deleting_rows_keeps_default_pictures(self):
+        for name in ('profile_pics/default.jpg', 'default.jpg'):
+            os.makedirs(os.path.dirname(os.path.join(self.media.name, name)), exist_ok=True)
+            with open(os.path.join(self.media.name, name), 'wb') as file:
+                file.write(b'default')
+        PlasticCollection.objects.create(user=self.profile, amount_collected=1)
+        self.assertEqual(self.profile.profile_pic.name, 'profile_pics/default.jpg')
+        self.profile.user.delete()
+        self.assertTrue(os.path.exists(os.path.join(self.media.name, 'profile_pics/default.jpg')))
+        self.assertTrue(os.path.exists(os.path.join(self.media.name, 'default.jpg')))
+
+class PhotoFingerprintTests(APITestMixin, TestCase):
+    def setUp(self):
+        self.profile = self.make_user('client')
+
+    def photo(self, seed):
+        # Random coarse blocks: re-encodes keep their gradients, different seeds do not share them
+        rng = random.Random(seed)
+        blocks = Image.new('L', (16, 12))
+        blocks.putdata([rng.randrange(256) for _ in range(16 * 12)])
+        return blocks.resize((400, 300), Image.NEAREST).convert('RGB')
+
+    def reencode(self, image, size):
+        buffer = BytesIO()
+        image.resize(size).save(buffer, 'JPEG', quality=60)
+        return Image.open(BytesIO(buffer.getvalue()))
+
+    def test_chunks_cover_hash(self):
+        value = 0xF0F0_1234_ABCD_0001
+        parts = fingerprints.chunks(value)
+        rebuilt = 0
+        for bits, part in zip(fingerprints.CHUNK_BITS, parts):
+            rebuilt = (rebuilt << bits) | part
+        self.assertEqual(rebuilt, value)
+
+    def test_resubmitted_photo_is_flagged(self):
+        original, other = self.photo(7), self.photo(101)
+        first, second, third = [PlasticCollection.objects.create(user=self.profile, amount_collected=1) for _ in range(3)]
+        self.assertEqual(fingerprints.index_collection(first.id, original), [])
+        self.assertEqual(fingerprints.index_collection(third.id, other), [])
+        matches = fingerprints.index_collection(second.id, self.reencode(original, (320, 240)))
+        self.assertEqual(matches[0][1], first.id)
+        second.refresh_from_db()
+        self.assertEqual(second.possible_duplicate_of_id, first.id)
+        self.assertIsNone(PlasticCollection.objects.get(pk=third.pk).possible_duplicate_of_id)
+
+
+class RewardCatalogTests(APITestMixin, TestCase):
+    def setUp(self):
+        self.client = TestClient(api)
+        catalog.catalog.invalidate()
+        cache.clear()
+        self.profile = self.make_user('client')
+        UserProfile.objects.filter(pk=self.profile.pk).update(earned_points=50)
+        self.cheap = ListReward.objects.create(title='Cheap', points_required=10, reward_type='Offer')
+        self.mid = ListReward.objects.create(title='Mid', points_required=50, reward_type='Offer')
+        ListReward.objects.create(title='Dear', points_required=500, reward_type='Cash')
+        self.url = f'/client/{self.profile.user.id}/rewards'
+
+    def claimable(self):
+        return [reward['name'] for reward in self.client.get(self.url, headers=self.auth(self.profile)).json()]
+
+    def test_claimable_rewards_are_cached(self):
+        self.assertEqual(self.claimable(), ['Cheap', 'Mid'])
+        # Only the version stamps and the balance lookup
+        with self.assertNumQueries(2):
+            self.assertEqual(self.claimable(), ['Cheap', 'Mid'])
+
+    def test_catalog_and_claims_invalidate(self):
+        self.assertEqual(self.claimable(), ['Cheap', 'Mid'])
+        with self.captureOnCommitCallbacks(execute=True):
+            Reward.objects.create(user=UserProfile.objects.get(pk=self.profile.pk), reward=self.cheap)
+            ListReward.objects.create(title='New', points_required=5, reward_type='Offer')
+        self.assertEqual(self.claimable(), ['New'])
+
+
+class ProfileTokenAuthTests(APITestMixin, TestCase):
+    def setUp(self):
+        self.client = MixedClient(api)
+        self.profile = self.make_user('client')
+
+    def login(self):
+        response = self.client.post('/user/login', json={'username': 'client', 'password': 'testpassword'})
+        return {'Authorization': f"Bearer {response.json()['access']}"}
+
+    def test_login_token_carries_profile_claims(self):
+        headers = self.login()
+        token = AccessToken(headers['Authorization'].split()[1])
+        self.assertEqual(token['profile_id'], self.profile.id)
+        self.assertEqual(token['role'], 'Client')
+
+    def test_login_hashes_off_the_event_loop(self):
+        from main import api as api_module
+        # A sync handler: under ASGI the password hash runs in a thread, not on the event loop
+        self.assertFalse(asyncio.iscoroutinefunction(api_module.login))
+
+    def test_owner_and_role_checks_are_query_free(self):
+        headers = self.login()
+        url = f'/client/{self.profile.user.id}/badges'
+        self.client.get(url, headers=headers)
+        # Just the badge query: no user fetch, no profile lookup
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(url, headers=headers).status_code, 200)
+        other = self.make_user('other')
+        self.assertEqual(self.client.get(f'/client/{other.user.id}/badges', headers=headers).status_code, 403)
+        self.assertEqual(self.client.get(f'/agent/{self.profile.user.id}/history', headers=headers).status_code, 403)
+
+    def test_deactivated_user_is_rejected(self):
+        headers = self.login()
+        User.objects.filter(pk=self.profile.user.pk).update(is_active=False)
+        # Revocation is picked up once the cached account expires (or is evicted by a save signal)
+        accounts.forget(self.profile.user.pk)
+        self.assertEqual(self.client.get(f'/client/{self.profile.user.id}', headers=headers).status_code, 401)
+
+
+    def test_demotion_overrides_token_claims(self):
+        UserProfile.objects.filter(pk=self.profile.pk).update(role='Agent')
+        accounts.forget(self.profile.user.pk)
+        headers = self.login()
+        self.assertEqual(AccessToken(headers['Authorization'].split()[1])['role'], 'Agent')
+        url = f'/agent/{self.profile.user.id}/history'
+        self.assertEqual(self.client.get(url, headers=headers).status_code, 200)
+        self.profile.refresh_from_db()
+        self.profile.role = 'Client'
+        self.profile.save()
+        self.assertEqual(self.client.get(url, headers=headers).status_code, 403)
+
+class LeaderboardTests(APITestMixin, TestCase):
+    def setUp(self):
+        self.client = TestClient(api)
+        leaderboards.reset_rank_indexes()
+        self.pune = [self.make_user(f'pune{i}') for i in range(3)]
+        self.delhi = self.make_user('delhi', city='New Delhi', state='Delhi')
+        for profile, kg in zip(self.pune + [self.delhi], [1, 5, 3, 10]):
+            PlasticCollection.objects.create(user=profile, amount_collected=kg, status='Collected')
+
+    def top(self, **params):
+        query = '&'.join(f'{key}={value}' for key, value in params.items())
+        return self.client.get(f'/leaderboard?{query}').json()
+
+    def rank(self, profile, **params):
+        query = '&'.join(f'{key}={value}' for key, value in params.items())
+        return self.client.get(f'/leaderboard/{profile.user.id}/rank?{query}', headers=self.auth(profile)).json()
+
+    def test_top_and_rank_follow_collections(self):
+        self.assertEqual([row['username'] for row in self.top()], ['delhi', 'pune1', 'pune2', 'pune0'])
+        self.assertEqual([row['username'] for row in self.top(city='Pune', metric='plastic')], ['pune1', 'pune2', 'pune0'])
+        self.assertEqual(self.rank(self.pune[0])['rank'], 4)
+        self.assertEqual(self.rank(self.pune[0], scope='city'), {'board': 'city:Pune', 'rank': 3, 'score': '10.00', 'total': 3})
+        PlasticCollection.objects.create(user=self.pune[0], amount_collected=20, status='Collected')
+        self.assertEqual(self.rank(self.pune[0])['rank'], 1)
+        self.assertEqual(self.top(limit=1)[0]['username'], 'pune0')
+
+    def test_rebuild_matches_incremental(self):
+        before = sorted(LeaderboardEntry.objects.values_list('board', 'metric', 'profile', 'score'))
+        LeaderboardEntry.objects.all().delete()
+        call_command('rebuild_leaderboards', stdout=StringIO())
+        self.assertEqual(sorted(LeaderboardEntry.objects.values_list('board', 'metric', 'profile', 'score')), before)
+
+
+    def test_moving_takes_the_score_along(self):
+        mover = self.pune[1]
+        self.assertEqual(self.rank(mover, scope='city')['rank'], 1)
+        mover.city, mover.state = 'New Delhi', 'Delhi'
+        with self.captureOnCommitCallbacks(execute=True):
+            mover.save()
+        self.assertFalse(LeaderboardEntry.objects.filter(profile=mover, board__in=['city:Pune', 'state:Maharashtra']).exists())
+        self.assertEqual(self.rank(mover, scope='city'), {'board': 'city:New Delhi', 'rank': 2, 'score': '50.00', 'total': 2})
+        self.assertEqual([row['username'] for row in self.top(city='Pune')], ['pune2', 'pune0'])
+        before = sorted(LeaderboardEntry.objects.values_list('board', 'metric', 'profile', 'score'))
+        call_command('rebuild_leaderboards', stdout=StringIO())
+        self.assertEqual(sorted(LeaderboardEntry.objects.values_list('board', 'metric', 'profile', 'score')), before)
+
+class BadgeAwardTests(APITestMixin, TestCase):
+    def setUp(self):
+        # Credits made by the test are settled right away
+        patcher = mock.patch.object(badges, 'SETTLE_SECONDS', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.heavy = self.make_user('heavy')
+        self.light = self.make_user('light')
+        self.idle = self.make_user('idle')
+        PlasticCollection.objects.create(user=self.heavy, amount_collected=60, status='Collected')
+        PlasticCollection.objects.create(user=self.light, amount_collected=2, status='Collected')
+        PlasticCollection.objects.create(user=self.idle, amount_collected=2, status='Pending')
+
+    def awarded(self):
+        return set(Badge.objects.values_list('user__user__username', 'name'))
+
+    def test_awards_only_touched_profiles_once(self):
+        self.assertEqual(badges.award_pending(), (2, 3))
+        self.assertEqual(self.awarded(), {('heavy', 'Recycler'), ('heavy', 'Eco Warrior'), ('light', 'Recycler')})
+        self.heavy.refresh_from_db()
+        self.assertEqual(self.heavy.unread_notifications, 2)
+        self.assertEqual(Notification.objects.filter(to_user=self.heavy, importance_level='Medium').count(), 2)
+
+        # Nothing new in the ledger, nothing to evaluate
+        self.assertEqual(badges.award_pending(), (0, 0))
+        PlasticCollection.objects.create(user=self.light, amount_collected=50, status='Collected')
+        out = StringIO()
+        call_command('award_badges', stdout=out)
+        self.assertIn('Processed 1 credits, awarded 1 badges', out.getvalue())
+        self.assertIn(('light', 'Eco Warrior'), self.awarded())
+        self.assertEqual(Badge.objects.count(), 4)
+
+    def test_weekly_streak(self):
+        today = timezone.now()
+        for weeks_ago in (1, 2, 3):
+            collection = PlasticCollection.objects.create(user=self.light, amount_collected=1, status='Collected')
+            PointsLedger.objects.filter(collection=collection).update(created_date=today - timedelta(weeks=weeks_ago))
+        badges.award_pending()
+        self.assertIn(('light', 'Sustainability Hero'), self.awarded())
+        self.assertNotIn(('heavy', 'Sustainability Hero'), self.awarded())
+        self.assertEqual(badges.longest_streak([date(2026, 1, 5), date(2026, 1, 19), date(2026, 1, 26)]), 2)
+
+    def test_waits_for_unsettled_credits(self):
+        heavy, light = PointsLedger.objects.filter(reason='Collection').order_by('id')
+        now = timezone.now()
+        # A credit that may still be uncommitted elsewhere holds back itself and every id after it
+        PointsLedger.objects.filter(pk=heavy.pk).update(created_date=now - timedelta(seconds=5))
+        PointsLedger.objects.filter(pk=light.pk).update(created_date=now - timedelta(seconds=60))
+        Job.objects.all().delete()
+        with mock.patch.object(badges, 'SETTLE_SECONDS', 30):
+            self.assertEqual(badges.award_pending(), (0, 0))
+            self.assertEqual(self.awarded(), set())
+            self.assertTrue(Job.objects.filter(key='award-badges', status='Queued').exists())
+            PointsLedger.objects.filter(pk=heavy.pk).update(created_date=now - timedelta(seconds=60))
+            self.assertEqual(badges.award_pending(), (2, 3))
+
+
+JOB_CALLS = []
+
+
+def record_job(value):
+    JOB_CALLS.append(value)
+
+
+def failing_job():
+    raise RuntimeError('boom')
+
+
+def slow_job(seconds):
+    """Outlives its initial lease, then checks whether another worker could take it over"""
+    time.sleep(seconds)
+    return jobs.claim(10)
+
+
+class JobQueueTests(APITestMixin, TestCase):
+    def setUp(self):
+        JOB_CALLS.clear()
+
+    def test_priority_order_and_keyed_enqueue(self):
+        jobs.enqueue('main.tests.record_job', 'low')
+        jobs.enqueue('main.tests.record_job', 'high', priority=5)
+        self.assertIsNotNone(jobs.enqueue('main.tests.record_job', 'keyed', key='once'))
+        self.assertIsNone(jobs.enqueue('main.tests.record_job', 'keyed again', key='once'))
+        jobs.enqueue('main.tests.record_job', 'later', delay=3600)
+        self.assertEqual(jobs.run_pending(), 3)
+        self.assertEqual(JOB_CALLS, ['high', 'low', 'keyed'])
+        self.assertEqual(Job.objects.filter(status='Done').count(), 3)
+
+    def test_failures_back_off_then_fail(self):
+        job = jobs.enqueue('main.tests.failing_job', max_attempts=2)
+        with self.assertLogs('main.jobs', 'ERROR'):
+            jobs.run_pending()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('Queued', 1))
+        self.assertGreater(job.run_after, timezone.now())
+        self.assertIn('boom', job.last_error)
+        Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+        with self.assertLogs('main.jobs', 'ERROR'):
+            jobs.run_pending()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('Failed', 2))
+
+    def test_expired_lease_is_reclaimed(self):
+        job = jobs.enqueue('main.tests.record_job', 'x')
+        self.assertEqual(jobs.claim(10), [job.pk])
+        self.assertEqual(jobs.claim(10), [])
+        Job.objects.filter(pk=job.pk).update(locked_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(jobs.claim(10), [job.pk])
+        jobs.execute(job.pk)
+        self.assertEqual(JOB_CALLS, ['x'])
+
+    def test_failed_retry_superseded_by_queued_key(self):
+        job = jobs.enqueue('main.tests.failing_job', key='rebuild')
+        self.assertEqual(jobs.claim(10), [job.pk])
+        # Enqueued again while the first run is in progress
+        queued = jobs.enqueue('main.tests.failing_job', key='rebuild')
+        self.assertIsNotNone(queued)
+        jobs.execute(job.pk)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'Failed')
+        self.assertIn('superseded', job.last_error)
+        self.assertEqual(Job.objects.get(pk=queued.pk).status, 'Queued')
+
+    def test_collection_credit_queues_one_badge_run(self):
+        profile = self.make_user('client')
+        PlasticCollection.objects.create(user=profile, amount_collected=1, status='Collected')
+        PlasticCollection.objects.create(user=profile, amount_collected=1, status='Collected')
+        self.assertEqual(Job.objects.filter(key='award-badges', status='Queued').count(), 1)
+        # As when the run comes due, AWARD_DELAY_SECONDS after the credits
+        Job.objects.update(run_after=timezone.now())
+        PointsLedger.objects.update(created_date=timezone.now() - timedelta(seconds=badges.AWARD_DELAY_SECONDS))
+        out = StringIO()
+        call_command('run_jobs', '--once', stdout=out)
+        self.assertIn('Ran 1 jobs', out.getvalue())
+        self.assertTrue(Badge.objects.filter(user=profile, name='Recycler').exists())
+
+
+
+class JobLeaseTests(TransactionTestCase):
+    # Committed rows: the lease is renewed from the heartbeat thread's own connection
+
+    def test_lease_renewed_while_the_task_runs(self):
+        job = jobs.enqueue('main.tests.slow_job', 1.0, max_attempts=1)
+        with mock.patch.object(jobs, 'LEASE_SECONDS', 0.3):
+            self.assertEqual(jobs.claim(10, lease=0.3), [job.pk])
+            jobs.execute(job.pk)
+        job.refresh_from_db()
+        # Not reclaimed mid-run, and the outcome of the one run is recorded
+        self.assertEqual((job.status, job.attempts, job.result), ('Done', 1, []))
+
+    def test_long_user_import_keeps_its_report(self):
+        hashed = make_password('secret')
+
+        def slow_hash(password):
+            time.sleep(0.2)
+            return hashed
+
+        rows = ''.join(f'user{number},secret,Client\n' for number in range(5))
+        with tempfile.TemporaryDirectory() as uploads, override_settings(IMPORTS_DIR=uploads), \
+                mock.patch.object(jobs, 'LEASE_SECONDS', 0.3), mock.patch.object(imports, 'make_password', slow_hash):
+            name = imports.upload_storage().save('users.csv', ContentFile(f'username,password,role\n{rows}'.encode()))
+            job = jobs.enqueue('main.imports.import_file', name, 'users', 'csv', workers=0, max_attempts=1)
+            self.assertEqual(jobs.claim(10, lease=0.3), [job.pk])
+            # Another worker polling while the import hashes for longer than the lease
+            poller = threading.Timer(0.8, lambda: claimed.extend(jobs.claim(10)))
+            claimed = []
+            poller.start()
+            jobs.execute(job.pk)
+            poller.join()
+        job.refresh_from_db()
+        self.assertEqual(claimed, [])
+        self.assertEqual((job.status, job.result['created']), ('Done', 5))
+
+class AgentBatchTests(APITestMixin, TestCase):
+    def setUp(self):
+        self.client = TestClient(api)
+        self.agent = self.make_user('agent', role='Agent')
+        self.rival = self.make_user('rival', role='Agent')
+        self.clients = [self.make_user(f'client{i}') for i in range(2)]
+        self.requests = [PlasticCollection.objects.create(user=self.clients[i % 2], amount_collected=i + 1) for i in range(4)]
+
+    def batch(self, agent, action, ids):
+        method = self.client.post if action == 'claim' else self.client.patch
+        return method(f'/agent/{agent.user.id}/{action}/batch', json={'collection_ids': ids}, headers=self.auth(agent)).json()
+
+    def test_claim_then_collect_in_batches(self):
+        first, second, third, fourth = [collection.id for collection in self.requests]
+        self.batch(self.rival, 'claim', [fourth])
+        claimed = self.batch(self.agent, 'claim', [first, second, third, fourth, 999])
+        self.assertEqual(claimed['claimed'], 3)
+        self.assertEqual([result['ok'] for result in claimed['results']], [True, True, True, False, False])
+        self.assertEqual(claimed['results'][3]['error'], 'Collection request already claimed')
+
+        collected = self.batch(self.agent, 'collect', [first, second, fourth])
+        self.assertEqual(collected['collected'], 2)
+        self.assertEqual(collected['results'][2]['error'], 'Collection request is not claimed by this agent')
+        # Collections of 1 kg and 2 kg, one per client
+        points = dict(UserProfile.objects.filter(pk__in=[c.pk for c in self.clients]).values_list('id', 'earned_points'))
+        self.assertEqual(points, {self.clients[0].pk: 10, self.clients[1].pk: 20})
+        self.assertEqual(PointsLedger.objects.filter(reason='Collection').count(), 2)
+        self.assertEqual(LeaderboardEntry.objects.filter(board='global', metric='points', profile=self.clients[1]).get().score, 20)
+
+        again = self.batch(self.agent, 'collect', [first])
+        self.assertEqual(again['results'][0]['error'], 'Collection request already collected')
+        self.assertEqual(PointsLedger.objects.filter(reason='Collection').count(), 2)
+
+    def test_claim_lost_to_a_concurrent_request(self):
+        first = self.requests[0].id
+        available_to = PlasticCollection.available_to
+
+        def rival_claims_first(agent_id, now):
+            # Another request claims and collects between the read and the conditional UPDATE
+            PlasticCollection.objects.filter(pk=first).update(status='Collected', agent_id=self.rival.pk)
+            return available_to(agent_id, now)
+
+        with mock.patch.object(PlasticCollection, 'available_to', side_effect=rival_claims_first):
+            result = self.batch(self.agent, 'claim', [first])
+        self.assertEqual(result['results'][0]['error'], 'Collection request already collected')
+
+    def test_batch_size_is_bounded(self):
+        response = self.client.post(f'/agent/{self.agent.user.id}/claim/batch', json={'collection_ids': []},
+                                    headers=self.auth(self.agent))
+        self.assertEqual(response.status_code, 400)
+
+
+class RollupTests(APITestMixin, TestCase):
+    def setUp(self):
+        self.client = TestClient(api)
+        self.agent = self.make_user('agent', role='Agent')
+        self.pune = self.make_user('pune')
+        self.delhi = self.make_user('delhi', city='New Delhi', state='Delhi')
+        self.admin = self.make_user('admin')
+        User.objects.filter(pk=self.admin.user_id).update(is_superuser=True, is_staff=True)
+        PlasticCollection.objects.create(user=self.pune, agent=self.agent, amount_collected=3, status='Collected')
+        batch = [PlasticCollection.objects.create(user=profile, amount_collected=2, status='Pending', agent=self.agent)
+                 for profile in (self.pune, self.delhi)]
+        collect_collections(self.agent.pk, [collection.pk for collection in batch])
+        Reward.objects.create(user=self.pune, reward=ListReward.objects.create(title='Bag', points_required=40))
+
+    def rollup(self, dimension):
+        return DailyRollup.objects.filter(dimension=dimension).values('collections', 'kg', 'points_issued', 'rewards', 'points_redeemed').get()
+
+    def test_incremental_rollups_match_rebuild(self):
+        self.assertEqual(self.rollup('global'), {'collections': 3, 'kg': 7, 'points_issued': 70, 'rewards': 1, 'points_redeemed': 40})
+        self.assertEqual(self.rollup('city:Pune')['kg'], 5)
+        self.assertEqual(self.rollup(f'agent:{self.agent.pk}')['collections'], 3)
+        before = sorted(DailyRollup.objects.values_list('day', 'dimension', 'collections', 'kg', 'points_issued', 'rewards', 'points_redeemed'))
+        DailyRollup.objects.all().delete()
+        call_command('rebuild_rollups', stdout=StringIO())
+        after = sorted(DailyRollup.objects.values_list('day', 'dimension', 'collections', 'kg', 'points_issued', 'rewards', 'points_redeemed'))
+        self.assertEqual(after, before)
+
+    def test_rebuild_keeps_city_history_after_a_move(self):
+        self.pune.city, self.pune.state = 'New Delhi', 'Delhi'
+        self.pune.save()
+        PlasticCollection.objects.create(user=self.pune, amount_collected=4, status='Collected')
+        # Credited before the move stay with Pune, the new one goes to New Delhi
+        self.assertEqual(self.rollup('city:Pune')['kg'], 5)
+        self.assertEqual(self.rollup('city:New Delhi')['kg'], 6)
+        before = sorted(DailyRollup.objects.values_list('day', 'dimension', 'collections', 'kg', 'points_issued', 'rewards', 'points_redeemed'))
+        call_command('rebuild_rollups', stdout=StringIO())
+        after = sorted(DailyRollup.objects.values_list('day', 'dimension', 'collections', 'kg', 'points_issued', 'rewards', 'points_redeemed'))
+        self.assertEqual(after, before)
+
+    def test_analytics_endpoints_read_rollups(self):
+        today = timezone.localdate()
+        with self.assertNumQueries(3):
+            response = self.client.get(f'/analytics/daily?start={today - timedelta(days=6)}&city=Pune', headers=self.auth(self.admin))
+        data = response.json()
+        self.assertEqual(len(data['days']), 7)
+        self.assertEqual(data['totals']['collections'], 2)
+        top = self.client.get('/analytics/top?by=city', headers=self.auth(self.admin)).json()
+        self.assertEqual([row['city'] for row in top], ['Pune', 'New Delhi'])
+        self.assertEqual(self.client.get('/analytics/daily', headers=self.auth(self.agent)).status_code, 403)
+        self.assertEqual(self.client.get(f'/analytics/daily?start={today}&end={today - timedelta(days=1)}',
+                                         headers=self.auth(self.admin)).status_code, 400)
+
+    def test_admin_index_shows_rollups(self):
+        browser = Client()
+        browser.force_login(self.admin.user)
+        response = browser.get('/admin/')
+        self.assertContains(response, 'Kg collected, last 30 days')
+        self.assertContains(response, 'New Delhi')
+
+
+class ExportTests(APITestMixin, TestCase):
+    def setUp(self):
+        self.client = TestClient(api)
+        self.admin = self.make_user('admin')
+        User.objects.filter(pk=self.admin.user_id).update(is_superuser=True)
+        self.pune = self.make_user('pune')
+        self.delhi = self.make_user('delhi', city='New Delhi', state='Delhi')
+        for i in range(5):
+            PlasticCollection.objects.create(user=self.pune if i % 2 else self.delhi, amount_collected=i + 1,
+                                             status='Collected' if i < 2 else 'Request')
+
+    def test_csv_and_ndjson_with_filters(self):
+        response = self.client.get('/exports/collections?status=Request&state=delhi', headers=self.auth(self.admin))
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertTrue(response.streaming)
+        lines = response.content.decode().splitlines()
+        self.assertEqual(lines[0].split(',')[:3], ['id', 'client', 'city'])
+        self.assertEqual(len(lines), 3)
+        response = self.client.get('/exports/users?format=ndjson&status=Client&state=Delhi', headers=self.auth(self.admin))
+        rows = [json.loads(line) for line in response.content.decode().splitlines()]
+        self.assertEqual([row['username'] for row in rows], ['delhi'])
+        self.assertEqual(self.client.get('/exports/collections', headers=self.auth(self.pune)).status_code, 403)
+
+    def test_export_is_chunked(self):
+        chunks = list(exports.stream('collections', 'ndjson', chunk_size=2, start=timezone.localdate()))
+        self.assertEqual([chunk.count('\n') for chunk in chunks], [2, 2, 1])
+        out = StringIO()
+        call_command('export_data', 'rewards', stdout=out)
+        self.assertEqual(out.getvalue().strip(), 'id,client,state,reward,points,claimed_date')
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class BulkImportTests(APITestMixin, TestCase):
+    def setUp(self):
+        self.client = TestClient(api)
+        self.admin = self.make_user('admin')
+        User.objects.filter(pk=self.admin.user_id).update(is_superuser=True)
+
+    def test_users_import_reports_rejects(self):
+        source = StringIO(
+            'username,password,first_name,role,state,city\n'
+            'asha,secret,Asha,Client,Maharashtra,Pune\n'
+            'ravi,secret,Ravi,Agent,Delhi,New Delhi\n'
+            'admin,secret,Dup,Client,,\n'
+            'asha,secret,Again,Client,,\n'
+            'nopass,,No,Client,,\n'
+            'meera,secret,Meera,Client,Delhi,Pune\n'
+        )
+        report = imports.run_import('users', source, 'csv', workers=0, chunk_size=4)
+        self.assertEqual(report['created'], 2)
+        self.assertEqual(sorted((reject['line'], reject['error']) for reject in report['rejects']), [
+            (4, 'username already exists'), (5, 'duplicate username in file'),
+            (6, 'password is required'), (7, 'unknown city Pune'),
+        ])
+        ravi = UserProfile.objects.select_related('user').get(user__username='ravi')
+        self.assertEqual((ravi.role, ravi.city, ravi.user.first_name), ('Agent', 'New Delhi', 'Ravi'))
+        self.assertTrue(ravi.user.check_password('secret'))
+
+    def test_rewards_import_through_job(self):
+        upload = SimpleUploadedFile('rewards.ndjson', b'{"title": "Bag", "points_required": 50, "reward_type": "Offer"}\n'
+                                                      b'not json\n{"title": "Cup", "points_required": -1, "reward_type": "Cash"}\n')
+        with tempfile.TemporaryDirectory() as media, tempfile.TemporaryDirectory() as uploads, \
+                override_settings(MEDIA_ROOT=media, IMPORTS_DIR=uploads):
+            response = self.client.post('/imports/rewards?format=ndjson', FILES={'file': upload}, headers=self.auth(self.admin))
+            job_id = response.json()['job_id']
+            # Waiting in the private directory, nothing under MEDIA_ROOT or in the blob table
+            self.assertEqual(os.listdir(uploads), ['rewards.ndjson'])
+            self.assertEqual(os.listdir(media), [])
+            self.assertFalse(MediaBlob.objects.exists())
+            jobs.run_pending()
+            self.assertEqual(os.listdir(uploads), [])
+        status = self.client.get(f'/imports/jobs/{job_id}', headers=self.auth(self.admin)).json()
+        self.assertEqual(status['status'], 'Done')
+        self.assertEqual(status['result']['created'], 1)
+        self.assertEqual([reject['line'] for reject in status['result']['rejects']], [2, 3])
+        self.assertEqual(list(ListReward.objects.values_list('title', flat=True)), ['Bag'])
+
+
+class SQLiteProductionModeTests(TestCase):
+    def test_off_by_default(self):
+        from django.conf import settings
+        from django.db import connection
+        self.assertFalse(settings.SQLITE_PRODUCTION_MODE)
+        if connection.vendor == 'sqlite':
+            self.assertEqual(connection.settings_dict['OPTIONS'], {})
+
+    def test_pragmas_applied_on_connection(self):
+        from django.conf import settings
+        from django.db import connection
+        from django.db.backends.sqlite3.base import DatabaseWrapper
+        if connection.vendor != 'sqlite':
+            self.skipTest("SQLite only")
+        with tempfile.TemporaryDirectory() as directory:
+            production = DatabaseWrapper({**connection.settings_dict, 'NAME': os.path.join(directory, 'db.sqlite3'),
+                                          'OPTIONS': settings.SQLITE_PRODUCTION_OPTIONS})
+            try:
+                with production.cursor() as cursor:
+                    cursor.execute('PRAGMA journal_mode')
+                    self.assertEqual(cursor.fetchone()[0], 'wal')
+                    cursor.execute('PRAGMA synchronous')
+                    self.assertEqual(cursor.fetchone()[0], 1)
+                    cursor.execute('PRAGMA cache_size')
+                    self.assertEqual(cursor.fetchone()[0], -20000)
+                self.assertEqual(production.transaction_mode, 'IMMEDIATE')
+            finally:
+                production.close()
+
+
+class ResponseEncodingTests(APITestMixin, TestCase):
+    def setUp(self):
+        self.profile = self.make_user('client')
+        for i in range(40):
+            Notification.objects.create(user=self.profile, to_user=self.profile, message=f'Your collection request #{i} was collected')
+
+    def test_orjson_renderer(self):
+        from decimal import Decimal
+        from main.renderers import dumps
+        moment = timezone.now().replace(microsecond=123456)
+        self.assertEqual(json.loads(dumps({'kg': Decimal('2.50'), 'at': moment, 'day': moment.date()})),
+                         {'kg': '2.50', 'at': moment.isoformat().replace('+00:00', 'Z'), 'day': moment.date().isoformat()})
+
+    def inbox(self, accept_encoding):
+        # Through the full middleware stack, not TestClient
+        return Client().get(f'/api/notifications/{self.profile.user.id}/inbox?limit=40',
+                            headers={'Accept-Encoding': accept_encoding, **self.auth(self.profile)})
+
+    def test_negotiated_compression(self):
+        import gzip
+        from main import middleware
+        plain = self.inbox('')
+        self.assertNotIn('Content-Encoding', plain)
+        self.assertIn('Accept-Encoding', plain['Vary'])
+        zipped = self.inbox('gzip, deflate')
+        self.assertEqual(zipped['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(zipped.content), plain.content)
+        self.assertLess(len(zipped.content), len(plain.content))
+        self.assertIsNone(middleware.negotiate('gzip;q=0, identity'))
+        if middleware.brotli:
+            brotli = self.inbox('gzip, br')
+            self.assertEqual(brotli['Content-Encoding'], 'br')
+            self.assertEqual(middleware.brotli.decompress(brotli.content), plain.content)
+
+    def test_small_and_streamed_events_are_not_compressed(self):
+        from django.http import HttpResponse, StreamingHttpResponse
+        from django.test import RequestFactory
+        from main.middleware import CompressionMiddleware
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip')
+        middleware = CompressionMiddleware(lambda request: None)
+        small = middleware.process_response(request, HttpResponse(b'{"ok": true}', content_type='application/json'))
+        self.assertNotIn('Content-Encoding', small)
+        events = StreamingHttpResponse(iter([b'data: 1\n\n'] * 200), content_type='text/event-stream')
+        self.assertNotIn('Content-Encoding', middleware.process_response(request, events))
+
+
+class ConditionalGetTests(APITestMixin, TestCase):
+    def setUp(self):
+        self.client = MixedClient(api)
+        self.profile = self.make_user('client')
+        self.headers = self.auth(self.profile)
+        self.user_id = self.profile.user.id
+
+    def get(self, path, **headers):
+        # Through Django's client, TestClient does not build the HTTP_IF_* META keys conditional GET reads
+        return Client().get(f'/api/{path}', headers={**self.headers, **headers})
+
+    def assertRevalidates(self, path):
+        """Returns the current ETag after checking that it answers 304"""
+        first = self.get(path)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first['Cache-Control'], 'private, no-cache')
+        etag = first['ETag']
+        # The account is cached by now: only the stamp lookup, none of the handler's queries
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get(path, **{'If-None-Match': f'W/{etag}'}).status_code, 304)
+        return etag
+
+    def test_profile_and_points(self):
+        for path in [f'profile/{self.user_id}', f'client/{self.user_id}']:
+            etag = self.assertRevalidates(path)
+            self.profile.address = f'{path} road'
+            self.profile.save()
+            self.assertEqual(self.get(path, **{'If-None-Match': etag}).status_code, 200)
+        etag = self.assertRevalidates(f'client/{self.user_id}')
+        PlasticCollection.objects.create(user=self.profile, amount_collected=2, status='Collected')
+        response = self.get(f'client/{self.user_id}', **{'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(float(response.json()['total_points']), 20)
+
+    def test_history_changes_with_collection_status(self):
+        agent = self.make_user('agent', role='Agent')
+        collection = PlasticCollection.objects.create(user=self.profile, amount_collected=1)
+        path = f'client/{self.user_id}/history?include_totals=true'
+        etag = self.assertRevalidates(path)
+        self.client.post(f'/agent/{agent.user.id}/claim?collection_id={collection.id}', headers=self.auth(agent))
+        response = self.get(path, **{'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['pending_requests']), 1)
+
+    def test_rewards_change_with_claims_and_catalog(self):
+        PlasticCollection.objects.create(user=self.profile, amount_collected=10, status='Collected')
+        reward = ListReward.objects.create(title='Coupon', points_required=30, reward_type='Offer')
+        path = f'client/{self.user_id}/rewards'
+        etag = self.assertRevalidates(path)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f'/client/{self.user_id}/rewards/{reward.id}/claim', headers=self.headers)
+        self.assertEqual(self.get(path, **{'If-None-Match': etag}).json(), [])
+        etag = self.assertRevalidates(path)
+        with self.captureOnCommitCallbacks(execute=True):
+            ListReward.objects.create(title='Bag', points_required=5, reward_type='Offer')
+        self.assertEqual([reward['name'] for reward in self.get(path, **{'If-None-Match': etag}).json()], ['Bag'])
+
+    def test_login_leaves_the_profile_stamp_alone(self):
+        etag = self.get(f'profile/{self.user_id}')['ETag']
+        user = User.objects.get(pk=self.user_id)
+        # Only the UPDATE: no profile lookup, no stamp bump
+        with self.assertNumQueries(1):
+            user.save(update_fields=['last_login'])
+        self.assertEqual(self.get(f'profile/{self.user_id}', **{'If-None-Match': etag}).status_code, 304)
+        user.first_name = 'Renamed'
+        user.save(update_fields=['first_name'])
+        self.assertEqual(self.get(f'profile/{self.user_id}', **{'If-None-Match': etag}).status_code, 200)
+
+    def test_if_modified_since(self):
+        PlasticCollection.objects.create(user=self.profile, amount_collected=1)
+        path = f'client/{self.user_id}/history'
+        key = versions.collections_key(self.profile.pk)
+        # Bumped within the current second: a later bump in the same second would not move a
+        # whole-second date, so only the ETag validates
+        response = self.get(path)
+        self.assertNotIn('Last-Modified', response)
+        stamp = VersionStamp.objects.get(key=key).modified_date
+        since = http_date(int(stamp.timestamp()) + 1)
+        self.assertEqual(self.get(path, **{'If-Modified-Since': since}).status_code, 200)
+
+        VersionStamp.objects.filter(key=key).update(modified_date=timezone.now() - timedelta(seconds=5))
+        last_modified = self.get(path)['Last-Modified']
+        self.assertEqual(self.get(path, **{'If-Modified-Since': last_modified}).status_code, 304)
+        versions.bump(key)
+        self.assertEqual(self.get(path, **{'If-Modified-Since': last_modified}).status_code, 200)
+
+
+@override_settings(METRICS_TOKEN='scrape-token', METRICS_DIR='')
+class MetricsTests(APITestMixin, TestCase):
+    def setUp(self):
+        metrics.registry.clear()
+        self.profile = self.make_user('client')
+
+    def scrape(self, **headers):
+        return Client().get('/metrics', headers={'Authorization': 'Bearer scrape-token', **headers})
+
+    def sample(self, text, line_start):
+        lines = [line for line in text.splitlines() if line.startswith(line_start)]
+        self.assertEqual(len(lines), 1, line_start)
+        return float(lines[0].rsplit(' ', 1)[1])
+
+    def test_route_metrics(self):
+        Client().post('/api/user/login', {'username': 'client', 'password': 'testpassword'}, content_type='application/json')
+        Client().post('/api/user/login', {'username': 'client', 'password': 'wrong'}, content_type='application/json')
+        # Async handler: its queries run in sync_to_async threads and still count
+        async_to_sync(AsyncClient().get)(f'/api/client/{self.profile.user.id}/history', headers=self.auth(self.profile))
+        text = self.scrape().content.decode()
+        login = 'route="api:login",path="api/user/login",method="POST"'
+        self.assertEqual(self.sample(text, f'cygree_http_request_duration_seconds_count{{{login}}}'), 2)
+        self.assertEqual(self.sample(text, f'cygree_http_request_duration_seconds_bucket{{{login},le="+Inf"}}'), 2)
+        self.assertEqual(self.sample(text, f'cygree_http_responses_total{{{login},status="200"}}'), 1)
+        self.assertEqual(self.sample(text, f'cygree_http_responses_total{{{login},status="400"}}'), 1)
+        self.assertGreater(self.sample(text, f'cygree_http_request_db_queries_sum{{{login}}}'), 0)
+        self.assertGreater(self.sample(text, f'cygree_http_response_size_bytes_sum{{{login}}}'), 0)
+        history = 'route="api:get_history",path="api/client/<user_id>/history",method="GET"'
+        self.assertGreaterEqual(self.sample(text, f'cygree_http_request_db_queries_sum{{{history}}}'), 2)
+        self.assertIn('# TYPE cygree_http_request_duration_seconds histogram', text)
+
+    def test_routes_sharing_a_name(self):
+        # LeaderboardController.top and AnalyticsController.top are both api:top
+        Client().get('/api/leaderboard')
+        Client().get('/api/analytics/top')
+        text = self.scrape().content.decode()
+        self.assertEqual(self.sample(text, 'cygree_http_request_duration_seconds_count{route="api:top",path="api/leaderboard",method="GET"}'), 1)
+        self.assertEqual(self.sample(text, 'cygree_http_request_duration_seconds_count{route="api:top",path="api/analytics/top",method="GET"}'), 1)
+
+    def test_streaming_responses_are_only_counted(self):
+        admin = self.make_user('admin')
+        User.objects.filter(pk=admin.user_id).update(is_superuser=True)
+        response = Client().get('/api/exports/collections', headers=self.auth(admin))
+        self.assertTrue(response.streaming)
+        b''.join(response.streaming_content)
+        text = self.scrape().content.decode()
+        labels = 'route="api:export",path="api/exports/<name>",method="GET"'
+        self.assertEqual(self.sample(text, f'cygree_http_responses_total{{{labels},status="200"}}'), 1)
+        self.assertNotIn(f'cygree_http_request_duration_seconds_count{{{labels}}}', text)
+
+    def test_periodic_flush_runs_off_the_request(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(METRICS_DIR=directory, METRICS_FLUSH_SECONDS=0), \
+                mock.patch.object(metrics.threading, 'Thread', wraps=threading.Thread) as thread:
+            metrics.registry.flushed = 0.0
+            Client().post('/api/user/login', {'username': 'client', 'password': 'testpassword'}, content_type='application/json')
+            self.assertEqual(thread.call_args.kwargs['target'], metrics._background_flush)
+            # The writer releases the lock once the file is in place
+            with metrics._flushing:
+                self.assertTrue(os.path.exists(os.path.join(directory, f'{os.getpid()}.json')))
+
+    def test_protected(self):
+        self.assertEqual(self.scrape(Authorization='').status_code, 401)
+        self.assertEqual(self.scrape(Authorization='Bearer other').status_code, 401)
+        self.assertEqual(self.scrape().status_code, 200)
+        staff = User.objects.create_user(username='staff', password='testpassword', is_staff=True)
+        client = Client()
+        client.force_login(staff)
+        self.assertEqual(client.get('/metrics').status_code, 200)
+
+    def test_directory_aggregates_workers(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(METRICS_DIR=directory):
+            Client().post('/api/user/login', {'username': 'client', 'password': 'testpassword'}, content_type='application/json')
+            labels = (('route', 'api:login'), ('path', 'api/user/login'), ('method', 'POST'))
+            # Another worker's file
+            with open(os.path.join(directory, '1.json'), 'w') as file:
+                json.dump([['cygree_http_responses_total', [list(pair) for pair in labels + (('status', '200'),)], 4]], file)
+            text = self.scrape().content.decode()
+            self.assertTrue(os.path.exists(os.path.join(directory, f'{os.getpid()}.json')))
+        self.assertEqual(self.sample(text, 'cygree_http_responses_total{route="api:login",path="api/user/login",method="POST",status="200"}'), 5)
@@ -0,0 +1,129 @@
+import hashlib
+from functools import wraps
+from inspect import iscoroutinefunction
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+# Version stamps for conditional GET. Every write that changes what a client screen shows
+# bumps the stamp of the resources involved, in the same transaction as the write, so a
+# reader never sees a new stamp without the new data:
+#   profile:<profile id>      profile and user fields, point and plastic balances
+#   collections:<profile id>  the client's collection requests and their status
+#   rewards:<profile id>      rewards the client has claimed
+#   catalog                   the reward catalog
+# Handlers decorated with conditional() derive an ETag and Last-Modified from the stamps
+# and answer If-None-Match / If-Modified-Since with 304 before running their queries.
+
+
+def profile_key(profile_id):
+    return f'profile:{profile_id}'
+
+
+def collections_key(profile_id):
+    return f'collections:{profile_id}'
+
+
+def rewards_key(profile_id):
+    return f'rewards:{profile_id}'
+
+
+CATALOG_KEY = 'catalog'
+
+
+def bump(*keys):
+    """Advance the stamps of keys, creating the missing ones"""
+    from main.models import VersionStamp
+    keys = set(keys)
+    if not keys:
+        return
+    now = timezone.now()
+    with transaction.atomic():
+        stamps = VersionStamp.objects.filter(key__in=keys)
+        if stamps.update(version=F('version') + 1, modified_date=now) == len(keys):
+            return
+        for key in keys - set(stamps.values_list('key', flat=True)):
+            try:
+                with transaction.atomic():
+                    VersionStamp.objects.create(key=key, version=1, modified_date=now)
+            except IntegrityError:
+                # Created concurrently, fall back to advancing it
+                VersionStamp.objects.filter(key=key).update(version=F('version') + 1, modified_date=now)
+
+
+def _validators(keys, rows):
+    """(ETag, Last-Modified) for the stamps of keys. Keys never written have version 0 and
+    no modification date, Last-Modified is left out until all of them have one"""
+    stamps = {key: (version, modified_date) for key, version, modified_date in rows}
+    versions = ';'.join(f'{key}={stamps.get(key, (0, None))[0]}' for key in keys)
+    etag = '"%s"' % hashlib.md5(versions.encode(), usedforsecurity=False).hexdigest()[:20]
+    dates = [stamps[key][1] for key in keys if key in stamps]
+    if not dates or len(dates) < len(keys):
+        return etag, None
+    # HTTP dates have whole seconds. Last-Modified is the second after the newest stamp and
+    # is only sent once that second has passed: a bump after this response then always
+    # moves it forward, while a truncated date would repeat for bumps in the same second
+    last_modified = int(max(dates).timestamp()) + 1
+    if last_modified > timezone.now().timestamp():
+        return etag, None
+    return etag, last_modified
+
+
+def validators(keys):
+    from main.models import VersionStamp
+    return _validators(keys, VersionStamp.objects.filter(key__in=keys).values_list('key', 'version', 'modified_date'))
+
+
+async def avalidators(keys):
+    """Async version of validators"""
+    from main.models import VersionStamp
+    rows = [row async for row in VersionStamp.objects.filter(key__in=keys).values_list('key', 'version', 'modified_date')]
+    return _validators(keys, rows)
+
+
+def _finish(controller, request, etag, last_modified):
+    """304 response when the client's copy is current, otherwise None after adding the
+    validators to the response the handler is about to produce"""
+    not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    response = controller.context.response if not_modified is None else not_modified
+    response.headers['ETag'] = etag
+    if last_modified is not None:
+        response.headers['Last-Modified'] = http_date(last_modified)
+    # Per-user data: keep it out of shared caches and have clients revalidate every time
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return not_modified
+
+
+def conditional(resources):
+    """Decorator for GET handlers of /{user_id}/ routes. resources(profile_id) returns the
+    stamp keys the response depends on"""
+    from main.auth import aowned_profile_id, owned_profile_id
+
+    def decorator(handler):
+        if iscoroutinefunction(handler):
+            @wraps(handler)
+            async def async_wrapper(controller, request, *args, **kwargs):
+                etag, last_modified = await avalidators(resources(await aowned_profile_id(request, kwargs['user_id'])))
+                not_modified = _finish(controller, request, etag, last_modified)
+                if not_modified is not None:
+                    return not_modified
+                return await handler(controller, request, *args, **kwargs)
+            return async_wrapper
+
+        @wraps(handler)
+        def wrapper(controller, request, *args, **kwargs):
+            etag, last_modified = validators(resources(owned_profile_id(request, kwargs['user_id'])))
+            not_modified = _finish(controller, request, etag, last_modified)
+            if not_modified is not None:
+                return not_modified
+            return handler(controller, request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def profile_image_processed(pk, image):
+    """images hook: profile picture derivatives are part of the profile"""
+    bump(profile_key(pk))
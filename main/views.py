@@ -1,3 +1,23 @@
-from django.shortcuts import render
+import hmac
 
-# Create your views here.
+from django.conf import settings
+from django.http import HttpResponse
+from django.views.decorators.http import require_GET
+
+from main import metrics as request_metrics
+
+
+def _authorized(request):
+    header = request.META.get('HTTP_AUTHORIZATION', '')
+    if settings.METRICS_TOKEN and header.startswith('Bearer '):
+        return hmac.compare_digest(header[len('Bearer '):].encode(), settings.METRICS_TOKEN.encode())
+    return request.user.is_authenticated and request.user.is_staff
+
+
+@require_GET
+def metrics(request):
+    """Request metrics for Prometheus, see main/metrics.py"""
+    if not _authorized(request):
+        return HttpResponse(status=401, headers={'WWW-Authenticate': 'Bearer'})
+    return HttpResponse(request_metrics.render(request_metrics.collect()),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')